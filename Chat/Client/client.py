@@ -1,24 +1,28 @@
 import calendar
-import inspect
-import json
 import logging
 import os
 import sys
 import threading
 import dis
-import time
+import itertools
+import selectors
+from collections import deque
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
 from datetime import datetime, timezone
-from socket import socket, AF_INET, SOCK_STREAM
-from functools import wraps
+from socket import socket, socketpair, AF_INET, SOCK_STREAM
 from threading import Thread
 from PyQt6 import QtWidgets
 
 path = os.path.abspath(os.path.join(".."))
 sys.path.append(path)
 
+from common.codec import CODECS, DEFAULT_CODEC, JSON_CODEC, decode_message
+from common.compression import COMPRESSIONS, Compressor
+from common.framing import FrameBuffer, encode_frame
+from common.tracing import trace
 from client_database import ClientDatabaseStorage
 from gui_client import ClientWindow, ChatDialogWindow, AddContactDialogWindow,\
-    DelContactDialogWindow
+    DelContactDialogWindow, ClientSignals
 import client_log_config
 
 logger = logging.getLogger('chat.client')
@@ -26,19 +30,13 @@ logger = logging.getLogger('chat.client')
 
 def log(func):
     """
-    Декоратор. Логгер срабатывания функции
+    Декоратор. Логгер срабатывания функции (см. common.tracing.trace).
+    Если уровень логгера выше DEBUG, вызов функции не записывается.
 
     :param func: Оборачиваемая функция
     :return: Оборачиваемая функция
     """
-    @wraps(func)
-    def decorated(*args, **kwargs):
-        logger.debug(f' Функция {func.__name__} вызвана из функции '
-                     f'{inspect.stack()[1].function}')
-        res = func(*args, **kwargs)
-        return res
-
-    return decorated
+    return trace(logger)(func)
 
 
 @log
@@ -96,9 +94,30 @@ class ClientVerifier(type):
         type.__init__(self, clsname, bases, clsdict)
 
 
+class PendingRequest:
+    """Запрос, ожидающий ответа сервера"""
+    __slots__ = ('future', 'frames', 'stream')
+
+    def __init__(self, stream):
+        """
+        :param stream: ответ состоит из нескольких кадров, последний содержит "done": true
+        """
+        self.future = Future()
+        self.frames = []
+        self.stream = stream
+
+
 class MessangerClient(Thread, metaclass=ClientVerifier):
     """Основной класс проекта"""
-    def __init__(self, user_name, password, addr='localhost', port=7777):
+    recv_size = 65536
+    """Размер буфера чтения сокета"""
+    sync_page_size = 1000
+    """Количество сообщений в одном ответе при синхронизации истории"""
+    request_timeout = 10
+    """Время ожидания ответа на запрос, секунд"""
+
+    def __init__(self, user_name, password, addr='localhost', port=7777, codec=DEFAULT_CODEC, compression=None,
+                 database=None):
         """
         Экземпляр класса клиента чата
 
@@ -106,15 +125,34 @@ class MessangerClient(Thread, metaclass=ClientVerifier):
         :param password: Пароль
         :param addr: Адрес сервера
         :param port: Порт на сервере
+        :param codec: Формат сообщений, запрашиваемый у сервера при аутентификации (json или binary)
+        :param compression: Сжатие сообщений, запрашиваемое у сервера (zlib, zlib-dict или None)
+        :param database: База клиента, по умолчанию client_database.sqlite3 в текущем каталоге
         """
         self.user_name = user_name
         self.password = password
         self.addr = addr
         self.port = port
         self.socket = None  # self.get_socket(AF_INET, SOCK_STREAM)
+        self.read_buffer = FrameBuffer()
+        self.received_frames = deque()
+        self.received_ids = []
+        self.codec_name = codec
+        self.codec = JSON_CODEC
+        self.compression_name = compression
+        self.compression = None
         self.cv = threading.Condition()
-        self.database = ClientDatabaseStorage('sqlite:///client_database.sqlite3', False)
-        self.lock = threading.Lock()
+        self.database = database or ClientDatabaseStorage('sqlite:///client_database.sqlite3', False)
+        self.lock = threading.Lock()  # Запись в сокет из разных потоков
+        self.request_ids = itertools.count(1)
+        self.pending_requests = {}
+        self.reader_thread = None
+        self.message_handler = None
+        self.history_handler = None
+        self.disconnect_handler = None
+        self.wakeup_reader, self.wakeup_writer = socketpair()  # Пробуждение потока receiver при остановке
+        self.connected = threading.Event()
+        self.stopped = threading.Event()
         self.client_is_active = False
         self.is_authenticate = False
         super().__init__()
@@ -126,35 +164,37 @@ class MessangerClient(Thread, metaclass=ClientVerifier):
 
         :param status: Статус подключения
         :param _type: тип сообщения
-        :return: Сообщение в формате JSON
+        :return: Сообщение (dict)
         """
         logger.debug("Создаём presence сообщение серверу")
-        return json.dumps({
+        return {
             "action": "presence",
             "time": calendar.timegm(datetime.now(timezone.utc).utctimetuple()),
             "type": _type,
             "user": {
                 "account_name": self.user_name,
                 "status": status,
-            }
-        })
+            },
+            **self.get_options_request(),
+        }
 
     def create_authenticate_message(self):
         """
         Создание сообщения аутентификации
 
-        :return: Сообщение в формате JSON
+        :return: Сообщение (dict)
         """
         logger.debug("Создаём authenticate сообщение серверу")
 
-        return json.dumps({
+        return {
             "action": "authenticate",
             "time": calendar.timegm(datetime.now(timezone.utc).utctimetuple()),
             "user": {
                 "account_name": self.user_name,
                 "password": self.password,
-            }
-        })
+            },
+            **self.get_options_request(),
+        }
 
     # @log
     def create_text_message(self, to_user, message, encoding='utf-8'):
@@ -164,75 +204,136 @@ class MessangerClient(Thread, metaclass=ClientVerifier):
         :param to_user: Кому отправить
         :param message: Текст сообщения
         :param encoding: Кодировка
-        :return: Сообщение в формате JSON
+        :return: Сообщение (dict)
         """
         logger.debug("Создаём текстовое сообщение")
-        return json.dumps({
+        return {
             "action": "msg",
             "time": calendar.timegm(datetime.now(timezone.utc).utctimetuple()),
             "to": to_user,
             "from": self.user_name,
             "encoding": encoding,
             "message": message,
-        })
+        }
 
     def create_get_contacts_message(self):
         """
         Создание сообщения запроса списка контактов пользователя
 
-        :return: Сообщение в формате JSON
+        :return: Сообщение (dict)
         """
         logger.debug("Создаём запрос списка контактов пользователя")
-        return json.dumps({
+        return {
             "action": "get_contacts",
             "time": calendar.timegm(datetime.now(timezone.utc).utctimetuple()),
             "user_login": self.user_name,
-        })
+        }
 
     def create_add_contacts_message(self, contact):
         """
         Создание сообщения добавления контакта в список контактов пользователя
 
         :param contact: Имя пользователя - контакта
-        :return: Сообщение в формате JSON
+        :return: Сообщение (dict)
         """
         logger.debug("Создаём запрос на добавление контакта в список")
-        return json.dumps({
+        return {
             "action": "add_contact",
             "user_id": self.user_name,
             "time": calendar.timegm(datetime.now(timezone.utc).utctimetuple()),
             "user_login": contact,
-        })
+        }
 
     def create_del_contacts_message(self, contact):
         """
         Создание сообщения удаления контакта из списка контактов пользователя
 
         :param contact: Имя пользователя - контакта
-        :return: Сообщение в формате JSON
+        :return: Сообщение (dict)
         """
         logger.debug("Создаём запрос на добавление контакта в список")
-        return json.dumps({
+        return {
             "action": "del_contact",
             "user_id": self.user_name,
             "time": calendar.timegm(datetime.now(timezone.utc).utctimetuple()),
             "user_login": contact,
-        })
+        }
+
+    def create_sync_history_message(self, cursors, since, after_id=0):
+        """
+        Создание запроса сообщений истории, которых нет в базе клиента
+
+        :param cursors: наибольший id сообщения сервера в каждой переписке
+        :param since: id последней завершённой синхронизации
+        :param after_id: продолжение ответа после сообщения с этим id
+        :return: Сообщение (dict)
+        """
+        logger.debug("Создаём запрос синхронизации истории сообщений")
+        return {
+            "action": "sync_history",
+            "time": calendar.timegm(datetime.now(timezone.utc).utctimetuple()),
+            "cursors": cursors,
+            "since": since,
+            "after_id": after_id,
+            "limit": self.sync_page_size,
+        }
+
+    def create_ack_message(self, ids):
+        """
+        Создание подтверждения получения сообщений, сохранённых сервером до подключения клиента
+
+        :param ids: id полученных сообщений
+        :return: Сообщение (dict)
+        """
+        logger.debug("Создаём подтверждение получения сообщений")
+        return {
+            "action": "ack",
+            "time": calendar.timegm(datetime.now(timezone.utc).utctimetuple()),
+            "ids": ids,
+        }
+
+    def get_options_request(self):
+        """
+        Поля запроса формата и сжатия сообщений для presence и authenticate.
+        Для JSON без сжатия поля не передаются.
+
+        :return: dict
+        """
+        options = {}
+        if self.codec_name != DEFAULT_CODEC:
+            options["codec"] = self.codec_name
+        if self.compression_name:
+            options["compression"] = self.compression_name
+        return options
+
+    def accept_options(self, server_response):
+        """
+        Переход на формат и сжатие сообщений, выбранные сервером в ответе на presence или authenticate
+
+        :param server_response: ответ сервера (dict)
+        """
+        if 'codec' in server_response:
+            self.codec = CODECS.get(server_response['codec'], JSON_CODEC)
+        if 'compression' in server_response:
+            name = server_response['compression']
+            self.compression = Compressor(name) if name in COMPRESSIONS else None
 
     # @log
-    def parse_server_response(self, data):
+    def parse_server_response(self, response_data):
         """
         Обработка сообщения от сервера
 
-        :param data: сырое сообщения
-        :return: Сообщение в формате dict
+        :param response_data: сообщение (dict)
+        :return: Текст для вывода или False
         """
         logger.debug("Парсим ответ сервера")
-        response_data = json.loads(data)
 
         if 'action' in response_data and response_data['action'] == 'msg' \
                 and (response_data["to"] == self.user_name or response_data["to"].lower() == 'all'):
-            self.database.save_message_to_history(response_data["from"], response_data["to"], response_data["message"])
+            self.save_message(response_data["from"], response_data["to"], response_data["message"],
+                              response_data.get("id"))
+            if response_data.get("stored"):
+                self.received_ids.append(response_data["id"])
             response_data = f'{response_data["from"]}: {response_data["message"]}'
             return response_data
         return False
@@ -249,33 +350,196 @@ class MessangerClient(Thread, metaclass=ClientVerifier):
         logger.debug("Создаём сокет")
         s = socket(addr_family, socket_type)  # Создать сокет TCP
         s.connect((self.addr, self.port))  # Соединиться с сервером
-        s.settimeout(1)
+        s.settimeout(self.request_timeout)  # Поток receiver читает сокет только после select
 
         return s
 
+    def send_data(self, data):
+        """
+        Отправка сообщения серверу одним кадром в согласованном формате и со сжатием
+
+        :param data: Сообщение (dict)
+        """
+        payload = self.codec.encode(data)
+        frame = encode_frame(*self.compression.compress(payload)) if self.compression else encode_frame(payload)
+        with self.lock:
+            self.socket.sendall(frame)
+
+    def request(self, message, stream=False):
+        """
+        Отправка запроса без ожидания ответа. Запросу назначается request_id, кадр ответа сервера
+        с этим request_id завершает возвращаемый Future, поэтому можно отправить несколько запросов подряд.
+
+        :param message: Сообщение (dict)
+        :param stream: ответ состоит из нескольких кадров, последний содержит "done": true
+        :return: Future с ответом сервера (dict) или со списком кадров ответа, если stream
+        """
+        request_id = next(self.request_ids)
+        pending = PendingRequest(stream)
+        self.pending_requests[request_id] = pending
+        message['request_id'] = request_id
+        try:
+            self.send_data(message)
+        except OSError:
+            del self.pending_requests[request_id]
+            raise
+        return pending.future
+
+    def wait_response(self, future):
+        """
+        Ожидание ответа на запрос. Ответы читает поток receiver, если он ещё не запущен
+        (аутентификация до запуска клиента), сообщения сервера читаются в текущем потоке.
+
+        :param future: результат request
+        :return: ответ сервера
+        """
+        reader = self.reader_thread
+        if reader and reader.is_alive() and reader is not threading.current_thread():
+            try:
+                return future.result(self.request_timeout)
+            except FutureTimeoutError:
+                # Запрос больше не ожидает ответа: опоздавший ответ не завершит брошенный Future
+                for request_id, pending in list(self.pending_requests.items()):
+                    if pending.future is future:
+                        self.pending_requests.pop(request_id, None)
+                raise
+        while not future.done():
+            message = self.receive_data()
+            if message is None:
+                raise ConnectionError('Сервер закрыл соединение')
+            self.dispatch(message)
+        return future.result()
+
+    def call(self, message, stream=False):
+        """
+        Отправка запроса и ожидание ответа
+
+        :param message: Сообщение (dict)
+        :param stream: ответ состоит из нескольких кадров
+        :return: ответ сервера (dict) или список кадров ответа, если stream
+        """
+        return self.wait_response(self.request(message, stream))
+
+    def dispatch(self, message):
+        """
+        Передача сообщения сервера запросу, который ожидает ответ с его request_id.
+        Сообщения без request_id (сообщения других пользователей) передаются в parse_server_response,
+        текст для пользователя - в message_handler.
+
+        :param message: сообщение сервера (dict)
+        """
+        logger.debug(f'Сообщение от сервера: {message}')
+        pending = self.pending_requests.get(message.get('request_id'))
+        if pending is None:
+            text = self.parse_server_response(message)
+            if text:
+                if self.message_handler:
+                    self.message_handler(text)
+                else:
+                    print(f'\n{text}\n>', end='')
+            self.send_ack()
+            return
+        if pending.stream:
+            pending.frames.append(message)
+            if not message.get('done'):
+                return
+            result = pending.frames
+        else:
+            result = message
+        if self.pending_requests.pop(message['request_id'], None) is pending:
+            pending.future.set_result(result)
+
+    def fail_pending_requests(self, error):
+        """
+        Завершение ожидающих запросов ошибкой при разрыве соединения
+
+        :param error: исключение
+        """
+        while self.pending_requests:
+            _, pending = self.pending_requests.popitem()
+            pending.future.set_exception(error)
+
+    def send_ack(self):
+        """
+        Подтверждение полученных недоставленных сообщений. Отправляется одно подтверждение
+        на все сообщения, уже прочитанные из сокета, после их сохранения в базу.
+        """
+        if self.received_ids and not self.received_frames:
+            self.send_data(self.create_ack_message(self.received_ids))
+            self.received_ids = []
+
+    def receive_data(self):
+        """
+        Получение следующего сообщения от сервера. Кадры, пришедшие одним блоком, сохраняются
+        для следующих вызовов, неполный кадр дочитывается из сокета.
+
+        :return: Сообщение (dict) или None, если сервер закрыл соединение
+        """
+        while not self.received_frames:
+            data = self.socket.recv(self.recv_size)
+            if not data:
+                return None
+            self.received_frames.extend(self.read_buffer.feed(data))
+        return decode_message(self.received_frames.popleft())
+
     # @log
     def receiver(self):
-        """Приём сообщений от сервера"""
-        while self.client_is_active:
-            time.sleep(1)
-            with self.lock:
-                try:
-                    data = self.socket.recv(1000000).decode('utf-8')
-
-                    if data:
-                        logger.debug(f'Сообщение от сервера: {data}, длиной {len(data)} байт')
-                        server_response = self.parse_server_response(data)
-                        if server_response:
-                            print(f'\n{server_response}\n>', end='')
-                    else:
-                        logger.critical("Server close connection")
-                        self.socket.close()
-                        break
-                except OSError as err:
-                    if err.errno:
+        """
+        Приём сообщений от сервера. Единственный поток, читающий сокет после запуска клиента.
+        Поток ждёт в select готовности сокета или сигнала остановки, без опроса по таймауту,
+        и разбирает все кадры, прочитанные из сокета, сразу после их поступления.
+        """
+        selector = selectors.DefaultSelector()
+        selector.register(self.socket, selectors.EVENT_READ)
+        selector.register(self.wakeup_reader, selectors.EVENT_READ)
+        try:
+            while self.client_is_active:
+                # Кадры, прочитанные из сокета до запуска потока (аутентификация)
+                while self.received_frames:
+                    self.dispatch(decode_message(self.received_frames.popleft()))
+                for key, _ in selector.select():
+                    if key.fileobj is self.wakeup_reader:
+                        self.wakeup_reader.recv(64)
+                        continue
+                    try:
+                        data = self.socket.recv(self.recv_size)
+                    except OSError:
                         logger.critical('Lost server connection')
-                        self.socket.close()
-                        break
+                        return
+                    if not data:
+                        logger.critical("Server close connection")
+                        return
+                    self.received_frames.extend(self.read_buffer.feed(data))
+        finally:
+            selector.close()
+            self.client_is_active = False
+            self.socket.close()
+            self.fail_pending_requests(ConnectionError('Соединение с сервером разорвано'))
+            self.stopped.set()
+            if self.disconnect_handler:
+                self.disconnect_handler()
+
+    def stop(self):
+        """Остановка клиента: поток receiver выходит из ожидания select и закрывает соединение"""
+        self.client_is_active = False
+        self.stopped.set()
+        try:
+            self.wakeup_writer.send(b'\0')
+        except OSError:
+            pass
+
+    def save_message(self, user_from, user_to, message, server_id=None):
+        """
+        Сохранение сообщения в историю, сохранённая строка передаётся в history_handler
+
+        :param user_from: Отправитель
+        :param user_to: Получатель
+        :param message: Текст сообщения
+        :param server_id: id сообщения в истории сервера
+        """
+        row = self.database.save_message_to_history(user_from, user_to, message, server_id)
+        if row and self.history_handler:
+            self.history_handler(row)
 
     def send_message(self, to_user, msg):
         """
@@ -285,10 +549,9 @@ class MessangerClient(Thread, metaclass=ClientVerifier):
         :param msg: Текст сообщения
         """
         msg = msg.strip()
-        with self.lock:
-            self.database.save_message_to_history(self.user_name, to_user, msg)
-            msg = self.create_text_message(to_user, msg)
-            self.socket.send(msg.encode('utf-8'))  # Отправить!
+        self.save_message(self.user_name, to_user, msg)
+        msg = self.create_text_message(to_user, msg)
+        self.send_data(msg)  # Отправить!
 
     # @log
     def sender(self):
@@ -300,8 +563,7 @@ class MessangerClient(Thread, metaclass=ClientVerifier):
         while self.client_is_active:
             msg = input('>')
             if msg == 'exit':
-                # break
-                self.client_is_active = False
+                self.stop()
             elif msg == 'help':
                 self.show_help()
             elif msg == 'contacts':
@@ -314,7 +576,7 @@ class MessangerClient(Thread, metaclass=ClientVerifier):
                     self.send_message(to_user, msg)
                 except OSError:
                     logger.critical('Соединение с сервером разорвано. Перезапустите клиент.')
-                    self.socket.close()
+                    self.stop()
                     break
                 except ValueError:
                     print('Неправильный формат сообщения!')
@@ -345,13 +607,7 @@ class MessangerClient(Thread, metaclass=ClientVerifier):
         """
         msg = self.create_presence_message(status)
         logger.debug("Отправляем Presense сообщение серверу")
-
-        with self.lock:
-            self.socket.send(msg.encode('utf-8'))
-            data = self.socket.recv(1000000).decode('utf-8')
-
-        if data:
-            logger.debug(f'Сообщение от сервера: {data}, длиной {len(data)} байт')
+        self.accept_options(self.call(msg))
 
     def contacts_manager(self):
         """Обработка меню контактов в консоли"""
@@ -372,17 +628,28 @@ class MessangerClient(Thread, metaclass=ClientVerifier):
         msg = self.create_get_contacts_message()
         logger.debug("Отправляем Запрос списка контактов")
 
-        with self.lock:
-            self.socket.send(msg.encode('utf-8'))
-            data = self.socket.recv(1000000).decode('utf-8')
+        server_response = self.call(msg)
+        if 'alert' in server_response and len(server_response['alert']):
+            self.database.remove_all_contacts()
+            for contact in server_response['alert']:
+                self.database.add_contact(self.user_name, contact)
 
-            if data:
-                logger.debug(f'Сообщение от сервера: {data}, длиной {len(data)} байт')
-                server_response = json.loads(data)
-                if server_response and 'alert' in server_response and len(server_response['alert']):
-                    self.database.remove_all_contacts()
-                    for contact in server_response['alert']:
-                        self.database.add_contact(self.user_name, contact)
+    def sync_history(self):
+        """
+        Получение сообщений, отправленных пока клиент был не в сети. Сервер передаёт только сообщения,
+        которых нет в базе клиента, каждая страница ответа сохраняется одной транзакцией.
+        """
+        logger.debug("Отправляем Запрос синхронизации истории")
+        cursors, since = self.database.get_sync_cursors(self.user_name)
+        after_id = 0
+        more = True
+        while more:
+            frames = self.call(self.create_sync_history_message(cursors, since, after_id), stream=True)
+            rows = [row for frame in frames for row in frame['alert']]
+            more = frames[-1]['more']
+            after_id = frames[-1]['cursor']
+            self.database.save_synced_messages(self.user_name, rows, None if more else after_id)
+            logger.debug(f'Получено {len(rows)} сообщений истории')
 
     def show_contacts(self):
         """Отображение списка контактов в консоли"""
@@ -406,15 +673,8 @@ class MessangerClient(Thread, metaclass=ClientVerifier):
         else:
             return
 
-        with self.lock:
-            self.socket.send(msg.encode('utf-8'))
-
-            data = self.socket.recv(1000000).decode('utf-8')
-
-            if data:
-                logger.debug(f'Сообщение от сервера: {data}, длиной {len(data)} байт')
-                server_response = json.loads(data)
-        if server_response and server_response['response'] and server_response['response'] in range(200, 300):
+        server_response = self.call(msg)
+        if server_response['response'] in range(200, 300):
             self.get_contacts()
 
     def show_messages_history(self, user_from, user_to):
@@ -433,18 +693,13 @@ class MessangerClient(Thread, metaclass=ClientVerifier):
         msg = self.create_authenticate_message()
         logger.debug("Отправляем Запрос аутентификации")
 
-        with self.lock:
-            self.socket.send(msg.encode('utf-8'))
-            data = self.socket.recv(1000000).decode('utf-8')
-
-            if data:
-                logger.debug(f'Сообщение от сервера: {data}, длиной {len(data)} байт')
-                server_response = json.loads(data)
-                if server_response and 'response' in server_response and server_response and 'alert' in server_response:
-                    if server_response['response'] == 200:
-                        return True
-                    logger.critical(f'Ошибка авторизации на сервере. '
-                                    f'Код {server_response["response"]}, описание: {server_response["alert"]}')
+        server_response = self.call(msg)
+        if 'response' in server_response and 'alert' in server_response:
+            if server_response['response'] == 200:
+                self.accept_options(server_response)
+                return True
+            logger.critical(f'Ошибка авторизации на сервере. '
+                            f'Код {server_response["response"]}, описание: {server_response["alert"]}')
         return False
 
     # @log
@@ -458,19 +713,17 @@ class MessangerClient(Thread, metaclass=ClientVerifier):
         self.client_is_active = True
 
         logger.debug("Запускаем потоки...")
-        receiver_thread = Thread(target=self.receiver)
+        receiver_thread = self.reader_thread = Thread(target=self.receiver)
         receiver_thread.daemon = True
         receiver_thread.start()
 
         sender_thread = Thread(target=self.sender)
         sender_thread.daemon = True
         sender_thread.start()
-        # sender_thread.join()
-        #
-        while self.client_is_active:
-            if not receiver_thread.is_alive() or not sender_thread.is_alive():
-                break
-            time.sleep(1)
+
+        self.connected.set()
+        # Поток завершается, когда receiver потерял соединение или пользователь вышел
+        self.stopped.wait()
 
 
 def ask_user_name():
@@ -497,6 +750,13 @@ def main():
     main_window = ClientWindow()
     client = MessangerClient(main_window.edtUserName.text(), main_window.adtPassword.text())
 
+    # Сообщения из потока receiver передаются в главный поток Qt сигналом, без опроса по таймеру
+    signals = ClientSignals()
+    client.message_handler = signals.message_received.emit
+    client.history_handler = signals.history_added.emit
+    client.disconnect_handler = signals.connection_lost.emit
+    open_dialogs = set()
+
     def connect():
         client.user_name = main_window.edtUserName.text()
         client.password = main_window.adtPassword.text()
@@ -504,17 +764,13 @@ def main():
             client.daemon = True
             client.start()
 
-        for _ in range(0, 30):
-            if client.client_is_active:
-                break
-            time.sleep(0.5)
-
-        if not client.client_is_active:
+        if not client.connected.wait(15) or not client.client_is_active:
             raise ConnectionError('Не удалось выполнить подключение за указанное время.')
 
         # client.send_presense('online')
         if client.authenticate():
             client.is_authenticate = True
+            client.sync_history()
             main_window.database = client.database
             main_window.username = main_window.edtUserName.text()
             main_window.addr = main_window.edtAddres.text()
@@ -537,24 +793,39 @@ def main():
         if user_to:
             dialog = ChatDialogWindow(user_to, main_window)
 
-            def update_messages():
-                dialog.lstMessges.setModel(dialog.create_messages_history_view(user_to))
-
-            update_messages()
+            dialog.show_history()
+            open_dialogs.add(dialog)
+            dialog.finished.connect(lambda: open_dialogs.discard(dialog))
 
             def send_message_btn_action():
                 if dialog.txtMessage.toPlainText():
                     client.send_message(user_to, dialog.txtMessage.toPlainText())
                     dialog.txtMessage.clear()
-                    update_messages()
 
             dialog.btnSend.clicked.connect(send_message_btn_action)
-            dialog.btnRefresh.clicked.connect(update_messages)
+            dialog.btnRefresh.clicked.connect(dialog.reload_history)
 
             dialog.open()
 
     main_window.lstContacts.doubleClicked.connect(messages_window)
 
+    def message_received(text):
+        logger.debug(f'Получено сообщение: {text}')
+
+    signals.message_received.connect(message_received)
+
+    def history_added(message):
+        for dialog in open_dialogs:
+            dialog.message_added(message)
+
+    signals.history_added.connect(history_added)
+
+    def connection_lost():
+        client.is_authenticate = False
+        main_window.lstContacts.setModel(main_window.set_error('Соединение с сервером разорвано'))
+
+    signals.connection_lost.connect(connection_lost)
+
     def add_contact_window():
         def add_contact(contact):
             if contact:
@@ -1,8 +1,12 @@
-from sqlalchemy.orm import declarative_base, sessionmaker
-from sqlalchemy import Column, Integer, String, DateTime, create_engine, MetaData, Table, or_, and_
+from sqlalchemy.orm import declarative_base
+from sqlalchemy import Column, Integer, String, DateTime, MetaData, Table, Index, or_, and_, case, func, desc, \
+    update, bindparam, inspect, text
+from sqlalchemy.dialects.sqlite import insert
 from datetime import datetime
 from sqlalchemy.sql import default_comparator
 
+from common.storage import create_storage_engine, create_session
+
 
 class ClientDatabaseStorage:
     Base = declarative_base()
@@ -27,21 +31,36 @@ class ClientDatabaseStorage:
         user_to = Column(String, nullable=False)
         message = Column(String)
         time_send = Column(DateTime)
+        server_id = Column(Integer)  # id сообщения в истории сервера
 
-        def __init__(self, user_from, user_to, message, time_send):
+        def __init__(self, user_from, user_to, message, time_send, server_id=None):
             self.user_from = user_from
             self.user_to = user_to
             self.message = message
             self.time_send = time_send
+            self.server_id = server_id
+
+    class SyncState(Base):
+        __tablename__ = 'sync_state'
+        user_name = Column(String, primary_key=True)
+        last_id = Column(Integer, nullable=False)  # id, до которого история синхронизирована с сервером
 
-    def __init__(self, connection_string, enable_echo=False):
-        self.db_engine = create_engine(connection_string, echo=enable_echo, connect_args={'check_same_thread': False})
+    def __init__(self, connection_string, enable_echo=False, profile=None):
+        """
+        Подключение к базе данных
+
+        :param connection_string: строка подключения
+        :param enable_echo: вывод подробной информации о взаимодействии с БД
+        :param profile: настройки SQLite (см. common.storage.SQLITE_PROFILE)
+        """
+        self.db_engine = create_storage_engine(connection_string, enable_echo, profile)
         self.metadata = MetaData()
         self.map_tables()
-        self.session = sessionmaker(bind=self.db_engine)()
+        self.session = create_session(self.db_engine)
 
-    def change_engine(self, connection_string, enable_echo):
-        self.db_engine = create_engine(connection_string, enable_echo)
+    def change_engine(self, connection_string, enable_echo, profile=None):
+        self.db_engine = create_storage_engine(connection_string, enable_echo, profile)
+        self.session = create_session(self.db_engine)
 
     def map_tables(self):
         contacts_table = Table('contacts', self.metadata,
@@ -56,9 +75,31 @@ class ClientDatabaseStorage:
                                  Column('user_to', String, nullable=False),
                                  Column('message', String),
                                  Column('time_send', DateTime),
+                                 Column('server_id', Integer),
+                                 Index('ix_messages_history_server_id', 'server_id', unique=True),
+                                 Index('ix_messages_history_conversation', 'user_from', 'user_to', 'time_send', 'id'),
                                  )
 
+        sync_state = Table('sync_state', self.metadata,
+                           Column('user_name', String, primary_key=True),
+                           Column('last_id', Integer, nullable=False),
+                           )
+
         self.metadata.create_all(self.db_engine)
+        self.upgrade_schema()
+
+    def upgrade_schema(self):
+        """
+        Обновление базы, созданной предыдущей версией клиента: добавление id сообщений сервера и индексов
+
+        :return: Не возвращает значений
+        """
+        columns = {column['name'] for column in inspect(self.db_engine).get_columns('messages_history')}
+        with self.db_engine.begin() as connection:
+            if 'server_id' not in columns:
+                connection.execute(text('ALTER TABLE messages_history ADD COLUMN server_id INTEGER'))
+            for index in self.metadata.tables['messages_history'].indexes:
+                index.create(connection, checkfirst=True)
 
     @staticmethod
     def get_time() -> datetime:
@@ -79,18 +120,131 @@ class ClientDatabaseStorage:
         for contact in contact_list:
             self.session.delete(contact)
 
-    def save_message_to_history(self, user_from, user_to, message):
+    def save_message_to_history(self, user_from, user_to, message, server_id=None):
+        """
+        Сохранение сообщения в историю. Сообщение с id сервера может одновременно сохраняться
+        при синхронизации истории в потоке интерфейса, поэтому повторная вставка пропускается
+        по уникальному индексу server_id, а не после отдельной проверки.
+
+        :return: строка истории [id, отправитель, получатель, сообщение, время] или None, если сообщение уже сохранено
+        """
         current_time = self.get_time()
-        self.session.add(self.MessagesHistory(user_from, user_to, message, current_time))
+        history = self.MessagesHistory.__table__
+        with self.db_engine.begin() as connection:
+            result = connection.execute(
+                insert(history).values(user_from=user_from, user_to=user_to, message=message,
+                                       time_send=current_time, server_id=server_id)
+                .on_conflict_do_nothing(index_elements=['server_id']))
+        if not result.rowcount:
+            return None  # Сообщение уже получено при синхронизации
+        return [result.inserted_primary_key[0], user_from, user_to, message, current_time]
+
+    def get_sync_cursors(self, user_name):
+        """
+        Состояние истории для синхронизации с сервером
+
+        :param user_name: имя пользователя
+        :return: (словарь {собеседник: наибольший id сообщения сервера}, id последней завершённой синхронизации)
+        """
+        history = self.MessagesHistory
+        contact = case((history.user_from == user_name, history.user_to), else_=history.user_from)
+        cursors = dict(self.session.query(contact, func.max(history.server_id))
+                       .filter(or_(history.user_from == user_name, history.user_to == user_name),
+                               history.server_id.isnot(None))
+                       .group_by(contact).all())
+        state = self.session.get(self.SyncState, user_name)
+        since = state.last_id if state else 0
         self.session.commit()
+        return cursors, since
+
+    def save_synced_messages(self, user_name, rows, last_id=None):
+        """
+        Сохранение сообщений, полученных при синхронизации, одной транзакцией.
+        Сообщения, отправленные с этого клиента (без id сервера), не дублируются: им назначается id сервера.
+        Сообщения, уже сохранённые потоком получения сообщений, пропускаются по уникальному индексу server_id.
+
+        :param user_name: имя пользователя
+        :param rows: список [id, отправитель, получатель, сообщение, время (unix)]
+        :param last_id: id завершённой синхронизации, None - синхронизация не завершена
+        :return: Не возвращает значений
+        """
+        history = self.MessagesHistory.__table__
+        with self.db_engine.begin() as connection:
+            if rows:
+                server_ids = [row[0] for row in rows]
+                known = {server_id for server_id, in connection.execute(
+                    history.select().with_only_columns(history.c.server_id)
+                    .where(history.c.server_id.between(min(server_ids), max(server_ids))))}
+                local = {}
+                for local_id, user_from, user_to, message in connection.execute(
+                        history.select().with_only_columns(history.c.id, history.c.user_from, history.c.user_to,
+                                                           history.c.message)
+                        .where(history.c.server_id.is_(None), history.c.user_from == user_name)
+                        .order_by(history.c.id)):
+                    local.setdefault((user_from, user_to, message), []).append(local_id)
+
+                inserts = []
+                updates = []
+                for server_id, user_from, user_to, message, time_send in rows:
+                    if server_id in known:
+                        continue
+                    local_ids = local.get((user_from, user_to, message))
+                    if local_ids:
+                        updates.append({'local_id': local_ids.pop(0), 'server_id': server_id})
+                    else:
+                        inserts.append({'server_id': server_id, 'user_from': user_from, 'user_to': user_to,
+                                        'message': message,
+                                        'time_send': datetime.fromtimestamp(time_send) if time_send else None})
+                if updates:
+                    connection.execute(update(history).prefix_with('OR IGNORE').where(history.c.id == bindparam('local_id'))
+                                       .values(server_id=bindparam('server_id')), updates)
+                if inserts:
+                    connection.execute(insert(history).on_conflict_do_nothing(index_elements=['server_id']), inserts)
+            if last_id is not None:
+                sync_state = self.SyncState.__table__
+                if connection.execute(update(sync_state).where(sync_state.c.user_name == user_name)
+                                      .values(last_id=last_id)).rowcount == 0:
+                    connection.execute(insert(sync_state).values(user_name=user_name, last_id=last_id))
 
     def get_message_history(self, user_from, user_to):
         result = self.session.query(self.MessagesHistory).filter(or_(and_(self.MessagesHistory.user_from == user_from,
                                                                  self.MessagesHistory.user_to == user_to),
                                                                      and_(self.MessagesHistory.user_from == user_to,
-                                                                 self.MessagesHistory.user_to == user_from))).all()
+                                                                 self.MessagesHistory.user_to == user_from))) \
+            .order_by(self.MessagesHistory.time_send).all()
         return [[m.user_from, m.user_to, m.message, m.time_send] for m in result]
 
+    def get_message_page(self, user_name, contact, before=None, after=None, limit=50):
+        """
+        Страница переписки двух пользователей. Пагинация по ключу (время отправки, id) без OFFSET,
+        каждое направление переписки читается по индексу ix_messages_history_conversation.
+
+        :param user_name: имя пользователя
+        :param contact: имя собеседника
+        :param before: ключ первого загруженного сообщения, страница более старых сообщений
+        :param after: ключ последнего загруженного сообщения, страница более новых сообщений
+        :param limit: количество сообщений на странице
+        :return: список [id, отправитель, получатель, сообщение, время] по возрастанию времени;
+                 без before и after - последние limit сообщений
+        """
+        history = self.MessagesHistory
+        query = self.session.query(history.id, history.user_from, history.user_to, history.message,
+                                   history.time_send) \
+            .filter(or_(and_(history.user_from == user_name, history.user_to == contact),
+                        and_(history.user_from == contact, history.user_to == user_name)))
+        if after is not None:
+            time_send, message_id = after
+            query = query.filter(or_(history.time_send > time_send,
+                                     and_(history.time_send == time_send, history.id > message_id)))
+            return [list(row) for row in query.order_by(history.time_send, history.id).limit(limit)]
+        if before is not None:
+            time_send, message_id = before
+            query = query.filter(or_(history.time_send < time_send,
+                                     and_(history.time_send == time_send, history.id < message_id)))
+        rows = [list(row) for row in query.order_by(desc(history.time_send), desc(history.id)).limit(limit)]
+        rows.reverse()
+        return rows
+
 
 if __name__ == "__main__":
     username = 'Andrei'
@@ -1,6 +1,11 @@
 # logging - стандартный модуль для организации логирования
 import logging
 
+from common.log_queue import start_queue_logging
+
+SAMPLE_RATES = {}
+"""Выборочная запись частых сообщений: {имя логгера: записывается каждое N-е сообщение}"""
+
 # Можно выполнить более расширенную настройку логирования.
 # Создаем объект-логгер:
 logger = logging.getLogger('chat.client')
@@ -17,9 +22,8 @@ stream_handler = logging.StreamHandler()
 stream_handler.setLevel(logging.CRITICAL)
 stream_handler.setFormatter(formatter)
 
-# Добавляем в логгер новый обработчик событий и устанавливаем уровень логирования
-logger.addHandler(file_handler)
-logger.addHandler(stream_handler)
+# Обработчики вызываются в отдельном потоке: логгер только ставит запись в очередь
+queue_handler, listener = start_queue_logging(logger, (file_handler, stream_handler), sample_rates=SAMPLE_RATES)
 logger.setLevel(logging.DEBUG)
 
 if __name__ == '__main__':
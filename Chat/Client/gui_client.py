@@ -1,8 +1,122 @@
 from PyQt6 import QtWidgets, uic
 import sys
 
+from PyQt6.QtCore import Qt, QAbstractListModel, QModelIndex, QObject, pyqtSignal
 from PyQt6.QtGui import QStandardItemModel, QStandardItem
 
+HISTORY_PAGE_SIZE = 50
+"""Количество сообщений, загружаемых из базы при прокрутке переписки"""
+
+HISTORY_CACHE_SIZE = 500
+"""Максимальное количество сообщений переписки в памяти окна"""
+
+
+class ClientSignals(QObject):
+    """
+    Сигналы потока receiver. Обработчики, подключённые в главном потоке, вызываются
+    в цикле событий Qt (очередное соединение), поэтому могут обновлять окна.
+    """
+    message_received = pyqtSignal(str)
+    history_added = pyqtSignal(object)
+    connection_lost = pyqtSignal()
+
+
+class MessagesHistoryModel(QAbstractListModel):
+    """
+    Переписка с собеседником. В памяти хранится не больше cache_size сообщений: страницы более старых
+    сообщений читаются из базы при прокрутке вверх (fetch_older), более новых - при прокрутке вниз (fetchMore),
+    сообщения, вышедшие за размер кэша, удаляются с противоположного края. Новые сообщения добавляются
+    в конец без чтения базы.
+    """
+    def __init__(self, database, user_name, contact, page_size=HISTORY_PAGE_SIZE, cache_size=HISTORY_CACHE_SIZE,
+                 parent=None):
+        super().__init__(parent)
+        self.database = database
+        self.user_name = user_name
+        self.contact = contact
+        self.page_size = page_size
+        self.cache_size = cache_size
+        self.messages = []
+        self.older = False
+        self.newer = False
+
+    @staticmethod
+    def key(message):
+        return message[4], message[0]
+
+    def reload(self):
+        """Загрузка последней страницы переписки"""
+        self.beginResetModel()
+        self.messages = self.database.get_message_page(self.user_name, self.contact, limit=self.page_size)
+        self.older = len(self.messages) == self.page_size
+        self.newer = False
+        self.endResetModel()
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.messages)
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if role == Qt.ItemDataRole.DisplayRole and index.isValid():
+            _, user_from, _, message, time_send = self.messages[index.row()]
+            time_send = time_send.strftime("%Y-%m-%d %H:%M:%S") if time_send else ''
+            return f'<{time_send}> {user_from}: {message}'
+        return None
+
+    def fetch_older(self):
+        """
+        Загрузка предыдущей страницы переписки в начало списка
+
+        :return: количество загруженных сообщений
+        """
+        if not self.older:
+            return 0
+        before = self.key(self.messages[0]) if self.messages else None
+        page = self.database.get_message_page(self.user_name, self.contact, before=before, limit=self.page_size)
+        self.older = len(page) == self.page_size
+        if page:
+            self.beginInsertRows(QModelIndex(), 0, len(page) - 1)
+            self.messages[:0] = page
+            self.endInsertRows()
+            if len(self.messages) > self.cache_size:
+                self.beginRemoveRows(QModelIndex(), self.cache_size, len(self.messages) - 1)
+                del self.messages[self.cache_size:]
+                self.endRemoveRows()
+                self.newer = True
+        return len(page)
+
+    def canFetchMore(self, parent=QModelIndex()):
+        return not parent.isValid() and self.newer
+
+    def fetchMore(self, parent=QModelIndex()):
+        after = self.key(self.messages[-1]) if self.messages else None
+        page = self.database.get_message_page(self.user_name, self.contact, after=after, limit=self.page_size)
+        self.newer = len(page) == self.page_size
+        self.append(page)
+
+    def message_added(self, message):
+        """
+        Новое сообщение переписки: добавляется в конец, если загружены последние сообщения
+
+        :param message: строка истории [id, отправитель, получатель, сообщение, время]
+        """
+        if self.newer or {message[1], message[2]} != {self.user_name, self.contact}:
+            return
+        self.append([message])
+
+    def append(self, messages):
+        if not messages:
+            return
+        first = len(self.messages)
+        self.beginInsertRows(QModelIndex(), first, first + len(messages) - 1)
+        self.messages.extend(messages)
+        self.endInsertRows()
+        excess = len(self.messages) - self.cache_size
+        if excess > 0:
+            self.beginRemoveRows(QModelIndex(), 0, excess - 1)
+            del self.messages[:excess]
+            self.endRemoveRows()
+            self.older = True
+
 
 class ClientWindow(QtWidgets.QMainWindow):
     def __init__(self, username='', addr='', port='', parent=None):
@@ -41,6 +155,7 @@ class ChatDialogWindow(QtWidgets.QDialog):
         QtWidgets.QWidget.__init__(self, parent)
         self.username = parent.username
         self.contact = contact
+        self.history_model = None
         self.init_ui()
 
     def init_ui(self):
@@ -48,12 +163,37 @@ class ChatDialogWindow(QtWidgets.QDialog):
         self.edtUserName.insert(self.contact)
         self.setWindowTitle(f'Чат с {self.contact}')
 
-    def create_messages_history_view(self, user_to):
-        messages = self.parent().database.get_message_history(self.username, user_to)
-        messages_view = QStandardItemModel()
-        for message in messages:
-            messages_view.appendRow(QStandardItem(f'<{message[3].strftime("%Y-%m-%d %H:%M:%S")}> {message[0]}: {message[2]}'))
-        return messages_view
+    def show_history(self):
+        """Подключение списка сообщений к модели переписки, загрузка последних сообщений"""
+        self.history_model = MessagesHistoryModel(self.parent().database, self.username, self.contact, parent=self)
+        self.lstMessges.setUniformItemSizes(True)
+        self.lstMessges.setModel(self.history_model)
+        self.lstMessges.verticalScrollBar().valueChanged.connect(self.history_scrolled)
+        self.reload_history()
+
+    def reload_history(self):
+        self.history_model.reload()
+        self.lstMessges.scrollToBottom()
+
+    def history_scrolled(self, value):
+        # Прокрутка до начала списка загружает предыдущую страницу, видимые сообщения остаются на месте
+        if value == self.lstMessges.verticalScrollBar().minimum() and self.history_model.older:
+            loaded = self.history_model.fetch_older()
+            if loaded:
+                self.lstMessges.scrollTo(self.history_model.index(loaded),
+                                         QtWidgets.QAbstractItemView.ScrollHint.PositionAtTop)
+
+    def message_added(self, message):
+        """
+        Новое сообщение: список прокручивается к нему, если был прокручен до конца
+
+        :param message: строка истории [id, отправитель, получатель, сообщение, время]
+        """
+        scroll_bar = self.lstMessges.verticalScrollBar()
+        at_bottom = scroll_bar.value() == scroll_bar.maximum()
+        self.history_model.message_added(message)
+        if at_bottom:
+            self.lstMessges.scrollToBottom()
 
 
 class AddContactDialogWindow(QtWidgets.QDialog):
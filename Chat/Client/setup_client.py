@@ -2,7 +2,8 @@ import sys
 from cx_Freeze import setup, Executable
 
 build_exe_options = {
-    "packages": ['gui'],
+    "packages": ['gui', 'common'],
+    "path": sys.path + ['..'],
     "include_files": ['gui/'],
 }
 setup(
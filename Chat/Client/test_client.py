@@ -4,7 +4,15 @@ import sys
 import json
 from datetime import datetime, timezone
 import calendar
-from socket import socket, AF_INET, SOCK_STREAM
+import time
+import os
+import tempfile
+from threading import Thread
+from socket import socket, socketpair, AF_INET, SOCK_STREAM
+
+from common.codec import decode_message
+from common.framing import FrameBuffer, encode_frame
+from gui_client import MessagesHistoryModel
 
 
 class TestGetArguments(unittest.TestCase):
@@ -71,6 +79,186 @@ class TestGetSocket(unittest.TestCase):
         self.assertEqual(r.type, SOCK_STREAM)
 
 
+class TestClientDatabase(unittest.TestCase):
+    def setUp(self):
+        self.database = client.ClientDatabaseStorage('sqlite://')
+
+    def testSyncedMessages(self):
+        # Отправленное с клиента сообщение получает id сервера, повторно полученное - не дублируется
+        self.database.save_message_to_history('Andrei', 'Sergei', 'Привет')
+        now = int(time.time())
+        rows = [[5, 'Andrei', 'Sergei', 'Привет', now],
+                [6, 'Sergei', 'Andrei', 'Привет!', now + 1],
+                [7, 'Vadim', 'Andrei', 'Как дела?', now + 2]]
+        self.database.save_synced_messages('Andrei', rows[:2])
+        self.database.save_synced_messages('Andrei', rows, 7)
+        self.database.save_message_to_history('Vadim', 'Andrei', 'Как дела?', 7)
+
+        self.assertEqual([m[2] for m in self.database.get_message_history('Andrei', 'Sergei')], ['Привет', 'Привет!'])
+        self.assertEqual(len(self.database.get_message_history('Andrei', 'Vadim')), 1)
+        self.assertEqual(self.database.get_sync_cursors('Andrei'), ({'Sergei': 6, 'Vadim': 7}, 7))
+
+    def testConcurrentSave(self):
+        # Поток получения сообщений и синхронизация истории сохраняют одни и те же сообщения одновременно
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        database = client.ClientDatabaseStorage(f'sqlite:///{os.path.join(directory.name, "client.sqlite3")}')
+        self.addCleanup(database.db_engine.dispose)
+        now = int(time.time())
+        rows = [[i, 'Sergei', 'Andrei', str(i), now] for i in range(1, 301)]
+        errors = []
+
+        def receive():
+            try:
+                for server_id, user_from, user_to, message, _ in rows:
+                    database.save_message_to_history(user_from, user_to, message, server_id)
+            except Exception as e:
+                errors.append(e)
+
+        def sync():
+            try:
+                for start in range(0, len(rows), 50):
+                    database.save_synced_messages('Andrei', rows[start:start + 50])
+            except Exception as e:
+                errors.append(e)
+
+        threads = [Thread(target=receive), Thread(target=sync)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(len(database.get_message_history('Andrei', 'Sergei')), 300)
+        self.assertIsNone(database.save_message_to_history('Sergei', 'Andrei', '1', 1))
+
+    def testMessagePages(self):
+        for i in range(10):
+            self.database.save_message_to_history('Andrei' if i % 2 else 'Sergei', 'Sergei' if i % 2 else 'Andrei', str(i))
+        self.database.save_message_to_history('Andrei', 'Vadim', 'Привет')
+
+        last = self.database.get_message_page('Andrei', 'Sergei', limit=4)
+        self.assertEqual([m[3] for m in last], ['6', '7', '8', '9'])
+        older = self.database.get_message_page('Andrei', 'Sergei', before=(last[0][4], last[0][0]), limit=4)
+        self.assertEqual([m[3] for m in older], ['2', '3', '4', '5'])
+        newer = self.database.get_message_page('Andrei', 'Sergei', after=(older[-1][4], older[-1][0]), limit=2)
+        self.assertEqual([m[3] for m in newer], ['6', '7'])
+
+    def testMessagesHistoryModel(self):
+        # В памяти окна не больше cache_size сообщений, новые сообщения добавляются без чтения базы
+        for i in range(10):
+            self.database.save_message_to_history('Andrei', 'Sergei', str(i))
+        model = MessagesHistoryModel(self.database, 'Andrei', 'Sergei', page_size=4, cache_size=6)
+        model.reload()
+        self.assertEqual([m[3] for m in model.messages], ['6', '7', '8', '9'])
+        self.assertEqual(model.fetch_older(), 4)
+        self.assertEqual([m[3] for m in model.messages], ['2', '3', '4', '5', '6', '7'])
+        self.assertTrue(model.canFetchMore())
+
+        model.message_added(self.database.save_message_to_history('Sergei', 'Andrei', '10'))
+        self.assertEqual(model.rowCount(), 6)
+        while model.canFetchMore():
+            model.fetchMore()
+        self.assertEqual([m[3] for m in model.messages], ['5', '6', '7', '8', '9', '10'])
+        model.message_added(self.database.save_message_to_history('Andrei', 'Sergei', '11'))
+        model.message_added(self.database.save_message_to_history('Andrei', 'Vadim', 'Привет'))
+        self.assertEqual([m[3] for m in model.messages], ['6', '7', '8', '9', '10', '11'])
+        self.assertTrue(model.older)
+
+
+class TestRequests(unittest.TestCase):
+    def setUp(self):
+        self.client = client.MessangerClient('Andrei', '123', database=client.ClientDatabaseStorage('sqlite://'))
+        self.client.socket, self.server = socketpair()
+        self.client.socket.settimeout(1)
+        self.server.settimeout(5)
+        self.messages = []
+        self.client.message_handler = self.messages.append
+
+    def tearDown(self):
+        self.client.stop()
+        self.server.close()
+        self.client.socket.close()
+
+    def read_requests(self, count):
+        buffer = FrameBuffer()
+        frames = []
+        while len(frames) < count:
+            frames.extend(buffer.feed(self.server.recv(1024)))
+        return [decode_message(f) for f in frames]
+
+    def reply(self, *messages):
+        self.server.sendall(b''.join(encode_frame(json.dumps(m).encode('utf-8')) for m in messages))
+
+    def testPipelinedRequests(self):
+        # Запросы отправляются без ожидания ответа, ответы в любом порядке передаются своим запросам
+        contacts = self.client.request(self.client.create_get_contacts_message())
+        presence = self.client.request(self.client.create_presence_message())
+        self.assertEqual([r['request_id'] for r in self.read_requests(2)], [1, 2])
+        self.reply({"response": 201, "alert": 'Ok', "request_id": 2},
+                   {"action": "msg", "to": 'Andrei', "from": 'Sergei', "message": 'Привет'},
+                   {"response": 202, "alert": ['Sergei'], "request_id": 1})
+
+        self.assertEqual(self.client.wait_response(contacts)['alert'], ['Sergei'])
+        self.assertEqual(presence.result(0)['response'], 201)
+        self.assertEqual(self.messages, ['Sergei: Привет'])
+        self.assertEqual(self.client.pending_requests, {})
+
+    def testReaderThread(self):
+        self.client.client_is_active = True
+        self.client.reader_thread = Thread(target=self.client.receiver, daemon=True)
+        self.client.reader_thread.start()
+
+        history = self.client.request(self.client.create_sync_history_message({}, 0), stream=True)
+        request_id = self.read_requests(1)[0]['request_id']
+        self.reply({"action": "sync_history", "alert": [[1, 'Sergei', 'Andrei', 'Привет', 0]], "done": False,
+                    "request_id": request_id},
+                   {"action": "sync_history", "alert": [], "done": True, "more": False, "cursor": 1,
+                    "request_id": request_id})
+        self.assertEqual([len(frame['alert']) for frame in self.client.wait_response(history)], [1, 0])
+
+        # При разрыве соединения ожидающие запросы завершаются ошибкой
+        contacts = self.client.request(self.client.create_get_contacts_message())
+        self.server.close()
+        with self.assertRaises(ConnectionError):
+            self.client.wait_response(contacts)
+
+    def testRequestTimeout(self):
+        # Запрос без ответа удаляется из ожидающих, опоздавший ответ передаётся как сообщение сервера
+        self.client.client_is_active = True
+        self.client.reader_thread = Thread(target=self.client.receiver, daemon=True)
+        self.client.reader_thread.start()
+        self.client.request_timeout = 0.05
+        contacts = self.client.request(self.client.create_get_contacts_message())
+        request_id = self.read_requests(1)[0]['request_id']
+        with self.assertRaises(TimeoutError):
+            self.client.wait_response(contacts)
+        self.assertEqual(self.client.pending_requests, {})
+
+        self.reply({"response": 202, "alert": ['Sergei'], "request_id": request_id})
+        presence = self.client.request(self.client.create_presence_message())
+        self.reply({"response": 200, "alert": 'Ok', "request_id": self.read_requests(1)[0]['request_id']})
+        self.client.request_timeout = 5
+        self.assertEqual(self.client.wait_response(presence)['response'], 200)
+        self.assertFalse(contacts.done())
+
+    def testStop(self):
+        # Поток receiver ждёт в select без таймаута: сообщение передаётся сразу, остановка будит поток
+        self.client.client_is_active = True
+        self.client.reader_thread = Thread(target=self.client.receiver, daemon=True)
+        self.client.reader_thread.start()
+        received = time.perf_counter()
+        self.reply({"action": "msg", "to": 'Andrei', "from": 'Sergei', "message": 'Привет'})
+        while not self.messages and time.perf_counter() - received < 1:
+            time.sleep(0.001)
+        self.assertEqual(self.messages, ['Sergei: Привет'])
+
+        self.client.stop()
+        self.client.reader_thread.join(1)
+        self.assertFalse(self.client.reader_thread.is_alive())
+        self.assertTrue(self.client.stopped.is_set())
+
+
 # Запустить тестирование
 if __name__ == '__main__':
     unittest.main()
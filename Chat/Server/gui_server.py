@@ -1,44 +1,169 @@
 from PyQt6 import QtWidgets, uic
 import sys
 
-from PyQt6.QtGui import QStandardItemModel, QStandardItem
+from PyQt6.QtCore import Qt, QAbstractTableModel, QAbstractListModel, QModelIndex, QObject, pyqtSignal
+
+USERS_PAGE_SIZE = 100
+"""Количество пользователей, загружаемых из базы при прокрутке таблицы"""
+
+MESSAGES_COUNT = 20
+"""Количество последних сообщений в окне сервера"""
+
+
+class ServerSignals(QObject):
+    """
+    События сервера для окна администратора. Сервер вызывает emit в своём потоке,
+    обработчики моделей выполняются в главном потоке Qt.
+    """
+    user_saved = pyqtSignal(int, str, str)
+    message_saved = pyqtSignal(str, str, str, object)
+
+
+class UsersTableModel(QAbstractTableModel):
+    """
+    Таблица пользователей. Строки загружаются из базы страницами при прокрутке (fetchMore),
+    добавленные и изменённые пользователи обновляют только свою строку.
+    """
+    headers = ('id', 'Имя', 'Информация')
+
+    def __init__(self, page_size=USERS_PAGE_SIZE, parent=None):
+        super().__init__(parent)
+        self.page_size = page_size
+        self.database = None
+        self.users = []
+        self.rows = {}
+        self.more = False
+
+    def set_database(self, database):
+        """
+        Загрузка таблицы заново из базы
+
+        :param database: база сервера (ServerDatabaseStorage)
+        """
+        self.beginResetModel()
+        self.database = database
+        self.users = []
+        self.rows = {}
+        self.more = database is not None
+        self.endResetModel()
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.users)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.headers)
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if role == Qt.ItemDataRole.DisplayRole and index.isValid():
+            return str(self.users[index.row()][index.column()])
+        return None
+
+    def headerData(self, section, orientation, role=Qt.ItemDataRole.DisplayRole):
+        if role == Qt.ItemDataRole.DisplayRole and orientation == Qt.Orientation.Horizontal:
+            return self.headers[section]
+        return None
+
+    def canFetchMore(self, parent=QModelIndex()):
+        return not parent.isValid() and self.more
+
+    def fetchMore(self, parent=QModelIndex()):
+        after_id = self.users[-1][0] if self.users else 0
+        page = [user for user in self.database.get_users_page(after_id, self.page_size) if user[0] not in self.rows]
+        self.more = len(page) == self.page_size
+        if page:
+            self.add_rows(page)
+
+    def add_rows(self, users):
+        first = len(self.users)
+        self.beginInsertRows(QModelIndex(), first, first + len(users) - 1)
+        for row, user in enumerate(users, first):
+            self.rows[user[0]] = row
+            self.users.append(tuple(user))
+        self.endInsertRows()
+
+    def user_saved(self, user_id, name, information):
+        """
+        Пользователь добавлен или изменён: обновляется его строка. Новый пользователь
+        добавляется в конец таблицы, если она загружена полностью, иначе он будет прочитан fetchMore.
+        """
+        row = self.rows.get(user_id)
+        if row is not None:
+            self.users[row] = (user_id, name, information)
+            self.dataChanged.emit(self.index(row, 0), self.index(row, len(self.headers) - 1))
+        elif self.database is not None and not self.more:
+            self.add_rows([(user_id, name, information)])
+
+
+class MessagesListModel(QAbstractListModel):
+    """Последние сообщения истории, новые сообщения добавляются в начало списка без чтения базы"""
+    def __init__(self, count=MESSAGES_COUNT, parent=None):
+        super().__init__(parent)
+        self.count = count
+        self.messages = []
+
+    def set_database(self, database):
+        """
+        Загрузка последних сообщений из базы
+
+        :param database: база сервера (ServerDatabaseStorage)
+        """
+        self.beginResetModel()
+        self.messages = database.get_messages_history(self.count) if database else []
+        self.endResetModel()
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.messages)
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if role == Qt.ItemDataRole.DisplayRole and index.isValid():
+            message = self.messages[index.row()]
+            return f'({message[3]}) {message[0]} -> {message[1]}: {message[2]}'
+        return None
+
+    def message_saved(self, user_from, user_to, message, time_send):
+        self.beginInsertRows(QModelIndex(), 0, 0)
+        self.messages.insert(0, (user_from, user_to, message, time_send))
+        self.endInsertRows()
+        if len(self.messages) > self.count:
+            self.beginRemoveRows(QModelIndex(), self.count, len(self.messages) - 1)
+            del self.messages[self.count:]
+            self.endRemoveRows()
 
 
 class ServerWindow(QtWidgets.QMainWindow):
     def __init__(self, parent=None):
         QtWidgets.QWidget.__init__(self, parent)
+        self.users_model = UsersTableModel()
+        self.messages_model = MessagesListModel()
         self.init_ui()
         self.database = None
 
     def init_ui(self):
         uic.loadUi('gui_main_server.ui', self)
         self.btnExit.clicked.connect(self.close)
+        self.tblUsers.setModel(self.users_model)
+        self.lstMessages.setModel(self.messages_model)
+        self.lblMetrics = QtWidgets.QLabel()
+        self.statusbar.addPermanentWidget(self.lblMetrics, 1)
+
+    def set_database(self, database):
+        """
+        Подключение окна к базе сервера: таблицы загружаются заново
+
+        :param database: база сервера (ServerDatabaseStorage)
+        """
+        self.database = database
+        self.users_model.set_database(database)
+        self.messages_model.set_database(database)
+        self.tblUsers.resizeColumnsToContents()
+
+    def show_metrics(self, summary):
+        """
+        Сводка метрик сервера в строке состояния
 
-    def create_users_list_view(self):
-        list_view = QStandardItemModel()
-        list_view.setHorizontalHeaderLabels(['id', 'Имя', 'Информация'])
-        if self.database:
-            list_users = self.database.get_all_users()
-            for user in list_users:
-                id_ = user.id
-                name = user.name
-                information = user.information
-                id_ = QStandardItem(str(id_))
-                id_.setEditable(False)
-                name = QStandardItem(name)
-                name.setEditable(False)
-                information = QStandardItem(information)
-                information.setEditable(False)
-                list_view.appendRow([id_, name, information])
-        return list_view
-
-    def create_messages_history_view(self, database, count=20):
-        if self.database:
-            messages = database.get_messages_history(count)
-            messages_view = QStandardItemModel()
-            for message in messages:
-                messages_view.appendRow(QStandardItem(f'({message[3]}) {message[0]} -> {message[1]}: {message[2]}'))
-            return messages_view
+        :param summary: словарь {название: значение}
+        """
+        self.lblMetrics.setText('  |  '.join(f'{name}: {value}' for name, value in summary.items()))
 
 
 class AddUserDialogWindow(QtWidgets.QDialog):
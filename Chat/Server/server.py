@@ -2,43 +2,89 @@ import argparse
 import calendar
 import dis
 import hashlib
-import inspect
-import select
+import os
 # import socket
 import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 from socket import *
-import json
 from datetime import datetime, timezone
 import sys
 import logging
-from functools import wraps
 
 from PyQt6 import QtWidgets
 from PyQt6.QtCore import QTimer
 
+path = os.path.abspath(os.path.join(".."))
+sys.path.append(path)
+
+from common.codec import ACTIONS, CODECS, JSON_CODEC, decode_message
+from common.compression import COMPRESSIONS, COMPRESSION_THRESHOLD, Compressor
+from common.framing import FRAME_HEADER, encode_frame
+from common.metrics import MetricsRegistry, render, start_http_server
+from common.tracing import TRACING_METRICS, trace
 from server_database import ServerDatabaseStorage
-from gui_server import ServerWindow, AddUserDialogWindow
+from server_delivery import PendingDelivery
+from server_sessions import SessionRegistry
+from server_async import AsyncServerEngine
+from server_selector import SelectorServerEngine
+from gui_server import ServerWindow, AddUserDialogWindow, ServerSignals
 
 import server_log_config
 
 logger = logging.getLogger('chat.server')
+message_logger = logging.getLogger('chat.server.messages')  # Содержимое запросов, можно записывать выборочно
+
+SERVER_MODES = ('threaded', 'asyncio')
+"""Доступные режимы работы сервера"""
+
+LISTEN_BACKLOG = 1024
+"""Размер очереди входящих подключений"""
+
+WRITE_HIGH_WATER = 1024 * 1024
+"""Максимальный объём неотправленных данных одного подключения по умолчанию (байт)"""
+
+PRIORITY_NORMAL = 0
+"""Ответы сервера и личные сообщения: при переполнении очереди клиент отключается"""
+
+PRIORITY_LOW = 1
+"""Сообщения для all: при переполнении очереди сообщение клиенту не отправляется"""
+
+AUTH_WORKERS = 4
+"""Количество потоков для вычисления хэшей паролей по умолчанию. 0 - вычисление в потоке сервера"""
+
+AUTH_QUEUE_LIMIT = 1000
+"""Максимальное количество одновременно проверяемых паролей по умолчанию"""
+
+FANOUT_BUCKETS = (0, 1, 2, 5, 10, 50, 100, 500, 1000, 5000, 10000)
+"""Границы интервалов гистограммы количества получателей сообщения"""
 
+HISTORY_PAGE_SIZE = 50
+"""Количество сообщений истории в ответе get_history по умолчанию"""
 
-def log():
+HISTORY_PAGE_LIMIT = 1000
+"""Максимальное количество сообщений истории в одном ответе get_history"""
+
+HISTORY_CHUNK_SIZE = 100
+"""Количество сообщений истории в одном кадре ответа"""
+
+HISTORY_SYNC_WORKERS = 2
+"""Количество потоков для чтения истории по запросам sync_history"""
+
+METRICS_ADDR = '127.0.0.1'
+"""Адрес HTTP-сервера метрик: метрики доступны только локально"""
+
+
+def log(timed=False):
     """
-    Декоратор для логирования запуска функций
+    Декоратор для логирования запуска функций (см. common.tracing.trace).
+    Если уровень логгера выше DEBUG, вызов функции не записывается.
 
-    :return:
+    :param timed: записывать время выполнения в гистограмму chat_function_duration_seconds
+    :return: декоратор
     """
-    def decorator(func):
-        @wraps(func)
-        def decorated(*args, **kwargs):
-            logger.debug(f' Функция {func.__name__} вызвана из функции {inspect.stack()[1].function}')
-            res = func(*args, **kwargs)
-            return res
-        return decorated
-    return decorator
+    return trace(logger, timed)
 
 
 class Port:
@@ -61,15 +107,19 @@ def get_arguments():
     """
     Парсинг параметров строки запуска
 
-    :return: адрес, порт
+    :return: адрес, порт, режим работы сервера, порт метрик
     """
     logger.debug('Получаем аргументы')
     parser = argparse.ArgumentParser()
     parser.add_argument('-p', dest='port', type=int, help='Port of server run. Default 7777')
     parser.add_argument('-a', dest='addr', type=str, help='PIP-address listen to. Default ALL')
+    parser.add_argument('-e', dest='mode', type=str, choices=SERVER_MODES, default='threaded',
+                        help='Server engine: threaded or asyncio. Default threaded')
+    parser.add_argument('-m', dest='metrics_port', type=int,
+                        help=f'Port of Prometheus metrics endpoint on {METRICS_ADDR}. Default disabled')
     args = parser.parse_args()
-    logger.debug(f'address = {args.addr}, port = {args.port}')
-    return args.addr, args.port
+    logger.debug(f'address = {args.addr}, port = {args.port}, mode = {args.mode}, metrics port = {args.metrics_port}')
+    return args.addr, args.port, args.mode, args.metrics_port
 
 
 @log()
@@ -96,10 +146,7 @@ def login_required(func):
     :return: проверяемая функция
     """
     def check_action(*args, **kwargs):
-        check_result = False
-        for client in args[0].active_users:
-            if args[0].active_users[client] == args[2]:
-                check_result = True
+        check_result = args[0].sessions.is_authenticated(args[2])
 
         if not check_result:
             data = args[1]
@@ -146,19 +193,77 @@ class ServerClient(threading.Thread, metaclass=ServerVerifier):
     port = Port()
     """Переменная порта сервера"""
 
-    def __init__(self, addr, port):
+    def __init__(self, addr, port, mode='threaded'):
         """
         Инициализация экземпляра класса Сервера
 
         :param addr: адрес сервера
         :param port: порт сервера
+        :param mode: режим работы сервера: threaded (цикл selectors в отдельном потоке) или asyncio
         """
+        if mode not in SERVER_MODES:
+            raise ValueError(f'Неизвестный режим работы сервера {mode}. Допустимые значения: {", ".join(SERVER_MODES)}')
         self.addr = addr or ''
         self.port = port or 7777
+        self.mode = mode
+        self.engine = None
         self.database = None  #
         self.server_is_active = False
         self.socket = None
-        self.active_users = {}
+        self.sessions = SessionRegistry()
+        self.write_high_water = WRITE_HIGH_WATER
+        self.auth_workers = AUTH_WORKERS
+        self.auth_queue_limit = AUTH_QUEUE_LIMIT
+        self.compression_threshold = COMPRESSION_THRESHOLD
+        self.auth_pool = None
+        self.auth_queue_length = 0
+        self.history_pool = None
+        self.metrics = MetricsRegistry()
+        self.metrics_port = None
+        self.metrics_http = None
+        self.action_metrics = {}
+        self.connections_opened = self.metrics.counter('chat_connections_total', 'Принятые подключения')
+        self.metrics.gauge('chat_connections', 'Открытые подключения',
+                           function=lambda: len(self.engine.connections) if self.engine else 0)
+        self.history_write_time = self.metrics.histogram('chat_history_write_seconds',
+                                                         'Время записи пакета истории в базу')
+        self.message_fanout = self.metrics.histogram('chat_message_fanout', 'Количество получателей сообщения',
+                                                     buckets=FANOUT_BUCKETS)
+        self.messages_dropped = self.metrics.counter('chat_messages_dropped_total',
+                                                     'Сообщения, не отправленные из-за переполнения очереди')
+        self.slow_consumers_evicted = self.metrics.counter('chat_slow_consumers_evicted_total',
+                                                           'Клиенты, отключённые из-за переполнения очереди')
+        self.metrics.gauge('chat_write_queue_bytes', 'Неотправленные данные всех подключений',
+                           function=lambda: sum(self.get_queue_depths().values()))
+        self.metrics.gauge('chat_write_queue_bytes_max', 'Наибольший объём неотправленных данных подключения',
+                           function=lambda: max(self.get_queue_depths().values(), default=0))
+        self.metrics.gauge('chat_active_users', 'Пользователи в сети', function=lambda: len(self.sessions.by_user))
+        self.metrics.gauge('chat_sessions', 'Сессии авторизованных пользователей', function=lambda: len(self.sessions))
+        self.auth_failures = self.metrics.counter('chat_auth_failures_total', 'Неудачные попытки аутентификации')
+        self.auth_rejected = self.metrics.counter('chat_auth_rejected_total',
+                                                  'Запросы аутентификации, отклонённые из-за переполнения очереди')
+        self.metrics.gauge('chat_auth_pool_size', 'Количество потоков проверки паролей',
+                           function=lambda: self.auth_workers)
+        self.metrics.gauge('chat_auth_queue_length', 'Пароли в очереди на проверку',
+                           function=lambda: self.auth_queue_length)
+        self.metrics.gauge('chat_history_queue_length', 'Сообщения в очереди на запись в историю',
+                           function=lambda: self.database.history_queue_length() if self.database else 0)
+        self.metrics.counter('chat_user_cache_hits_total', 'Обращения к кэшу пользователей без запроса к базе',
+                             function=lambda: self.database.user_cache.hits if self.database else 0)
+        self.metrics.counter('chat_user_cache_misses_total', 'Обращения к кэшу пользователей с запросом к базе',
+                             function=lambda: self.database.user_cache.misses if self.database else 0)
+        self.metrics.gauge('chat_user_cache_size', 'Пользователи в кэше',
+                           function=lambda: len(self.database.user_cache) if self.database else 0)
+        self.bytes_sent = self.metrics.counter('chat_bytes_sent_total', 'Отправленные данные (после сжатия)')
+        self.bytes_sent_uncompressed = self.metrics.counter('chat_bytes_sent_uncompressed_total',
+                                                            'Отправленные данные до сжатия')
+        self.bytes_received = self.metrics.counter('chat_bytes_received_total', 'Полученные данные (сжатые)')
+        self.bytes_received_uncompressed = self.metrics.counter('chat_bytes_received_uncompressed_total',
+                                                                'Полученные данные после распаковки')
+        self.metrics.gauge('chat_log_records_dropped', 'Записи журнала, отброшенные при заполненной очереди',
+                           function=lambda: server_log_config.queue_handler.dropped)
+        self.pending = PendingDelivery(self)
+        self.subscribers = {}
         super().__init__()
 
     def set_database(self, connection_string, echo=False):
@@ -181,22 +286,72 @@ class ServerClient(threading.Thread, metaclass=ServerVerifier):
         :return: Объект пользователя
         """
         password_hash = get_password_hash(password)
-        return self.database.add_user(user_name, password_hash, information)
+        user = self.database.add_user(user_name, password_hash, information)
+        self.emit('user_saved', user.id, user.name, user.information or '')
+        return user
 
-    def authenticate_user(self, user_name, password):
+    def subscribe(self, event, handler):
+        """
+        Подписка на события сервера:
+        user_saved(id, имя, информация) - пользователь добавлен или изменён,
+        message_saved(отправитель, получатель, сообщение, время) - сообщение сохранено в историю.
+        Обработчики вызываются в потоке, где произошло событие (обычно в потоке сервера).
+
+        :param event: имя события
+        :param handler: функция обработки
+        :return: Не возвращает значений
+        """
+        self.subscribers.setdefault(event, []).append(handler)
+
+    def emit(self, event, *args):
+        """
+        Вызов обработчиков события. Ошибка обработчика не прерывает работу сервера.
+
+        :param event: имя события
+        :param args: параметры события
+        :return: Не возвращает значений
+        """
+        for handler in self.subscribers.get(event, ()):
+            try:
+                handler(*args)
+            except Exception as err:
+                logger.error(f'Ошибка обработчика события {event}: {err}')
+
+    def authenticate_user(self, user_name, password, password_hash=None):
         """
         Проверка логина и пароля пользователя
 
         :param user_name: Имя пользователя
         :param password: Пароль
+        :param password_hash: Хэш пароля, если уже вычислен
         :return: Результат проверки (boolean)
         """
-        password_hash = get_password_hash(password)
-        print(password, password_hash)
+        if password_hash is None:
+            password_hash = get_password_hash(password)
         if self.database.get_user_and_password(user_name, password_hash):
             return True
         return False
 
+    def login(self, client_data, sock, password_hash=None):
+        """
+        Аутентификация подключения
+
+        :param client_data: данные authenticate сообщения (dict)
+        :param sock: подключение клиента
+        :param password_hash: Хэш пароля, если уже вычислен
+        :return: (код ответа, описание)
+        """
+        user_name = client_data['user']['account_name']
+        if self.authenticate_user(user_name, client_data['user']['password'], password_hash):
+            self.sessions.add(user_name, sock)
+            sock.user_name = user_name
+            # Недоставленные сообщения отправляются после ответа на аутентификацию
+            self.engine.call_soon_threadsafe(self.pending.start, sock)
+            return 200, 'Ok'
+        self.remove_from_active(sock)
+        self.auth_failures.inc()
+        return 402, "Пользователь не авторизован"
+
     # @log()
     def get_socket(self, addr, port):
         """
@@ -209,7 +364,7 @@ class ServerClient(threading.Thread, metaclass=ServerVerifier):
         logger.debug("Создаём сокет")
         s = socket(AF_INET, SOCK_STREAM)
         s.bind((addr, int(port)))
-        s.listen(5)
+        s.listen(LISTEN_BACKLOG)
         s.settimeout(0.2)  # Таймаут для операций с сокетом
 
         return s
@@ -219,11 +374,11 @@ class ServerClient(threading.Thread, metaclass=ServerVerifier):
         """
         Конвертация сообщения клиента в словарь
 
-        :param data: Текст сообщения в формате JSON
+        :param data: Сообщение в формате JSON или в двоичном формате
         :return: Словарь Python
         """
         logger.debug("Парсим сообщение от клиента")
-        client_data = json.loads(data)
+        client_data = decode_message(data)
         return client_data
 
     # @log()
@@ -234,7 +389,7 @@ class ServerClient(threading.Thread, metaclass=ServerVerifier):
 
         :param client_data: данные от клиента (dict)
         :param sock: экземпляр сокета клиента
-        :return: (ответ сервера, пересылаемое сообщение)
+        :return: (ответ сервера (dict), пересылаемое сообщение)
         """
         logger.debug("Формируем ответ клиенту")
         action = client_data['action']
@@ -243,6 +398,7 @@ class ServerClient(threading.Thread, metaclass=ServerVerifier):
         alert = 'Неправильный запрос'
 
         message_to_send = {}
+        options = None
 
         if action == 'presence':
             print(type(client_data), client_data)
@@ -253,9 +409,11 @@ class ServerClient(threading.Thread, metaclass=ServerVerifier):
             else:
                 code = 200
             alert = 'Ok'
+            options = self.negotiate_options(sock, client_data)
         elif action == 'msg':
             code = 200
             alert = 'Ok'
+            client_data.pop('request_id', None)  # Получателям не передаётся
             message_to_send = client_data
         elif action == 'get_contacts':
             code = 202
@@ -268,98 +426,455 @@ class ServerClient(threading.Thread, metaclass=ServerVerifier):
             self.database.remove_contact(client_data['user_id'], client_data['user_login'])
             code = 202
             alert = "Ok"
+        elif action == 'get_history':
+            self.send_history(sock, client_data)
+            return {}, {}
+        elif action == 'sync_history':
+            self.send_history_delta(sock, client_data)
+            return {}, {}
+        elif action == 'ack':
+            self.pending.ack(sock.user_name, client_data.get('ids') or [])
+            return {}, {}
         elif action == 'authenticate':
-            user_name = client_data['user']['account_name']
-            if self.authenticate_user(user_name, client_data['user']['password']):
-                code = 200
-                self.active_users[user_name] = sock
-                print(type(sock), sock)
-            else:
-                self.active_users.pop(user_name, None)
-                code = 402
-                alert = "Пользователь не авторизован"
+            code, alert = self.login(client_data, sock)
+            if code == 200:
+                options = self.negotiate_options(sock, client_data)
 
+        return (self.create_response(code, alert, options) if len(message_to_send) == 0 else {}), message_to_send
+
+    @staticmethod
+    def create_response(code, alert, options=None):
+        """
+        Создание ответа сервера
+
+        :param code: код ответа
+        :param alert: описание
+        :param options: параметры подключения, согласованные с клиентом (codec, compression)
+        :return: Ответ (dict)
+        """
         response = {
             "response": code,
             "time": calendar.timegm(datetime.now(timezone.utc).utctimetuple()),
             "alert": alert,
         }
+        if options:
+            response.update(options)
+        return response
 
-        return (json.dumps(response) if len(message_to_send) == 0 else ''), message_to_send
+    @staticmethod
+    def correlation(client_data):
+        """
+        Поле request_id запроса. Клиент передаёт его в запросах, на которые ждёт ответ, сервер возвращает
+        его в каждом кадре ответа, поэтому клиент может отправить несколько запросов, не дожидаясь ответов.
 
-    # @log()
-    def write_responses(self, requests, w_clients, all_clients):
+        :param client_data: данные запроса
+        :return: dict для добавления в ответ
+        """
+        return {'request_id': client_data['request_id']} if 'request_id' in client_data else {}
+
+    def negotiate_options(self, conn, client_data):
+        """
+        Выбор формата сообщений и сжатия подключения по полям codec и compression сообщения presence
+        или authenticate. Ответ на это сообщение и все следующие сообщения сервера передаются в выбранном
+        формате, неизвестный формат заменяется на JSON, неизвестный способ сжатия - на отправку без сжатия.
+        Сообщения клиента разбираются в любом формате, сжатые кадры распаковываются всегда.
+
+        :param conn: подключение клиента
+        :param client_data: данные запроса
+        :return: выбранные параметры (dict) для ответа, только те, которые указал клиент
+        """
+        options = {}
+        if 'codec' in client_data:
+            conn.codec = CODECS.get(client_data['codec'], JSON_CODEC)
+            options['codec'] = conn.codec.name
+        if 'compression' in client_data:
+            name = client_data['compression']
+            conn.compression = Compressor(name, self.compression_threshold) if name in COMPRESSIONS else None
+            options['compression'] = conn.compression.name if conn.compression else None
+        return options
+
+    @staticmethod
+    def encode_message(conn, message):
+        """
+        Кадр сообщения в формате и со сжатием подключения
+
+        :param conn: подключение клиента
+        :param message: сообщение (dict)
+        :return: (кадр, размер кадра без сжатия)
+        """
+        payload = conn.codec.encode(message)
+        if conn.compression:
+            return encode_frame(*conn.compression.compress(payload)), FRAME_HEADER.size + len(payload)
+        return encode_frame(payload), FRAME_HEADER.size + len(payload)
+
+    def send_to(self, conn, message, priority=PRIORITY_NORMAL):
+        """
+        Отправка сообщения одному подключению
+
+        :param conn: подключение получателя
+        :param message: сообщение (dict)
+        :param priority: PRIORITY_NORMAL или PRIORITY_LOW
+        :return: True, если кадр поставлен в очередь
         """
-        Отправка ответов сервера
+        frame, size = self.encode_message(conn, message)
+        return self.deliver(conn, frame, priority, size)
 
-        :param requests: запросы (dict)
-        :param w_clients: список клиентов на чтение
-        :param all_clients: список всех подключенных клиентов
+    @staticmethod
+    def get_history_limit(client_data):
+        """
+        Количество сообщений в ответе на запрос истории
+
+        :param client_data: данные запроса, необязательное поле limit
+        :return: количество сообщений от 1 до HISTORY_PAGE_LIMIT
+        """
+        return min(max(int(client_data.get('limit') or HISTORY_PAGE_SIZE), 1), HISTORY_PAGE_LIMIT)
+
+    def stream_history(self, conn, action, rows, limit, cursor, complete_cursor=None, **fields):
+        """
+        Отправка сообщений истории несколькими кадрами по HISTORY_CHUNK_SIZE сообщений.
+        Последний кадр ответа содержит "done": true, cursor для продолжения и признак more -
+        есть ли ещё сообщения после этого ответа.
+
+        :param conn: подключение клиента
+        :param action: действие запроса
+        :param rows: итератор кортежей (id, отправитель, получатель, сообщение, время), не меньше limit + 1
+        :param limit: количество сообщений в ответе
+        :param cursor: cursor, если сообщений нет
+        :param complete_cursor: cursor последнего кадра, если переданы все сообщения
+        :param fields: дополнительные поля каждого кадра
+        :return: не возвращает значений
+        """
+        def send_chunk(chunk, done, more=False):
+            response = {
+                "response": 202,
+                "time": calendar.timegm(datetime.now(timezone.utc).utctimetuple()),
+                "action": action,
+                **fields,
+                "alert": chunk,
+                "cursor": cursor,
+                "done": done,
+            }
+            if done:
+                response["more"] = more
+            return self.send_to(conn, response)
+
+        chunk = []
+        more = False
+        for count, row in enumerate(rows):
+            if count == limit:
+                more = True
+                break
+            message_id, user_from, user_to, message, time_send = row
+            chunk.append([message_id, user_from, user_to, message,
+                          int(time_send.timestamp()) if time_send else None])
+            cursor = message_id
+            if len(chunk) == HISTORY_CHUNK_SIZE:
+                if not send_chunk(chunk, False):
+                    return
+                chunk = []
+        if not more and complete_cursor is not None:
+            cursor = complete_cursor
+        send_chunk(chunk, True, more)
+
+    def send_history(self, conn, client_data):
+        """
+        Отправка страницы переписки с собеседником (действие get_history), от новых сообщений к старым.
+        Для получения следующей страницы клиент передаёт полученный cursor в поле before_id.
+
+        :param conn: подключение клиента
+        :param client_data: данные запроса: contact, before_id (необязательно), limit (необязательно)
         :return: не возвращает значений
         """
-        for sock in w_clients:
-            if sock in requests:
-                try:
-                    # Подготовить и отправить ответ сервера
-                    resp = requests[sock]
-                    sock.send(resp.encode('utf-8'))
-                except:  # Сокет недоступен, клиент отключился
-                    logger.info('Клиент {} {} отключился'.format(sock.fileno(), sock.getpeername()))
-                    self.remove_from_active(sock)
-                    sock.close()
-                    all_clients.remove(sock)
+        contact = client_data['contact']
+        limit = self.get_history_limit(client_data)
+        before_id = client_data.get('before_id')
+        user_name = conn.user_name
+
+        def read():
+            # Запрашивается на одно сообщение больше, чтобы узнать, есть ли следующая страница
+            rows = self.database.get_conversation(user_name, contact, before_id, limit + 1, HISTORY_CHUNK_SIZE)
+            try:
+                return list(islice(rows, limit + 1))
+            finally:
+                rows.close()
+
+        self.query_history(conn, client_data, read,
+                           lambda rows: self.stream_history(conn, 'get_history', rows, limit, before_id,
+                                                            contact=contact, **self.correlation(client_data)))
+
+    def send_history_delta(self, conn, client_data):
+        """
+        Отправка сообщений, которых нет у клиента (действие sync_history), по возрастанию id.
+
+        Клиент передаёт cursors - наибольший id сообщения в каждой переписке, since - cursor последней
+        завершённой синхронизации. Если ответ не поместился в limit (more: true), клиент повторяет
+        запрос с теми же cursors и since, передав полученный cursor в поле after_id.
+        Cursor завершённой синхронизации клиент сохраняет и передаёт в since при следующем подключении.
+
+        :param conn: подключение клиента
+        :param client_data: данные запроса: cursors, since, after_id, limit (все необязательные)
+        :return: не возвращает значений
+        """
+        limit = self.get_history_limit(client_data)
+        since = int(client_data.get('since') or 0)
+        after_id = int(client_data.get('after_id') or 0)
+        cursors = client_data.get('cursors') or {}
+        user_name = conn.user_name
+
+        def read():
+            # Ожидается запись только сообщений, поставленных в очередь до запроса: после flush_history
+            # в базе есть все сообщения до complete_cursor, более новые попадут в следующую синхронизацию
+            complete_cursor = self.database.queued_message_id
+            self.database.flush_history(complete_cursor)
+            rows = self.database.get_history_delta(user_name, cursors, since, after_id, HISTORY_CHUNK_SIZE)
+            try:
+                return list(islice(rows, limit + 1)), complete_cursor
+            finally:
+                rows.close()
+
+        def send(result):
+            rows, complete_cursor = result
+            self.stream_history(conn, 'sync_history', rows, limit, max(since, after_id),
+                                complete_cursor=complete_cursor, **self.correlation(client_data))
+
+        self.query_history(conn, client_data, read, send)
+
+    def query_history(self, conn, client_data, read, send):
+        """
+        Чтение истории в пуле потоков history_pool и отправка ответа в потоке сервера:
+        запросы к базе и ожидание записи истории не блокируют цикл сервера.
+
+        :param conn: подключение клиента
+        :param client_data: данные запроса
+        :param read: функция чтения истории, выполняется в пуле потоков
+        :param send: функция отправки ответа, получает результат read, вызывается в потоке сервера
+        :return: не возвращает значений
+        """
+        if not self.history_pool:
+            send(read())
+            return
+        future = self.history_pool.submit(self.read_history, read)
+        future.add_done_callback(
+            lambda f: self.engine.call_soon_threadsafe(self.finish_history_query, conn, client_data, send, f))
+
+    def read_history(self, read):
+        """
+        Выполнение функции чтения истории в пуле потоков. Сессия базы потока закрывается после чтения.
+
+        :param read: функция чтения истории
+        :return: результат read
+        """
+        try:
+            return read()
+        finally:
+            self.database.session.remove()
+
+    def finish_history_query(self, conn, client_data, send, future):
+        """
+        Отправка ответа на запрос истории. Вызывается в потоке сервера.
+
+        :param conn: подключение клиента
+        :param client_data: данные запроса
+        :param send: функция отправки ответа
+        :param future: результат read_history
+        :return: не возвращает значений
+        """
+        if conn.closed:
+            return
+        try:
+            result = future.result()
+        except Exception:
+            logger.exception('Ошибка чтения истории')
+            self.send_to(conn, self.create_response(500, 'Ошибка чтения истории', self.correlation(client_data)))
+            return
+        send(result)
+
+    def start_authentication(self, conn, client_data):
+        """
+        Запуск проверки пароля в пуле потоков. До получения результата подключение остаётся
+        в состоянии аутентификации, следующие запросы клиента откладываются.
+
+        :param conn: подключение клиента
+        :param client_data: данные authenticate сообщения (dict)
+        :return: не возвращает значений
+        """
+        if self.auth_queue_length >= self.auth_queue_limit:
+            self.auth_rejected.inc()
+            self.send_to(conn, self.create_response(503, 'Сервер перегружен, повторите попытку позже',
+                                                    self.correlation(client_data)))
+            return
+        conn.authenticating = True
+        self.auth_queue_length += 1
+        future = self.auth_pool.submit(get_password_hash, client_data['user']['password'])
+        future.add_done_callback(
+            lambda f: self.engine.call_soon_threadsafe(self.finish_authentication, conn, client_data, f))
+
+    def finish_authentication(self, conn, client_data, future):
+        """
+        Завершение аутентификации после вычисления хэша пароля. Вызывается в потоке сервера.
+
+        :param conn: подключение клиента
+        :param client_data: данные authenticate сообщения (dict)
+        :param future: результат вычисления хэша пароля
+        :return: не возвращает значений
+        """
+        self.auth_queue_length -= 1
+        conn.authenticating = False
+        if conn.closed:
+            return
+        try:
+            code, alert = self.login(client_data, conn, future.result())
+            options = self.negotiate_options(conn, client_data) if code == 200 else {}
+            options.update(self.correlation(client_data))
+            self.send_to(conn, self.create_response(code, alert, options))
+            while conn.deferred and not conn.authenticating and not conn.closed:
+                self.process_request(conn, conn.deferred.popleft())
+        except Exception:
+            logger.exception('Ошибка аутентификации клиента {} {}'.format(conn.fileno(), conn.getpeername()))
+            logger.info('Клиент {} {} отключился'.format(conn.fileno(), conn.getpeername()))
+            conn.abort()
+
+    def deliver(self, conn, frame, priority=PRIORITY_NORMAL, size=None):
+        """
+        Постановка кадра в очередь отправки подключения с учётом её заполнения.
+        Если очередь превысит write_high_water, кадр с низким приоритетом отбрасывается,
+        а клиент, не успевающий принимать кадры с обычным приоритетом, отключается.
+
+        :param conn: подключение получателя
+        :param frame: кадр (bytes)
+        :param priority: PRIORITY_NORMAL или PRIORITY_LOW
+        :param size: размер кадра до сжатия
+        :return: True, если кадр поставлен в очередь
+        """
+        if conn.queue_size() + len(frame) <= self.write_high_water:
+            conn.send(frame)
+            self.bytes_sent.inc(len(frame))
+            self.bytes_sent_uncompressed.inc(size or len(frame))
+            return True
+        if priority == PRIORITY_LOW:
+            self.messages_dropped.inc()
+            return False
+        logger.warning('Клиент {} {} не успевает принимать данные и будет отключен'.format(conn.fileno(),
+                                                                                           conn.getpeername()))
+        self.slow_consumers_evicted.inc()
+        conn.abort()
+        return False
+
+    def get_queue_depths(self):
+        """
+        Объём неотправленных данных по подключениям
+
+        :return: словарь вида {адрес клиента: количество байт}
+        """
+        if not self.engine:
+            return {}
+        return {conn.getpeername(): conn.queue_size() for conn in list(self.engine.connections)}
+
+    def get_recipients(self, sender, user_to):
+        """
+        Подключения получателей сообщения
+
+        :param sender: подключение отправителя
+        :param user_to: имя получателя или all для сообщения всем
+        :return: список подключений (все сессии получателя)
+        """
+        if user_to.lower() == 'all':
+            return [conn for conn in self.sessions.all_connections() if conn is not sender]
+        return self.sessions.connections(user_to)
 
     # @log()
-    def send_messages(self, w_clients, all_clients, messages_to_send):
+    def send_messages(self, messages_to_send):
         """
-        Отправка сообщений клиентам
+        Отправка сообщений получателям. Личное сообщение отправляется только подключению получателя,
+        сообщение для all - всем авторизованным пользователям, кроме отправителя.
+        Сообщение сериализуется (и сжимается) один раз для каждого формата и способа сжатия, в очереди всех
+        получателей с этими параметрами ставится один и тот же кадр.
+        Личное сообщение пользователю не в сети ставится в очередь доставки и отправляется после его входа.
 
-        :param w_clients: ожидающие клиенты
-        :param all_clients: все подключенные клиенты
-        :param messages_to_send: сообщение для отправки
+        :param messages_to_send: сообщения для отправки вида {подключение отправителя: сообщение}
         :return: не возвращает значений
         """
-        for client in messages_to_send:
-            # Сохранить в историю сообщений на сервере
-            self.database.save_messge_to_history(messages_to_send[client]['from'],
-                                                 messages_to_send[client]['to'],
-                                                 messages_to_send[client]['message'])
-            for sock in w_clients:
-                try:
-                    msg = json.dumps(messages_to_send[client])
-                    sock.send(msg.encode('utf-8'))
-
-                except TypeError as e:  # Сокет недоступен, клиент отключился
-                    # logger.info('Клиент {} {} отключился'.format(sock.fileno(), sock.getpeername()))
-                    self.remove_from_active(sock)
-                    print(e)
-                    sock.close()
-                    all_clients.remove(sock)
+        for sender, message in messages_to_send.items():
+            recipients = self.get_recipients(sender, message['to'])
+            offline = not recipients and message['to'].lower() != 'all'
+            # Сохранить в историю сообщений на сервере, получатели узнают id сообщения в истории
+            time_send = self.database.get_time()
+            message_id = self.database.save_messge_to_history(message['from'], message['to'], message['message'],
+                                                              pending=offline, time_send=time_send)
+            if message_id:
+                message['id'] = message_id
+                if offline:
+                    self.pending.add(message['to'], dict(message, stored=True))
+                # Окно администратора показывает время, сохранённое в истории
+                self.emit('message_saved', message['from'], message['to'], message['message'], time_send)
+            if recipients:
+                frames = {}
+                priority = PRIORITY_LOW if message['to'].lower() == 'all' else PRIORITY_NORMAL
+                for conn in recipients:
+                    key = (conn.codec, conn.compression and conn.compression.name)
+                    encoded = frames.get(key)
+                    if encoded is None:
+                        encoded = frames[key] = self.encode_message(conn, message)
+                    frame, size = encoded
+                    self.deliver(conn, frame, priority, size)
+            self.message_fanout.observe(len(recipients))
+            logger.debug(f'Сообщение от {message["from"]} для {message["to"]} отправлено {len(recipients)} получателям')
 
     # @log()
-    def read_requests(self, r_clients, all_clients):
+    def handle_request(self, conn, data):
         """
-        Чтение запросов из списка клиентов
+        Обработка запроса клиента: отправка ответа и пересылка сообщения
 
-        :param r_clients: Список клиентов, которые что-то прислали
-        :param all_clients: Список всех клиентов
+        :param conn: подключение клиента
+        :param data: содержимое одного кадра (bytes) в формате JSON или в двоичном формате
         :return: не возвращает значений
         """
-        responses = {}  # Словарь ответов сервера вида {сокет: запрос}
-        messages = {}  # Словарь сообщений
-        for sock in r_clients:
-            try:
-                data = self.parse_client_data(sock.recv(1024).decode('utf-8'))
-                responses[sock], message = self.get_response(data, sock)
-                if len(message):
-                    messages[sock] = message
-                logger.info(f'Получено сообщение: {data} от Клиента: {sock.fileno()} {sock.getpeername()}')
-            except Exception as e:
-                print(e)
-                self.remove_from_active(sock)
-                logger.info('Клиент {} {} отключился'.format(sock.fileno(), sock.getpeername()))
-                all_clients.remove(sock)
-        return responses, messages
+        self.bytes_received_uncompressed.inc(FRAME_HEADER.size + len(data))
+        client_data = self.parse_client_data(data)
+        message_logger.info('Получено сообщение: %s от Клиента: %s %s', client_data, conn.fileno(), conn.getpeername())
+        self.process_request(conn, client_data)
+
+    def get_action_metrics(self, action):
+        """
+        Счётчик запросов и гистограмма времени подготовки ответа для действия.
+        Неизвестные действия учитываются под меткой other.
+
+        :param action: действие из запроса клиента
+        :return: (Counter, Histogram)
+        """
+        label = action if action in ACTIONS else 'other'
+        metrics = self.action_metrics.get(label)
+        if metrics is None:
+            metrics = self.action_metrics[label] = (
+                self.metrics.counter('chat_requests_total', 'Запросы клиентов', action=label),
+                self.metrics.histogram('chat_response_seconds', 'Время подготовки ответа (get_response)', action=label),
+            )
+        return metrics
+
+    def process_request(self, conn, client_data):
+        """
+        Обработка разобранного запроса клиента
+
+        :param conn: подключение клиента
+        :param client_data: данные от клиента (dict)
+        :return: не возвращает значений
+        """
+        if conn.authenticating:
+            conn.deferred.append(client_data)
+            return
+        requests, response_time = self.get_action_metrics(client_data.get('action'))
+        requests.inc()
+        if self.auth_pool and client_data.get('action') == 'authenticate':
+            self.start_authentication(conn, client_data)
+            return
+        start = time.perf_counter()
+        response, message = self.get_response(client_data, conn)
+        response_time.observe(time.perf_counter() - start)
+        if response:
+            response.update(self.correlation(client_data))
+            self.send_to(conn, response)
+        if message:
+            self.send_messages({conn: message})
 
     def remove_from_active(self, sock):
         """
@@ -368,51 +883,87 @@ class ServerClient(threading.Thread, metaclass=ServerVerifier):
         :param sock: Сокет отключенного клиента
         :return: не возвращает значений
         """
-        for user in self.active_users.copy():
-            if self.active_users[user] == sock:
-                self.active_users.pop(user, None)
+        session = self.sessions.remove(sock)
+        sock.user_name = None
+        if session:
+            self.pending.session_closed(sock, session.user_name)
 
     # @log()
     def run(self):
         """
-        Основной метод класса. Запускает поток сервера.
+        Основной метод класса. Запускает поток сервера в выбранном режиме.
 
         :return: Не возвращает значений
         """
-        clients = []
-        messages_to_send = {}
+        if self.mode == 'asyncio':
+            self.engine = AsyncServerEngine(self)
+        else:
+            self.engine = SelectorServerEngine(self)
+        if self.auth_workers:
+            self.auth_pool = ThreadPoolExecutor(max_workers=self.auth_workers, thread_name_prefix='auth')
+        self.history_pool = ThreadPoolExecutor(max_workers=HISTORY_SYNC_WORKERS, thread_name_prefix='history')
+        self.database.start_history_writer(write_time=self.history_write_time)
+        self.pending.load()
+        if self.metrics_port is not None:
+            self.metrics_http = start_http_server(self.render_metrics, METRICS_ADDR, self.metrics_port)
+            logger.info(f'Метрики доступны по адресу http://{METRICS_ADDR}:{self.metrics_http.server_port}/metrics')
+        try:
+            self.engine.serve()
+        finally:
+            if self.metrics_http:
+                self.metrics_http.shutdown()
+                self.metrics_http.server_close()
+                self.metrics_http = None
+            if self.auth_pool:
+                self.auth_pool.shutdown(wait=False, cancel_futures=True)
+                self.auth_pool = None
+            if self.history_pool:
+                self.history_pool.shutdown(wait=True, cancel_futures=True)
+                self.history_pool = None
+            # История сохраняется полностью до завершения потока сервера
+            self.database.stop_history_writer()
+            self.database.session.remove()
+
+    def render_metrics(self):
+        """
+        Метрики сервера и время выполнения трассируемых функций в текстовом формате Prometheus
 
-        if not self.socket:
-            self.socket = self.get_socket(self.addr, self.port)
-        self.server_is_active = True
+        :return: str
+        """
+        return render(self.metrics, TRACING_METRICS)
 
-        logger.info("Сервер запущен")
-        while self.server_is_active:
-            try:
-                client, addr = self.socket.accept()
-            except OSError as e:
-                pass  # timeout вышел
-            else:
-                logger.info("Получен запрос на соединение от %s" % str(addr))
-                clients.append(client)
-            finally:
-                # Проверить наличие событий ввода-вывода
-                wait = 1
-                r = []
-                w = []
+    def get_metrics_summary(self):
+        """
+        Основные показатели сервера для окна администратора
 
-                try:
-                    r, w, e = select.select(clients, clients, [], wait)
-                except:
-                    pass  # Ничего не делать, если какой-то клиент отключился
+        :return: словарь {название: значение}
+        """
+        requests = sum(counter.value for counter, _ in list(self.action_metrics.values()))
+        responses = [histogram for _, histogram in list(self.action_metrics.values())]
+        response_count = sum(histogram.count for histogram in responses)
+        response_time = sum(histogram.sum for histogram in responses) / response_count if response_count else 0
+        messages = self.action_metrics.get('msg')
+        return {
+            'Подключения': self.metrics.get('chat_connections').get(),
+            'В сети': self.metrics.get('chat_active_users').get(),
+            'Запросы': requests,
+            'Сообщения': messages[0].value if messages else 0,
+            'Ответ, мс': round(response_time * 1000, 2),
+            'Получено, КБ': self.bytes_received.value // 1024,
+            'Отправлено, КБ': self.bytes_sent.value // 1024,
+            'Очередь истории': self.metrics.get('chat_history_queue_length').get(),
+            'Ошибки входа': self.auth_failures.value,
+        }
 
-                requests, messages_to_send = self.read_requests(r, clients)  # Сохраним запросы клиентов
-                if requests:
-                    self.write_responses(requests, w, clients)  # Выполним отправку ответов клиентам
+    def stop(self):
+        """
+        Остановка сервера
 
-                if len(messages_to_send) and w:
-                    self.send_messages(w, clients, messages_to_send)
-                    messages_to_send.clear()
+        :return: Не возвращает значений
+        """
+        self.server_is_active = False
+        if self.engine:
+            self.engine.stop()
 
 
 @log()
@@ -425,9 +976,17 @@ def main():
     server_window_app = QtWidgets.QApplication(sys.argv)
     main_window = ServerWindow()
 
-    server_client = ServerClient(main_window.edtAddress.text(), main_window.edtPort.text())
+    server_client = ServerClient(main_window.edtAddress.text(), main_window.edtPort.text(), args[2])
+    server_client.metrics_port = args[3]
     server_client.set_database(main_window.edtConnectionString.text(), False)
 
+    # Окно обновляется по событиям сервера, изменяются только добавленные строки
+    signals = ServerSignals()
+    server_client.subscribe('user_saved', signals.user_saved.emit)
+    server_client.subscribe('message_saved', signals.message_saved.emit)
+    signals.user_saved.connect(main_window.users_model.user_saved)
+    signals.message_saved.connect(main_window.messages_model.message_saved)
+
     def connect():
         server_client.set_database(main_window.edtConnectionString.text(), False)
         server_client.addr = main_window.edtAddress.text()
@@ -444,25 +1003,19 @@ def main():
         if not server_client.server_is_active:
             raise ConnectionError('Не удалось выполнить подключение за указанное время.')
 
-        main_window.database = server_client.database
-        update_user_list()
-        update_messages_history()
+        main_window.set_database(server_client.database)
 
     main_window.btnConnect.clicked.connect(connect)
 
     def update_user_list():
-        main_window.tblUsers.setModel(main_window.create_users_list_view())
+        main_window.users_model.set_database(main_window.database)
         main_window.tblUsers.resizeColumnsToContents()
-        main_window.tblUsers.resizeRowsToContents()
-        # print(1)
 
-    update_user_list()
     main_window.btnContacts.clicked.connect(update_user_list)
 
     def update_messages_history():
-        main_window.lstMessages.setModel(main_window.create_messages_history_view(server_client.database, 20))
+        main_window.messages_model.set_database(main_window.database)
 
-    update_messages_history()
     main_window.btnMessages.clicked.connect(update_messages_history)
 
     def add_user_window():
@@ -470,7 +1023,6 @@ def main():
             def add_user(user_name, password, information):
                 if user_name and password:
                     server_client.create_user(user_name, password, information)
-                    update_user_list()
 
             dialog = AddUserDialogWindow(main_window)
             dialog.accepted.connect(lambda: add_user(dialog.edtLogin.text(),
@@ -482,13 +1034,10 @@ def main():
 
     main_window.btnAddUser.clicked.connect(add_user_window)
 
-    timer_update_user_list = QTimer()
-    timer_update_user_list.timeout.connect(update_user_list)
-    timer_update_user_list.start(1000)
-
-    timer_update_messages_history = QTimer()
-    timer_update_messages_history.timeout.connect(update_messages_history)
-    timer_update_messages_history.start(1000)
+    # Сводка метрик читает только счётчики в памяти, без обращения к базе
+    timer_update_metrics = QTimer()
+    timer_update_metrics.timeout.connect(lambda: main_window.show_metrics(server_client.get_metrics_summary()))
+    timer_update_metrics.start(1000)
 
     main_window.show()
     sys.exit(server_window_app.exec())
@@ -0,0 +1,206 @@
+import asyncio
+import logging
+from collections import deque
+
+from common.codec import JSON_CODEC
+from common.framing import FrameBuffer
+
+logger = logging.getLogger('chat.server')
+
+
+class AsyncServerProtocol(asyncio.Protocol):
+    """
+    Соединение клиента в асинхронном режиме сервера.
+
+    Повторяет интерфейс подключения, который используется в ServerClient (send, fileno, getpeername, close).
+    """
+    def __init__(self, engine):
+        """
+        Инициализация соединения
+
+        :param engine: экземпляр AsyncServerEngine
+        """
+        self.engine = engine
+        self.transport = None
+        self.peername = None
+        self.read_buffer = FrameBuffer()
+        self.write_queue = []
+        self.queued_bytes = 0
+        self.user_name = None
+        self.authenticating = False
+        self.deferred = deque()
+        self.codec = JSON_CODEC
+        self.compression = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.peername = transport.get_extra_info('peername')
+        self.engine.connections.add(self)
+        self.engine.server.connections_opened.inc()
+        logger.info("Получен запрос на соединение от %s" % str(self.peername))
+
+    def data_received(self, data):
+        self.engine.handle_data(self, data)
+
+    def connection_lost(self, exc):
+        self.engine.drop_connection(self)
+
+    def send(self, data):
+        """
+        Постановка данных в очередь на отправку. Не блокирует поток: все данные, поставленные в очередь
+        за итерацию цикла событий, передаются транспорту одним вызовом.
+
+        :param data: данные (bytes)
+        :return: количество поставленных в очередь байт
+        """
+        if self.closed:
+            return 0
+        if not self.write_queue:
+            self.engine.loop.call_soon(self.flush)
+        self.write_queue.append(data)
+        self.queued_bytes += len(data)
+        return len(data)
+
+    def flush(self):
+        """Передача очереди отправки транспорту"""
+        queue, self.write_queue = self.write_queue, []
+        self.queued_bytes = 0
+        if queue and not self.transport.is_closing():
+            self.transport.writelines(queue)
+
+    def queue_size(self):
+        """
+        Объём неотправленных данных: очередь подключения и буфер транспорта
+
+        :return: количество байт
+        """
+        if self.transport is None:
+            return self.queued_bytes
+        return self.queued_bytes + self.transport.get_write_buffer_size()
+
+    @property
+    def closed(self):
+        return self.transport is None or self.transport.is_closing()
+
+    def fileno(self):
+        sock = self.transport.get_extra_info('socket') if self.transport else None
+        return sock.fileno() if sock else -1
+
+    def getpeername(self):
+        return self.peername
+
+    def close(self):
+        if self.transport:
+            self.transport.close()
+
+    def abort(self):
+        """Немедленное отключение клиента без отправки данных из очереди"""
+        self.write_queue.clear()
+        self.queued_bytes = 0
+        if self.transport:
+            self.transport.abort()
+
+
+class AsyncServerEngine:
+    """
+    Асинхронный режим работы сервера на asyncio.
+
+    Каждое соединение обслуживается протоколом AsyncServerProtocol, запросы обрабатываются
+    сразу по приходу данных без опроса сокетов и фиксированных пауз.
+    """
+    backlog = 1024
+    """Размер очереди входящих подключений"""
+
+    def __init__(self, server):
+        """
+        Инициализация движка
+
+        :param server: экземпляр ServerClient, логика которого используется для обработки запросов
+        """
+        self.server = server
+        self.connections = set()
+        self.loop = None
+        self.stopped = None
+
+    def serve(self):
+        """
+        Запуск цикла событий. Блокирует вызывающий поток до остановки сервера.
+
+        :return: Не возвращает значений
+        """
+        asyncio.run(self._serve())
+
+    def stop(self):
+        """
+        Остановка цикла событий. Может вызываться из любого потока.
+
+        :return: Не возвращает значений
+        """
+        if self.loop and self.stopped and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.stopped.set)
+
+    def call_soon_threadsafe(self, callback, *args):
+        """
+        Выполнение функции в цикле событий. Может вызываться из любого потока.
+
+        :param callback: функция
+        :param args: аргументы функции
+        :return: Не возвращает значений
+        """
+        self.loop.call_soon_threadsafe(callback, *args)
+
+    def call_later(self, delay, callback, *args):
+        """
+        Выполнение функции в цикле событий через указанное время. Вызывается в потоке цикла событий.
+
+        :param delay: задержка (секунды)
+        :param callback: функция
+        :param args: аргументы функции
+        :return: Не возвращает значений
+        """
+        self.loop.call_later(delay, callback, *args)
+
+    async def _serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.stopped = asyncio.Event()
+        listener = await self.loop.create_server(lambda: AsyncServerProtocol(self),
+                                                 host=self.server.addr or None,
+                                                 port=int(self.server.port),
+                                                 backlog=self.backlog,
+                                                 reuse_address=True)
+        self.server.server_is_active = True
+        logger.info("Сервер запущен (asyncio)")
+        async with listener:
+            await self.stopped.wait()
+        for conn in list(self.connections):
+            conn.close()
+        self.server.server_is_active = False
+
+    def handle_data(self, conn, data):
+        """
+        Обработка данных, полученных от клиента
+
+        :param conn: соединение клиента
+        :param data: полученные данные (bytes), могут содержать часть кадра или несколько кадров
+        :return: Не возвращает значений
+        """
+        self.server.bytes_received.inc(len(data))
+        try:
+            for frame in conn.read_buffer.feed(data):
+                if conn.closed:
+                    break  # Клиент отключён при обработке предыдущего запроса
+                self.server.handle_request(conn, frame)
+        except Exception:
+            logger.exception('Ошибка обработки запроса клиента {} {}'.format(conn.fileno(), conn.getpeername()))
+            logger.info('Клиент {} {} отключился'.format(conn.fileno(), conn.getpeername()))
+            conn.close()
+
+    def drop_connection(self, conn):
+        """
+        Удаление отключившегося клиента
+
+        :param conn: соединение клиента
+        :return: Не возвращает значений
+        """
+        self.server.remove_from_active(conn)
+        self.connections.discard(conn)
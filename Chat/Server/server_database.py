@@ -1,8 +1,272 @@
-from sqlalchemy.orm import declarative_base, sessionmaker, relationship
-from sqlalchemy import Column, Integer, String, DateTime, create_engine, MetaData, Table, ForeignKey, desc
+import logging
+import queue
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from heapq import merge
+
+from sqlalchemy.orm import declarative_base, relationship, aliased
+from sqlalchemy import Column, Integer, String, DateTime, MetaData, Table, ForeignKey, Index, desc, \
+    insert, delete, bindparam, text, func, or_
 from datetime import datetime
 from sqlalchemy.sql import default_comparator
 
+from common.storage import create_storage_engine, create_session
+
+logger = logging.getLogger('chat.server')
+
+SCHEMA_VERSION = 3
+"""Версия схемы базы данных сервера (PRAGMA user_version в SQLite)"""
+
+SCHEMA_MIGRATIONS = {
+    1: (
+        # Объединение пользователей с одинаковыми именами перед созданием уникального индекса
+        """CREATE TEMP TABLE user_duplicates AS
+           SELECT u.id AS id, (SELECT MIN(k.id) FROM users k WHERE k.name = u.name) AS keep_id
+           FROM users u WHERE u.id != (SELECT MIN(k.id) FROM users k WHERE k.name = u.name)""",
+        """UPDATE contacts SET user_owner = (SELECT keep_id FROM user_duplicates WHERE id = user_owner)
+           WHERE user_owner IN (SELECT id FROM user_duplicates)""",
+        """UPDATE contacts SET user_contact = (SELECT keep_id FROM user_duplicates WHERE id = user_contact)
+           WHERE user_contact IN (SELECT id FROM user_duplicates)""",
+        """UPDATE history SET user_id = (SELECT keep_id FROM user_duplicates WHERE id = user_id)
+           WHERE user_id IN (SELECT id FROM user_duplicates)""",
+        """UPDATE messages_history SET user_id_from = (SELECT keep_id FROM user_duplicates WHERE id = user_id_from)
+           WHERE user_id_from IN (SELECT id FROM user_duplicates)""",
+        """UPDATE messages_history SET user_id_to = (SELECT keep_id FROM user_duplicates WHERE id = user_id_to)
+           WHERE user_id_to IN (SELECT id FROM user_duplicates)""",
+        "DELETE FROM users WHERE id IN (SELECT id FROM user_duplicates)",
+        "DROP TABLE user_duplicates",
+        # Удаление повторяющихся контактов
+        """DELETE FROM contacts WHERE id NOT IN (
+           SELECT MIN(id) FROM contacts GROUP BY user_owner, user_contact)""",
+    ),
+    2: (),  # только новый индекс ix_messages_history_from_to_id
+    3: (),  # только новая таблица pending_delivery
+}
+"""Изменения данных, которые нужно выполнить перед созданием индексов версии схемы"""
+
+USER_CACHE_SIZE = 10000
+"""Максимальное количество пользователей в кэше"""
+
+UserRecord = namedtuple('UserRecord', 'id name password_hash information')
+"""Данные пользователя, которые хранятся в кэше"""
+
+
+class UserCache:
+    """
+    Кэш пользователей: имя -> UserRecord, вытесняются давно не использованные записи.
+    Обращения возможны из потока сервера и из потока интерфейса.
+    """
+    def __init__(self, max_size=USER_CACHE_SIZE):
+        self.max_size = max_size
+        self.records = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_name):
+        """
+        Поиск пользователя в кэше
+
+        :param user_name: имя пользователя
+        :return: UserRecord или None
+        """
+        with self.lock:
+            record = self.records.get(user_name)
+            if record is None:
+                self.misses += 1
+                return None
+            self.records.move_to_end(user_name)
+            self.hits += 1
+            return record
+
+    def put(self, record):
+        with self.lock:
+            self.records[record.name] = record
+            self.records.move_to_end(record.name)
+            if len(self.records) > self.max_size:
+                self.records.popitem(last=False)
+
+    def invalidate(self, user_name=None):
+        """
+        Удаление пользователя из кэша
+
+        :param user_name: имя пользователя, None - очистить кэш полностью
+        :return: Не возвращает значений
+        """
+        with self.lock:
+            if user_name is None:
+                self.records.clear()
+            else:
+                self.records.pop(user_name, None)
+
+    def __len__(self):
+        return len(self.records)
+
+
+HISTORY_BATCH_SIZE = 500
+"""Максимальное количество сообщений, записываемых в историю одной транзакцией"""
+
+HISTORY_BATCH_INTERVAL = 0.05
+"""Максимальное время ожидания пополнения пакета сообщений (секунды)"""
+
+
+WRITE_HISTORY, WRITE_PENDING, WRITE_DELIVERED = range(3)
+"""Виды изменений, которые записывает HistoryWriter"""
+
+
+class HistoryWriter(threading.Thread):
+    """
+    Отложенная запись истории сообщений.
+
+    Сообщения ставятся в очередь без обращения к базе, отдельный поток записывает их пакетами:
+    одна транзакция на HISTORY_BATCH_SIZE сообщений или на HISTORY_BATCH_INTERVAL секунд.
+    """
+    def __init__(self, storage, batch_size=HISTORY_BATCH_SIZE, batch_interval=HISTORY_BATCH_INTERVAL,
+                 write_time=None, written_id=0):
+        """
+        Инициализация потока записи
+
+        :param storage: экземпляр ServerDatabaseStorage
+        :param batch_size: максимальный размер пакета
+        :param batch_interval: максимальное время набора пакета (секунды)
+        :param write_time: гистограмма времени записи пакета (common.metrics.Histogram)
+        :param written_id: id последнего сообщения, уже сохранённого в базе
+        """
+        super().__init__(name='history-writer', daemon=True)
+        self.storage = storage
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.write_time = write_time
+        self.queue = queue.Queue()
+        self.written = 0
+        self.batches = 0
+        self.written_id = written_id
+        self.written_condition = threading.Condition()
+        self.stopped = False
+        self._stop_marker = object()
+
+    def put(self, message_id, user_id_from, user_id_to, message, time_send, pending=False):
+        """
+        Постановка сообщения в очередь на запись. Не блокирует вызывающий поток.
+
+        :param message_id: id сообщения, назначенный сервером
+        :param user_id_from: id отправителя
+        :param user_id_to: id получателя
+        :param message: текст сообщения
+        :param time_send: время отправки
+        :param pending: получатель не в сети, сообщение ставится в очередь доставки
+        :return: Не возвращает значений
+        """
+        self.queue.put((WRITE_HISTORY, {'id': message_id, 'user_id_from': user_id_from, 'user_id_to': user_id_to,
+                                        'message': message, 'time_send': time_send}))
+        if pending:
+            self.queue.put((WRITE_PENDING, {'user_id': user_id_to, 'message_id': message_id}))
+
+    def put_delivered(self, user_id, message_ids):
+        """
+        Постановка в очередь удаления доставленных сообщений из очереди доставки
+
+        :param user_id: id получателя
+        :param message_ids: id доставленных сообщений
+        :return: Не возвращает значений
+        """
+        for message_id in message_ids:
+            self.queue.put((WRITE_DELIVERED, {'user_id': user_id, 'message_id': message_id}))
+
+    def queue_length(self):
+        return self.queue.qsize()
+
+    def run(self):
+        stopping = False
+        while not stopping:
+            item = self.queue.get()
+            batch = []
+            deadline = time.monotonic() + self.batch_interval
+            while True:
+                if item is self._stop_marker:
+                    stopping = True
+                else:
+                    batch.append(item)
+                if stopping or len(batch) >= self.batch_size:
+                    break
+                try:
+                    item = self.queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+            try:
+                if batch:
+                    start = time.perf_counter()
+                    self.write_batch(batch)
+                    if self.write_time:
+                        self.write_time.observe(time.perf_counter() - start)
+            except Exception:
+                logger.exception(f'Не удалось сохранить в историю {len(batch)} сообщений')
+            finally:
+                for _ in range(len(batch) + stopping):
+                    self.queue.task_done()
+                # Сообщения ставятся в очередь по возрастанию id: все сообщения до written_id обработаны
+                message_ids = [values['id'] for kind, values in batch if kind == WRITE_HISTORY]
+                if message_ids or stopping:
+                    with self.written_condition:
+                        self.written_id = max([self.written_id, *message_ids])
+                        self.stopped = stopping
+                        self.written_condition.notify_all()
+
+    def write_batch(self, batch):
+        """
+        Запись пакета одной транзакцией: по одному executemany на каждый вид изменений.
+        Удаление доставленных сообщений выполняется после вставки, поэтому порядок изменений
+        одного сообщения внутри пакета сохраняется.
+
+        :param batch: список (вид изменения, значения столбцов)
+        :return: Не возвращает значений
+        """
+        rows = {WRITE_HISTORY: [], WRITE_PENDING: [], WRITE_DELIVERED: []}
+        for kind, values in batch:
+            rows[kind].append(values)
+        history = self.storage.MessagesHistory.__table__
+        pending = self.storage.PendingDelivery.__table__
+        with self.storage.db_engine.begin() as connection:
+            if rows[WRITE_HISTORY]:
+                connection.execute(insert(history), rows[WRITE_HISTORY])
+            if rows[WRITE_PENDING]:
+                connection.execute(insert(pending), rows[WRITE_PENDING])
+            if rows[WRITE_DELIVERED]:
+                connection.execute(delete(pending).where(pending.c.user_id == bindparam('user_id'),
+                                                         pending.c.message_id == bindparam('message_id')),
+                                   rows[WRITE_DELIVERED])
+        self.written += len(rows[WRITE_HISTORY])
+        self.batches += 1
+
+    def flush(self):
+        """
+        Ожидание записи всех сообщений, поставленных в очередь
+
+        :return: Не возвращает значений
+        """
+        self.queue.join()
+
+    def wait_written(self, message_id):
+        """
+        Ожидание записи сообщений до message_id включительно. Сообщения, поставленные в очередь позже,
+        не ожидаются, поэтому при постоянном потоке сообщений ожидание не затягивается.
+
+        :param message_id: id сообщения
+        :return: Не возвращает значений
+        """
+        with self.written_condition:
+            self.written_condition.wait_for(lambda: self.written_id >= message_id or self.stopped)
+
+    def stop(self):
+        """
+        Запись оставшихся сообщений и остановка потока
+
+        :return: Не возвращает значений
+        """
+        self.queue.put(self._stop_marker)
+        self.join()
+
 
 class ServerDatabaseStorage:
     Base = declarative_base()
@@ -63,14 +327,38 @@ class ServerDatabaseStorage:
             self.message = message
             self.time_send = time_send
 
-    def __init__(self, connection_string, enable_echo=False):
-        self.db_engine = create_engine(connection_string, echo=enable_echo, connect_args={'check_same_thread': False})
+    class PendingDelivery(Base):
+        __tablename__ = 'pending_delivery'
+        id = Column(Integer, primary_key=True)
+        user_id = Column(Integer, ForeignKey("users.id"), nullable=False)  # id получателя
+        message_id = Column(Integer, ForeignKey("messages_history.id"), nullable=False)
+
+        def __init__(self, user_id, message_id):
+            self.user_id = user_id
+            self.message_id = message_id
+
+    def __init__(self, connection_string, enable_echo=False, profile=None):
+        """
+        Подключение к базе данных
+
+        :param connection_string: строка подключения
+        :param enable_echo: вывод подробной информации о взаимодействии с БД
+        :param profile: настройки SQLite (см. common.storage.SQLITE_PROFILE)
+        """
+        self.db_engine = create_storage_engine(connection_string, enable_echo, profile)
         self.metadata = MetaData()
         self.map_tables()
-        self.session = sessionmaker(bind=self.db_engine)()
+        self.session = create_session(self.db_engine)
+        self.history_writer = None
+        self.user_cache = UserCache()
+        self.message_id_lock = threading.RLock()
+        self.last_message_id = self.session.query(func.max(self.MessagesHistory.id)).scalar() or 0
+        self.queued_message_id = self.last_message_id  # id последнего сообщения, поставленного в очередь записи
+        self.session.commit()
 
-    def change_engine(self, connection_string, enable_echo):
-        self.db_engine = create_engine(connection_string, enable_echo, connect_args={'check_same_thread': False})
+    def change_engine(self, connection_string, enable_echo, profile=None):
+        self.db_engine = create_storage_engine(connection_string, enable_echo, profile)
+        self.session = create_session(self.db_engine)
 
     def map_tables(self):
         users_table = Table('users', self.metadata,
@@ -78,6 +366,7 @@ class ServerDatabaseStorage:
                             Column('name', String),
                             Column('password_hash', String),
                             Column('information', String),
+                            Index('ix_users_name', 'name', unique=True),
                             )
 
         history_table = Table('history', self.metadata,
@@ -91,6 +380,7 @@ class ServerDatabaseStorage:
                                Column('id', Integer, primary_key=True),
                                Column('user_owner', Integer, ForeignKey("users.id"), nullable=False),
                                Column('user_contact', Integer, ForeignKey("users.id"), nullable=False),
+                               Index('ix_contacts_owner_contact', 'user_owner', 'user_contact', unique=True),
                                )
 
         messages_history = Table('messages_history', self.metadata,
@@ -99,9 +389,41 @@ class ServerDatabaseStorage:
                                  Column('user_id_to', Integer, ForeignKey("users.id"), nullable=False),
                                  Column('message', String),
                                  Column('time_send', DateTime),
+                                 Index('ix_messages_history_from_to_time', 'user_id_from', 'user_id_to', 'time_send'),
+                                 Index('ix_messages_history_time_send', 'time_send'),
+                                 Index('ix_messages_history_from_to_id', 'user_id_from', 'user_id_to', 'id'),
+                                 )
+
+        pending_delivery = Table('pending_delivery', self.metadata,
+                                 Column('id', Integer, primary_key=True),
+                                 Column('user_id', Integer, ForeignKey("users.id"), nullable=False),
+                                 Column('message_id', Integer, ForeignKey("messages_history.id"), nullable=False),
+                                 Index('ix_pending_delivery_user_message', 'user_id', 'message_id', unique=True),
                                  )
 
         self.metadata.create_all(self.db_engine)
+        self.upgrade_schema()
+
+    def upgrade_schema(self):
+        """
+        Обновление схемы существующей базы данных: create_all не добавляет индексы в уже созданные таблицы.
+        Версия схемы SQLite хранится в PRAGMA user_version, обновление выполняется одной транзакцией.
+
+        :return: Не возвращает значений
+        """
+        with self.db_engine.begin() as connection:
+            sqlite = connection.dialect.name == 'sqlite'
+            version = connection.execute(text('PRAGMA user_version')).scalar() if sqlite else 0
+            if version >= SCHEMA_VERSION:
+                return
+            for migration in range(version + 1, SCHEMA_VERSION + 1):
+                for statement in SCHEMA_MIGRATIONS.get(migration, ()):
+                    connection.execute(text(statement))
+            for table in self.metadata.sorted_tables:
+                for index in table.indexes:
+                    index.create(connection, checkfirst=True)
+            if sqlite:
+                connection.execute(text(f'PRAGMA user_version = {SCHEMA_VERSION}'))
 
     @staticmethod
     def get_time():
@@ -113,12 +435,44 @@ class ServerDatabaseStorage:
             user = ServerDatabaseStorage.Users(user_name, password_hash, information)
             self.session.add(user)
             self.session.commit()
+            self.user_cache.invalidate(user_name)
         return user
 
-    def get_user(self, user_name):
+    def update_user(self, user_name, password_hash=None, information=None):
+        """
+        Изменение данных пользователя (из интерфейса администратора)
+
+        :param user_name: имя пользователя
+        :param password_hash: новый хэш пароля, None - не изменять
+        :param information: новая информация о пользователе, None - не изменять
+        :return: объект пользователя или None, если пользователь не найден
+        """
         user = self.session.query(self.Users).filter_by(name=user_name).first()
+        if user:
+            if password_hash is not None:
+                user.password_hash = password_hash
+            if information is not None:
+                user.information = information
+            self.session.commit()
+        self.user_cache.invalidate(user_name)
         return user
 
+    def get_user(self, user_name):
+        """
+        Поиск пользователя по имени. Найденные пользователи сохраняются в кэше.
+
+        :param user_name: имя пользователя
+        :return: UserRecord или None
+        """
+        record = self.user_cache.get(user_name)
+        if record is None:
+            row = self.session.query(self.Users.id, self.Users.name, self.Users.password_hash,
+                                     self.Users.information).filter_by(name=user_name).first()
+            if row:
+                record = UserRecord(*row)
+                self.user_cache.put(record)
+        return record
+
     def add_user_to_history(self, user_id, ip_address):
         current_time = self.get_time()
         history = self.UserHistory(user_id, ip_address, current_time)
@@ -141,9 +495,20 @@ class ServerDatabaseStorage:
             self.session.commit()
 
     def get_contacts(self, user_owner):
-        user = self.get_user(user_owner)
-        contact_list = self.session.query(self.ContactList).filter_by(user_owner=user.id).all()
-        return tuple(str(self.session.query(self.Users).get(c.user_contact)) for c in contact_list)
+        """
+        Список контактов пользователя одним запросом
+
+        :param user_owner: имя владельца списка контактов
+        :return: кортеж имён контактов
+        """
+        owner = aliased(self.Users)
+        contact = aliased(self.Users)
+        query = self.session.query(contact.name) \
+            .join(self.ContactList, self.ContactList.user_contact == contact.id) \
+            .join(owner, self.ContactList.user_owner == owner.id) \
+            .filter(owner.name == user_owner) \
+            .order_by(self.ContactList.id)
+        return tuple(name for name, in query)
 
     def remove_contact(self, user_owner, user_contact):
         user = self.get_user(user_owner)
@@ -153,32 +518,281 @@ class ServerDatabaseStorage:
             self.session.delete(contact_records[0])
             self.session.commit()
 
-    def save_messge_to_history(self, user_from, user_to, message):
-        current_time = self.get_time()
+    def start_history_writer(self, batch_size=HISTORY_BATCH_SIZE, batch_interval=HISTORY_BATCH_INTERVAL,
+                             write_time=None):
+        """
+        Запуск отложенной записи истории сообщений в отдельном потоке
+
+        :param batch_size: максимальный размер пакета
+        :param batch_interval: максимальное время набора пакета (секунды)
+        :param write_time: гистограмма времени записи пакета
+        :return: Не возвращает значений
+        """
+        if not self.history_writer:
+            with self.message_id_lock:
+                self.history_writer = HistoryWriter(self, batch_size, batch_interval, write_time,
+                                                    self.queued_message_id)
+            self.history_writer.start()
+
+    def stop_history_writer(self):
+        """
+        Запись всех сообщений из очереди и остановка потока записи
+
+        :return: Не возвращает значений
+        """
+        if self.history_writer:
+            self.history_writer.stop()
+            self.history_writer = None
+
+    def flush_history(self, message_id=None):
+        """
+        Ожидание записи сообщений, поставленных в очередь
+
+        :param message_id: ожидать записи сообщений только до этого id (см. queued_message_id),
+                           None - пока очередь не опустеет
+        :return: Не возвращает значений
+        """
+        if not self.history_writer:
+            return
+        if message_id is None:
+            self.history_writer.flush()
+        else:
+            self.history_writer.wait_written(message_id)
+
+    def history_queue_length(self):
+        return self.history_writer.queue_length() if self.history_writer else 0
+
+    def next_message_id(self):
+        """
+        Назначение id сообщению истории. id назначаются сервером по возрастанию до записи в базу,
+        поэтому клиент получает id вместе с сообщением.
+
+        :return: id сообщения
+        """
+        with self.message_id_lock:
+            self.last_message_id += 1
+            return self.last_message_id
+
+    def save_messge_to_history(self, user_from, user_to, message, pending=False, time_send=None):
+        """
+        Сохранение сообщения в историю (в очередь на запись, если запущен поток записи)
+
+        :param user_from: имя отправителя
+        :param user_to: имя получателя
+        :param message: текст сообщения
+        :param pending: получатель не в сети, сообщение ставится в очередь доставки
+        :param time_send: время отправки, None - текущее время
+        :return: id сообщения или None, если отправитель или получатель не найден
+        """
+        current_time = time_send or self.get_time()
         user = self.get_user(user_from)
         contact = self.get_user(user_to)
-        if user and contact:
-            self.session.add(self.MessagesHistory(user.id, contact.id, message, current_time))
+        if not user or not contact:
+            return None
+        # id назначается и сообщение ставится в очередь под одной блокировкой: очередь упорядочена по id,
+        # и queued_message_id не указывает на сообщение, которого ещё нет в очереди
+        with self.message_id_lock:
+            message_id = self.next_message_id()
+            if self.history_writer:
+                self.history_writer.put(message_id, user.id, contact.id, message, current_time, pending)
+            else:
+                history = self.MessagesHistory(user.id, contact.id, message, current_time)
+                history.id = message_id
+                self.session.add(history)
+                if pending:
+                    self.session.flush()
+                    self.session.add(self.PendingDelivery(contact.id, message_id))
+                self.session.commit()
+            self.queued_message_id = message_id
+        return message_id
+
+    def get_pending_messages(self, user_name, after_id=0, limit=100):
+        """
+        Недоставленные сообщения пользователя по возрастанию id
+
+        :param user_name: имя получателя
+        :param after_id: id сообщения, после которого нужно продолжить
+        :param limit: количество сообщений
+        :return: список кортежей (id, отправитель, получатель, сообщение, время отправки)
+        """
+        user = self.get_user(user_name)
+        if not user:
+            return []
+        pending = self.PendingDelivery
+        history = self.MessagesHistory
+        user_from = aliased(self.Users)
+        rows = self.session.query(history.id, user_from.name, history.message, history.time_send) \
+            .join(pending, pending.message_id == history.id) \
+            .join(user_from, history.user_id_from == user_from.id) \
+            .filter(pending.user_id == user.id, pending.message_id > after_id) \
+            .order_by(pending.message_id) \
+            .limit(limit).all()
+        self.session.commit()
+        return [(message_id, name, user.name, message, time_send) for message_id, name, message, time_send in rows]
+
+    def get_pending_users(self):
+        """
+        Пользователи, у которых есть недоставленные сообщения
+
+        :return: множество имён
+        """
+        names = {name for name, in self.session.query(self.Users.name)
+                 .filter(self.Users.id.in_(self.session.query(self.PendingDelivery.user_id)))}
+        self.session.commit()
+        return names
+
+    def delete_delivered(self, user_name, message_ids):
+        """
+        Удаление доставленных сообщений из очереди доставки (пакетом в потоке записи, если он запущен)
+
+        :param user_name: имя получателя
+        :param message_ids: id сообщений, получение которых подтвердил клиент
+        :return: Не возвращает значений
+        """
+        user = self.get_user(user_name)
+        if not user or not message_ids:
+            return
+        if self.history_writer:
+            self.history_writer.put_delivered(user.id, message_ids)
+        else:
+            self.session.query(self.PendingDelivery) \
+                .filter(self.PendingDelivery.user_id == user.id, self.PendingDelivery.message_id.in_(message_ids)) \
+                .delete(synchronize_session=False)
             self.session.commit()
 
     def get_all_users(self):
         return self.session.query(self.Users).filter().all()
 
+    def get_users_page(self, after_id=0, limit=100):
+        """
+        Страница списка пользователей по возрастанию id (пагинация по ключу, без OFFSET)
+
+        :param after_id: id последнего пользователя предыдущей страницы
+        :param limit: количество пользователей на странице
+        :return: список кортежей (id, имя, информация)
+        """
+        query = self.session.query(self.Users.id, self.Users.name, self.Users.information) \
+            .filter(self.Users.id > after_id) \
+            .order_by(self.Users.id) \
+            .limit(limit)
+        return [tuple(row) for row in query]
+
     def get_messages_history(self, count=20):
-        messages = []
-        for m in self.session.query(self.MessagesHistory).filter().order_by(desc(self.MessagesHistory.time_send)).limit(count):
-            messages.append([
-                self.session.query(self.Users).get(m.user_id_from),
-                self.session.query(self.Users).get(m.user_id_to),
-                m.message,
-                m.time_send,
-            ])
-        return messages
+        """
+        Последние сообщения истории одним запросом
+
+        :param count: количество сообщений
+        :return: список кортежей (отправитель, получатель, сообщение, время отправки)
+        """
+        user_from = aliased(self.Users)
+        user_to = aliased(self.Users)
+        query = self.session.query(user_from.name, user_to.name, self.MessagesHistory.message,
+                                   self.MessagesHistory.time_send) \
+            .join(user_from, self.MessagesHistory.user_id_from == user_from.id) \
+            .join(user_to, self.MessagesHistory.user_id_to == user_to.id) \
+            .order_by(desc(self.MessagesHistory.time_send)) \
+            .limit(count)
+        return [tuple(row) for row in query]
+
+    def get_conversation(self, user_name, contact_name, before_id=None, limit=50, chunk_size=100):
+        """
+        Страница переписки двух пользователей, от новых сообщений к старым.
+
+        Пагинация по ключу: страница начинается с сообщения, предшествующего before_id, без OFFSET.
+        Каждое направление переписки читается своим запросом по индексу (user_id_from, user_id_to, id),
+        результаты объединяются по мере чтения, строки загружаются из базы порциями по chunk_size.
+
+        :param user_name: имя пользователя
+        :param contact_name: имя собеседника
+        :param before_id: id сообщения, предшествующие которому нужно вернуть, None - с последнего
+        :param limit: количество сообщений
+        :param chunk_size: количество строк, загружаемых из базы за раз
+        :return: генератор кортежей (id, отправитель, получатель, сообщение, время отправки)
+        """
+        user = self.get_user(user_name)
+        contact = self.get_user(contact_name)
+        if not user or not contact or limit <= 0:
+            return
+        names = {user.id: user.name, contact.id: contact.name}
+        history = self.MessagesHistory
+
+        def direction(user_from, user_to):
+            query = self.session.query(history.id, history.user_id_from, history.user_id_to, history.message,
+                                       history.time_send) \
+                .filter(history.user_id_from == user_from, history.user_id_to == user_to)
+            if before_id is not None:
+                query = query.filter(history.id < before_id)
+            return query.order_by(desc(history.id)).limit(limit).yield_per(chunk_size)
+
+        if user.id == contact.id:
+            rows = direction(user.id, user.id)
+        else:
+            rows = merge(direction(user.id, contact.id), direction(contact.id, user.id),
+                         key=lambda row: row.id, reverse=True)
+        for count, row in enumerate(rows):
+            if count >= limit:
+                break
+            yield row.id, names[row.user_id_from], names[row.user_id_to], row.message, row.time_send
+
+    def get_history_delta(self, user_name, cursors, since=0, after_id=0, chunk_size=100):
+        """
+        Сообщения пользователя, которых нет у клиента, по возрастанию id.
+
+        Клиент передаёт для каждой переписки наибольший id, который у него есть (cursors), и since -
+        id, до которого синхронизация уже была выполнена полностью. Сообщения после since читаются
+        одним запросом по диапазону id, пропуски до since в переписках из cursors - запросами
+        по индексу (user_id_from, user_id_to, id). Объём чтения пропорционален количеству
+        недостающих сообщений, а не размеру истории.
+
+        :param user_name: имя пользователя
+        :param cursors: словарь вида {имя собеседника: наибольший id сообщения у клиента}
+        :param since: id, до которого история у клиента полная
+        :param after_id: продолжение передачи после сообщения с этим id
+        :param chunk_size: количество строк, загружаемых из базы за раз
+        :return: генератор кортежей (id, отправитель, получатель, сообщение, время отправки)
+        """
+        user = self.get_user(user_name)
+        if not user:
+            return
+        history = self.MessagesHistory
+        names = {user.id: user.name}
+        contact_cursors = {}
+        for contact_name, cursor in cursors.items():
+            contact = self.get_user(contact_name)
+            if contact:
+                names[contact.id] = contact.name
+                contact_cursors[contact.id] = int(cursor or 0)
+
+        columns = (history.id, history.user_id_from, history.user_id_to, history.message, history.time_send)
+        lower = max(since, after_id)
+        streams = [self.session.query(*columns)
+                   .filter(history.id > lower, or_(history.user_id_from == user.id, history.user_id_to == user.id))
+                   .order_by(history.id).yield_per(chunk_size)]
+        for contact_id, cursor in contact_cursors.items():
+            if max(cursor, after_id) >= since:
+                continue
+            directions = ((user.id, contact_id),) if contact_id == user.id else \
+                ((user.id, contact_id), (contact_id, user.id))
+            for user_from, user_to in directions:
+                streams.append(self.session.query(*columns)
+                               .filter(history.user_id_from == user_from, history.user_id_to == user_to,
+                                       history.id > max(cursor, after_id), history.id <= since)
+                               .order_by(history.id).yield_per(chunk_size))
+
+        for row in merge(*streams, key=lambda r: r.id):
+            other = row.user_id_to if row.user_id_from == user.id else row.user_id_from
+            if row.id > since and row.id <= contact_cursors.get(other, since):
+                continue  # Сообщение уже есть у клиента
+            if other not in names:
+                # Один запрос на каждого нового собеседника, а не на каждое сообщение
+                names[other] = self.session.query(self.Users.name).filter_by(id=other).scalar()
+            yield row.id, names[row.user_id_from], names[row.user_id_to], row.message, row.time_send
 
     def get_user_and_password(self, user_name, password_hash):
-        result = self.session.query(self.Users).filter_by(name=user_name, password_hash=password_hash).first()
-        print(result)
-        return result
+        user = self.get_user(user_name)
+        if user and user.password_hash == password_hash:
+            return user
+        return None
 
 
 if __name__ == "__main__":
@@ -0,0 +1,203 @@
+import logging
+from collections import deque
+
+logger = logging.getLogger('chat.server')
+
+HOT_QUEUE_LIMIT = 1000
+"""Максимальное количество недоставленных сообщений пользователя, которые хранятся в памяти"""
+
+DELIVERY_BATCH = 100
+"""Количество недоставленных сообщений, отправляемых подключению за один шаг цикла сервера"""
+
+DELIVERY_RETRY_DELAY = 0.05
+"""Пауза перед следующим шагом, если очередь отправки подключения заполнена или запись в базу не завершена"""
+
+
+class PendingDelivery:
+    """
+    Очередь доставки сообщений пользователям, которые не в сети.
+
+    Сообщения хранятся в таблице pending_delivery и удаляются после подтверждения получения (ack).
+    Последние HOT_QUEUE_LIMIT сообщений пользователя дополнительно хранятся в памяти, чтобы доставка
+    после короткого отключения не обращалась к базе. Если часть сообщений есть только в базе
+    (переполнение, перезапуск сервера, неподтверждённая доставка), пользователь считается "холодным"
+    и сообщения читаются из базы страницами.
+
+    Доставка выполняется шагами по DELIVERY_BATCH сообщений, между шагами цикл сервера обрабатывает
+    запросы остальных клиентов; пока очередь отправки одного из подключений заполнена больше чем наполовину,
+    следующий шаг откладывается.
+
+    Доставка одна на пользователя: каждая порция отправляется всем его сессиям. Сессия, подключившаяся
+    во время доставки, получает оставшиеся сообщения, более ранние - при синхронизации истории.
+    """
+    def __init__(self, server, hot_limit=HOT_QUEUE_LIMIT, batch=DELIVERY_BATCH):
+        """
+        Инициализация очереди доставки
+
+        :param server: экземпляр ServerClient
+        :param hot_limit: максимальное количество сообщений пользователя в памяти
+        :param batch: количество сообщений за один шаг доставки
+        """
+        self.server = server
+        self.hot_limit = hot_limit
+        self.batch = batch
+        self.hot = {}
+        self.cold = set()
+        self.last_ids = {}
+        self.unacked = {}
+        self.delivering = {}
+        self.stored = server.metrics.counter('chat_pending_stored_total', 'Сообщения, поставленные в очередь доставки')
+        self.delivered = server.metrics.counter('chat_pending_delivered_total',
+                                                'Сообщения, отправленные из очереди доставки')
+        self.acked = server.metrics.counter('chat_pending_acked_total', 'Подтверждённые сообщения очереди доставки')
+        server.metrics.gauge('chat_pending_hot_messages', 'Недоставленные сообщения в памяти',
+                             function=lambda: sum(len(queue) for queue in self.hot.values()))
+
+    def load(self):
+        """
+        Пользователи с недоставленными сообщениями, сохранёнными до запуска сервера
+
+        :return: Не возвращает значений
+        """
+        self.hot.clear()
+        self.last_ids.clear()
+        self.unacked.clear()
+        self.delivering.clear()
+        self.cold = self.server.database.get_pending_users()
+
+    def add(self, user_name, message):
+        """
+        Постановка сообщения в очередь доставки. Сообщение уже сохранено в базе с признаком pending.
+
+        :param user_name: имя получателя
+        :param message: сообщение (dict) с id, назначенным сервером
+        :return: Не возвращает значений
+        """
+        self.stored.inc()
+        self.last_ids[user_name] = message['id']
+        if user_name in self.cold:
+            return
+        queue = self.hot.setdefault(user_name, deque())
+        if len(queue) >= self.hot_limit:
+            # Остальные сообщения будут прочитаны из базы
+            self.cold.add(user_name)
+            del self.hot[user_name]
+            return
+        queue.append(message)
+
+    def start(self, conn):
+        """
+        Начало доставки после аутентификации подключения. Если доставка пользователю уже идёт,
+        подключение получит следующие порции вместе с остальными сессиями.
+
+        :param conn: подключение получателя
+        :return: Не возвращает значений
+        """
+        user_name = conn.user_name
+        if user_name in self.delivering or (user_name not in self.hot and user_name not in self.cold):
+            return
+        delivery = object()
+        self.delivering[user_name] = delivery
+        self.step(user_name, delivery, 0)
+
+    def step(self, user_name, delivery, cursor):
+        """
+        Отправка очередной порции недоставленных сообщений всем сессиям пользователя
+
+        :param user_name: имя получателя
+        :param delivery: метка доставки, выданная start
+        :param cursor: id последнего отправленного сообщения из базы
+        :return: Не возвращает значений
+        """
+        if self.delivering.get(user_name) is not delivery:
+            return  # Все сессии пользователя отключились, доставка начнётся заново при подключении
+        connections = [conn for conn in self.server.sessions.connections(user_name) if not conn.closed]
+        if not connections:
+            del self.delivering[user_name]
+            return
+        engine = self.server.engine
+        if max(conn.queue_size() for conn in connections) > self.server.write_high_water // 2:
+            engine.call_later(DELIVERY_RETRY_DELAY, self.step, user_name, delivery, cursor)
+            return
+
+        if user_name in self.cold:
+            rows = self.server.database.get_pending_messages(user_name, cursor, self.batch)
+            messages = [self.create_message(*row) for row in rows]
+            if not messages:
+                if cursor < self.last_ids.get(user_name, 0):
+                    # Последние сообщения ещё в очереди записи в базу
+                    engine.call_later(DELIVERY_RETRY_DELAY, self.step, user_name, delivery, cursor)
+                    return
+                self.cold.discard(user_name)
+                self.last_ids.pop(user_name, None)
+                self.hot.pop(user_name, None)
+        else:
+            queue = self.hot.get(user_name) or deque()
+            messages = [queue.popleft() for _ in range(min(self.batch, len(queue)))]
+            if not queue:
+                self.hot.pop(user_name, None)
+                self.last_ids.pop(user_name, None)
+
+        if not messages:
+            del self.delivering[user_name]
+            return
+        unacked = self.unacked.setdefault(user_name, set())
+        for message in messages:
+            for conn in connections:
+                self.server.send_to(conn, message)
+            unacked.add(message['id'])
+            cursor = message['id']
+        self.delivered.inc(len(messages))
+        logger.debug(f'Пользователю {user_name} отправлено {len(messages)} недоставленных сообщений '
+                     f'({len(connections)} сессий)')
+        engine.call_soon_threadsafe(self.step, user_name, delivery, cursor)
+
+    @staticmethod
+    def create_message(message_id, user_from, user_to, message, time_send):
+        """
+        Сообщение из строки таблицы pending_delivery
+
+        :return: сообщение (dict) с признаком stored
+        """
+        return {
+            "action": "msg",
+            "time": int(time_send.timestamp()) if time_send else None,
+            "to": user_to,
+            "from": user_from,
+            "encoding": 'utf-8',
+            "message": message,
+            "id": message_id,
+            "stored": True,
+        }
+
+    def ack(self, user_name, message_ids):
+        """
+        Подтверждение получения сообщений клиентом. Записи удаляются из базы пакетом.
+
+        :param user_name: имя получателя
+        :param message_ids: id полученных сообщений
+        :return: Не возвращает значений
+        """
+        unacked = self.unacked.get(user_name, set())
+        message_ids = [message_id for message_id in message_ids if message_id in unacked]
+        unacked.difference_update(message_ids)
+        if not unacked:
+            self.unacked.pop(user_name, None)
+        self.server.database.delete_delivered(user_name, message_ids)
+        self.acked.inc(len(message_ids))
+
+    def session_closed(self, conn, user_name):
+        """
+        Отключение получателя. Неподтверждённые сообщения будут доставлены из базы при следующем подключении.
+
+        :param conn: подключение получателя
+        :param user_name: имя получателя
+        :return: Не возвращает значений
+        """
+        if not user_name or user_name in self.server.sessions:
+            return  # Доставка продолжается остальным сессиям пользователя
+        self.delivering.pop(user_name, None)
+        if self.unacked.get(user_name):
+            del self.unacked[user_name]
+            self.hot.pop(user_name, None)  # Оставшиеся сообщения также есть в базе
+            self.cold.add(user_name)
@@ -0,0 +1,349 @@
+import heapq
+import itertools
+import logging
+import selectors
+import time
+from collections import deque
+from itertools import islice
+from socket import socket, socketpair
+
+from common.codec import JSON_CODEC
+from common.framing import FrameBuffer
+
+logger = logging.getLogger('chat.server')
+
+SENDMSG_AVAILABLE = hasattr(socket, 'sendmsg')
+"""Возможность отправить несколько буферов одним вызовом (недоступно в Windows)"""
+
+IOV_MAX = 1024
+"""Максимальное количество буферов в одном вызове sendmsg"""
+
+
+class ClientConnection:
+    """
+    Состояние подключения клиента в режиме threaded.
+
+    Повторяет интерфейс подключения, который используется в ServerClient (send, fileno, getpeername, close).
+    Отправка не блокирует поток: данные ставятся в очередь и передаются в конце текущей итерации цикла
+    одним системным вызовом, остаток - когда сокет будет готов к записи.
+    """
+    __slots__ = ('sock', 'addr', 'engine', 'read_buffer', 'write_queue', 'queued_bytes', 'user_name',
+                 'authenticating', 'deferred', 'codec', 'compression', 'events')
+
+    def __init__(self, sock, addr, engine):
+        """
+        Инициализация подключения
+
+        :param sock: сокет клиента
+        :param addr: адрес клиента
+        :param engine: экземпляр SelectorServerEngine
+        """
+        self.sock = sock
+        self.addr = addr
+        self.engine = engine
+        self.read_buffer = FrameBuffer()
+        self.write_queue = deque()
+        self.queued_bytes = 0
+        self.user_name = None
+        self.authenticating = False
+        self.deferred = deque()
+        self.codec = JSON_CODEC
+        self.compression = None
+        self.events = selectors.EVENT_READ
+        engine.selector.register(sock, self.events, self)
+
+    def send(self, data):
+        """
+        Постановка данных в очередь на отправку. Один и тот же буфер может стоять в очередях
+        нескольких подключений.
+
+        :param data: данные (bytes)
+        :return: количество поставленных в очередь байт
+        """
+        if self.sock is None:
+            return 0
+        if not self.write_queue:
+            self.engine.dirty.append(self)
+        self.write_queue.append(data)
+        self.queued_bytes += len(data)
+        return len(data)
+
+    def queue_size(self):
+        """
+        Объём неотправленных данных
+
+        :return: количество байт в очереди отправки
+        """
+        return self.queued_bytes
+
+    def flush(self):
+        """
+        Отправка данных из очереди без блокировки. Все буферы очереди передаются одним вызовом sendmsg,
+        частично отправленный буфер остаётся в начале очереди.
+
+        :return: True, если очередь отправлена полностью
+        """
+        queue = self.write_queue
+        while queue:
+            try:
+                if SENDMSG_AVAILABLE:
+                    sent = self.sock.sendmsg(list(islice(queue, IOV_MAX)))
+                else:
+                    sent = self.sock.send(b''.join(queue))
+            except BlockingIOError:
+                break
+            self.queued_bytes -= sent
+            while queue and sent >= len(queue[0]):
+                sent -= len(queue.popleft())
+            if sent:
+                queue[0] = memoryview(queue[0])[sent:]
+                break
+        self.set_events(selectors.EVENT_READ | selectors.EVENT_WRITE if queue else selectors.EVENT_READ)
+        return not queue
+
+    def set_events(self, events):
+        """
+        Изменение событий, которые отслеживает селектор для сокета
+
+        :param events: маска событий selectors
+        :return: Не возвращает значений
+        """
+        if self.events != events:
+            self.events = events
+            self.engine.selector.modify(self.sock, events, self)
+
+    @property
+    def closed(self):
+        return self.sock is None
+
+    def fileno(self):
+        return self.sock.fileno() if self.sock else -1
+
+    def getpeername(self):
+        return self.addr
+
+    def close(self):
+        if self.sock is None:
+            return
+        self.engine.selector.unregister(self.sock)
+        self.sock.close()
+        self.sock = None
+        self.write_queue.clear()
+        self.queued_bytes = 0
+
+    def abort(self):
+        """Немедленное отключение клиента без отправки данных из очереди"""
+        self.engine.drop_connection(self)
+
+
+class SelectorServerEngine:
+    """
+    Режим работы сервера threaded на selectors (epoll в Linux).
+
+    Поток сервера спит в select до появления событий. Запись отслеживается только для подключений,
+    у которых есть неотправленные данные, поэтому простаивающие подключения не нагружают процессор.
+    """
+    recv_size = 65536
+    """Размер буфера чтения сокета"""
+
+    def __init__(self, server):
+        """
+        Инициализация движка
+
+        :param server: экземпляр ServerClient, логика которого используется для обработки запросов
+        """
+        self.server = server
+        self.selector = selectors.DefaultSelector()
+        self.connections = set()
+        self.dirty = []
+        self.pending_calls = deque()
+        self.timers = []
+        self.timer_sequence = itertools.count()
+        self.listener = None
+        self.wakeup_reader, self.wakeup_writer = socketpair()
+
+    def serve(self):
+        """
+        Основной цикл. Блокирует вызывающий поток до остановки сервера.
+
+        :return: Не возвращает значений
+        """
+        self.listener = self.server.socket or self.server.get_socket(self.server.addr, self.server.port)
+        self.server.socket = self.listener
+        self.listener.setblocking(False)
+        self.selector.register(self.listener, selectors.EVENT_READ, self.accept)
+        self.wakeup_reader.setblocking(False)
+        self.selector.register(self.wakeup_reader, selectors.EVENT_READ, self.wakeup)
+
+        self.server.server_is_active = True
+        logger.info("Сервер запущен")
+        while self.server.server_is_active:
+            timeout = max(self.timers[0][0] - time.monotonic(), 0) if self.timers else None
+            for key, mask in self.selector.select(timeout):
+                if callable(key.data):
+                    key.data()
+                    continue
+                conn = key.data
+                if conn.sock is None:
+                    continue  # Подключение закрыто при обработке предыдущих событий
+                if mask & selectors.EVENT_READ:
+                    self.read(conn)
+                if mask & selectors.EVENT_WRITE and conn.sock is not None:
+                    self.write(conn)
+            self.run_timers()
+            self.flush_dirty()
+
+        for conn in list(self.connections):
+            self.drop_connection(conn)
+        self.selector.close()
+        self.listener.close()
+        self.server.socket = None
+        self.close()
+
+    def close(self):
+        """
+        Закрытие сокетов пробуждения цикла. Вызовы call_soon_threadsafe после закрытия не выполняются.
+
+        :return: Не возвращает значений
+        """
+        self.wakeup_reader.close()
+        self.wakeup_writer.close()
+
+    def stop(self):
+        """
+        Пробуждение цикла для остановки сервера. Может вызываться из любого потока.
+
+        :return: Не возвращает значений
+        """
+        self.wake()
+
+    def call_soon_threadsafe(self, callback, *args):
+        """
+        Выполнение функции в потоке сервера. Может вызываться из любого потока.
+
+        :param callback: функция
+        :param args: аргументы функции
+        :return: Не возвращает значений
+        """
+        self.pending_calls.append((callback, args))
+        self.wake()
+
+    def call_later(self, delay, callback, *args):
+        """
+        Выполнение функции в потоке сервера через указанное время. Вызывается в потоке сервера.
+
+        :param delay: задержка (секунды)
+        :param callback: функция
+        :param args: аргументы функции
+        :return: Не возвращает значений
+        """
+        heapq.heappush(self.timers, (time.monotonic() + delay, next(self.timer_sequence), callback, args))
+
+    def run_timers(self):
+        """Выполнение функций, время которых наступило"""
+        now = time.monotonic()
+        while self.timers and self.timers[0][0] <= now:
+            _, _, callback, args = heapq.heappop(self.timers)
+            self.run_callback(callback, args)
+
+    def wake(self):
+        try:
+            self.wakeup_writer.send(b'\0')
+        except OSError:
+            pass
+
+    def wakeup(self):
+        """Обработка пробуждения цикла: выполнение функций, переданных из других потоков"""
+        try:
+            self.wakeup_reader.recv(4096)
+        except BlockingIOError:
+            pass
+        # Функции, добавленные во время выполнения, ждут следующей итерации цикла вместе с событиями сокетов
+        for _ in range(len(self.pending_calls)):
+            callback, args = self.pending_calls.popleft()
+            self.run_callback(callback, args)
+
+    @staticmethod
+    def run_callback(callback, args):
+        """Выполнение функции из call_soon_threadsafe или call_later: ошибка не останавливает цикл сервера"""
+        try:
+            callback(*args)
+        except Exception:
+            logger.exception('Ошибка при выполнении %r', callback)
+
+    def accept(self):
+        """Приём новых подключений"""
+        while True:
+            try:
+                sock, addr = self.listener.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            logger.info("Получен запрос на соединение от %s" % str(addr))
+            self.server.connections_opened.inc()
+            sock.setblocking(False)
+            self.connections.add(ClientConnection(sock, addr, self))
+
+    def read(self, conn):
+        """
+        Чтение и обработка запроса клиента
+
+        :param conn: подключение клиента
+        :return: Не возвращает значений
+        """
+        try:
+            data = conn.sock.recv(self.recv_size)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b''
+        if not data:
+            logger.info('Клиент {} {} отключился'.format(conn.fileno(), conn.getpeername()))
+            self.drop_connection(conn)
+            return
+
+        self.server.bytes_received.inc(len(data))
+        try:
+            for frame in conn.read_buffer.feed(data):
+                if conn.closed:
+                    break  # Клиент отключён при обработке предыдущего запроса
+                self.server.handle_request(conn, frame)
+        except Exception:
+            logger.exception('Ошибка обработки запроса клиента {} {}'.format(conn.fileno(), conn.getpeername()))
+            logger.info('Клиент {} {} отключился'.format(conn.fileno(), conn.getpeername()))
+            self.drop_connection(conn)
+
+    def write(self, conn):
+        """
+        Отправка данных из очереди подключения
+
+        :param conn: подключение клиента
+        :return: Не возвращает значений
+        """
+        try:
+            conn.flush()
+        except OSError:
+            logger.info('Клиент {} {} отключился'.format(conn.fileno(), conn.getpeername()))
+            self.drop_connection(conn)
+
+    def flush_dirty(self):
+        """
+        Отправка данных, поставленных в очередь за итерацию цикла. Несколько сообщений для одного
+        подключения уходят одним системным вызовом.
+
+        :return: Не возвращает значений
+        """
+        dirty, self.dirty = self.dirty, []
+        for conn in dirty:
+            if conn.sock is not None:
+                self.write(conn)
+
+    def drop_connection(self, conn):
+        """
+        Закрытие подключения и удаление клиента из активных
+
+        :param conn: подключение клиента
+        :return: Не возвращает значений
+        """
+        self.server.remove_from_active(conn)
+        self.connections.discard(conn)
+        conn.close()
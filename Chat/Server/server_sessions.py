@@ -0,0 +1,99 @@
+import time
+
+
+class Session:
+    """Сессия авторизованного пользователя: одно подключение клиента"""
+    __slots__ = ('user_name', 'conn', 'login_time')
+
+    def __init__(self, user_name, conn):
+        self.user_name = user_name
+        self.conn = conn
+        self.login_time = time.time()
+
+    def __repr__(self):
+        return f'{self.user_name} ({self.conn.getpeername()})'
+
+
+class SessionRegistry:
+    """
+    Реестр сессий авторизованных пользователей.
+
+    Хранит прямое и обратное соответствие подключение <-> пользователь, поэтому проверка авторизации,
+    поиск подключений пользователя и удаление сессии при отключении выполняются за O(1).
+    У одного пользователя может быть несколько одновременных сессий.
+    """
+    def __init__(self):
+        self.by_conn = {}
+        self.by_user = {}
+
+    def add(self, user_name, conn):
+        """
+        Регистрация сессии. Если подключение уже авторизовано под другим именем, прежняя сессия удаляется.
+
+        :param user_name: имя пользователя
+        :param conn: подключение клиента
+        :return: Session
+        """
+        self.remove(conn)
+        session = Session(user_name, conn)
+        self.by_conn[conn] = session
+        self.by_user.setdefault(user_name, {})[conn] = session
+        return session
+
+    def remove(self, conn):
+        """
+        Удаление сессии подключения
+
+        :param conn: подключение клиента
+        :return: удалённая Session или None, если подключение не было авторизовано
+        """
+        session = self.by_conn.pop(conn, None)
+        if session:
+            user_sessions = self.by_user[session.user_name]
+            del user_sessions[conn]
+            if not user_sessions:
+                del self.by_user[session.user_name]
+        return session
+
+    def get(self, conn):
+        """
+        Сессия подключения
+
+        :param conn: подключение клиента
+        :return: Session или None
+        """
+        return self.by_conn.get(conn)
+
+    def is_authenticated(self, conn):
+        return conn in self.by_conn
+
+    def connections(self, user_name):
+        """
+        Подключения пользователя
+
+        :param user_name: имя пользователя
+        :return: список подключений
+        """
+        return list(self.by_user.get(user_name, ()))
+
+    def all_connections(self):
+        """
+        Подключения всех авторизованных пользователей
+
+        :return: список подключений
+        """
+        return list(self.by_conn)
+
+    def users(self):
+        """
+        Имена пользователей, у которых есть хотя бы одна сессия
+
+        :return: список имён
+        """
+        return list(self.by_user)
+
+    def __contains__(self, user_name):
+        return user_name in self.by_user
+
+    def __len__(self):
+        return len(self.by_conn)
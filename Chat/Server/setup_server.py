@@ -2,7 +2,8 @@ import sys
 from cx_Freeze import setup, Executable
 
 build_exe_options = {
-    "packages": [],
+    "packages": ['common'],
+    "path": sys.path + ['..'],
     "include_files": ['gui_add_user_server.ui', 'gui_main_server.ui'],
 }
 setup(
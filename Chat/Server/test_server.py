@@ -1,10 +1,88 @@
 import unittest
 import server
+import server_selector
+from gui_server import UsersTableModel, MessagesListModel
+from server_database import ServerDatabaseStorage, SCHEMA_VERSION
+from sqlalchemy import event, inspect, text
+from common.codec import BINARY_CODEC, JSON_CODEC, decode_message
+from common.framing import FrameBuffer, encode_frame, FRAME_HEADER, COMPRESSED_FLAG
 import sys
 import json
 from datetime import datetime, timezone
 import calendar
-from socket import socket, AF_INET, SOCK_STREAM
+import os
+import sqlite3
+import tempfile
+from urllib.error import HTTPError
+from urllib.request import urlopen
+import threading
+import time
+from socket import socket, socketpair, AF_INET, SOCK_STREAM
+
+
+def get_free_port():
+    s = socket(AF_INET, SOCK_STREAM)
+    s.bind(('localhost', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def start_test_server(mode, **options):
+    """Запуск сервера с временной базой данных на свободном порту"""
+    db_dir = tempfile.mkdtemp()
+    server_client = server.ServerClient('localhost', get_free_port(), mode)
+    server_client.set_database(f'sqlite:///{os.path.join(db_dir, "server_database.sqlite3")}')
+    for name, value in options.items():
+        setattr(server_client, name, value)
+    server_client.daemon = True
+    server_client.start()
+    for _ in range(0, 50):
+        if server_client.server_is_active:
+            break
+        time.sleep(0.1)
+    return server_client
+
+
+def read_frames(sock, count):
+    """Чтение указанного количества кадров из сокета"""
+    buffer = FrameBuffer()
+    frames = []
+    while len(frames) < count:
+        frames.extend(buffer.feed(sock.recv(1024)))
+    return [decode_message(f) for f in frames]
+
+
+def send_frame(sock, data):
+    sock.send(encode_frame(json.dumps(data).encode('utf-8')))
+
+
+def connect_user(server_client, user_name, password):
+    """Подключение и аутентификация пользователя"""
+    s = socket(AF_INET, SOCK_STREAM)
+    s.settimeout(5)
+    s.connect(('localhost', server_client.port))
+    send_frame(s, {
+        "action": "authenticate",
+        "time": calendar.timegm(datetime.now(timezone.utc).utctimetuple()),
+        "user": {
+            "account_name": user_name,
+            "password": password,
+        }
+    })
+    read_frames(s, 1)
+    return s
+
+
+def create_text_message(user_from, user_to, message):
+    return {
+        "action": "msg",
+        "time": calendar.timegm(datetime.now(timezone.utc).utctimetuple()),
+        "to": user_to,
+        "from": user_from,
+        "encoding": 'utf-8',
+        "message": message,
+    }
 
 
 class TestGetArguments(unittest.TestCase):
@@ -83,6 +161,730 @@ class TestGetResponse(unittest.TestCase):
         pass
 
 
+class TestServerModes(unittest.TestCase):
+    def testUnknownMode(self):
+        self.assertRaises(ValueError, server.ServerClient, 'localhost', 7777, 'unknown')
+
+    def check_presence(self, mode):
+        server_client = start_test_server(mode)
+        self.assertTrue(server_client.server_is_active)
+
+        test_data = {
+            "action": "presence",
+            "time": calendar.timegm(datetime.now(timezone.utc).utctimetuple()),
+            "type": 'status',
+            "user": {
+                "account_name": 'Andrei',
+                "status": 'online',
+            }
+        }
+        s = socket(AF_INET, SOCK_STREAM)
+        s.settimeout(5)
+        s.connect(('localhost', server_client.port))
+        frame = encode_frame(json.dumps(test_data).encode('utf-8'))
+        # Два запроса одним блоком и один запрос по частям
+        s.send(frame + frame + frame[:3])
+        s.send(frame[3:])
+        responses = read_frames(s, 3)
+        s.close()
+        server_client.stop()
+
+        self.assertEqual([r['response'] for r in responses], [201, 201, 201])
+
+    def testThreadedStopClosesSockets(self):
+        # Сокеты пробуждения цикла закрываются при остановке сервера
+        server_client = start_test_server('threaded')
+        engine = server_client.engine
+        server_client.stop()
+        server_client.join(5)
+        self.assertEqual((engine.wakeup_reader.fileno(), engine.wakeup_writer.fileno()), (-1, -1))
+
+    def testThreadedPresence(self):
+        self.check_presence('threaded')
+
+    def testAsyncioPresence(self):
+        self.check_presence('asyncio')
+
+
+class TestMessageRouting(unittest.TestCase):
+    mode = 'threaded'
+
+    def setUp(self):
+        self.server_client = start_test_server(self.mode)
+        for name in ('Andrei', 'Sergei', 'Vadim'):
+            self.server_client.create_user(name, '123')
+        self.andrei = connect_user(self.server_client, 'Andrei', '123')
+        self.sergei = connect_user(self.server_client, 'Sergei', '123')
+        self.vadim = connect_user(self.server_client, 'Vadim', '123')
+
+    def tearDown(self):
+        for s in (self.andrei, self.sergei, self.vadim):
+            s.close()
+        self.server_client.stop()
+
+    def testDirectMessage(self):
+        send_frame(self.andrei, create_text_message('Andrei', 'Sergei', 'Привет'))
+        send_frame(self.andrei, create_text_message('Andrei', 'all', 'Всем привет'))
+
+        # Личное сообщение получает только адресат, сообщение all - все, кроме отправителя
+        self.assertEqual([m['message'] for m in read_frames(self.sergei, 2)], ['Привет', 'Всем привет'])
+        self.assertEqual([m['message'] for m in read_frames(self.vadim, 1)], ['Всем привет'])
+
+        fanout = self.server_client.message_fanout
+        self.assertEqual((fanout.count, fanout.sum), (2, 3))
+
+    def testServerEvents(self):
+        events = []
+        times = []
+        self.server_client.subscribe('message_saved', lambda *args: events.append(args[:3]))
+        self.server_client.subscribe('message_saved', lambda *args: times.append(args[3]))
+        self.server_client.subscribe('user_saved', lambda *args: events.append(args[1:]))
+        send_frame(self.andrei, create_text_message('Andrei', 'Sergei', 'Привет'))
+        read_frames(self.sergei, 1)
+        self.server_client.create_user('Oleg', '123', 'Новый')
+        self.assertEqual(events, [('Andrei', 'Sergei', 'Привет'), ('Oleg', 'Новый')])
+        # Событие передаёт время, сохранённое в истории
+        self.server_client.database.flush_history()
+        saved = self.server_client.database.get_messages_history(10)
+        self.assertEqual([m[3] for m in saved], [times[0]])
+
+    def testCoalescedBroadcasts(self):
+        messages = [create_text_message('Andrei', 'all', str(i)) for i in range(100)]
+        self.andrei.send(b''.join(encode_frame(json.dumps(m).encode('utf-8')) for m in messages))
+        self.assertEqual([m['message'] for m in read_frames(self.vadim, 100)], [str(i) for i in range(100)])
+
+    def testHistorySavedOnStop(self):
+        # История записывается потоком сервера пакетами и полностью сохраняется при остановке
+        for i in range(50):
+            send_frame(self.andrei, create_text_message('Andrei', 'Sergei', str(i)))
+        read_frames(self.sergei, 50)
+        self.server_client.stop()
+        self.server_client.join(5)
+
+        database = self.server_client.database
+        self.assertIsNone(database.history_writer)
+        self.assertEqual(sorted(int(m[2]) for m in database.get_messages_history(100)), list(range(50)))
+
+    def testHistoryPages(self):
+        for i in range(230):
+            if i % 2:
+                send_frame(self.sergei, create_text_message('Sergei', 'Andrei', str(i)))
+            else:
+                send_frame(self.andrei, create_text_message('Andrei', 'Sergei', str(i)))
+            send_frame(self.andrei, create_text_message('Andrei', 'Vadim', 'Другая переписка'))
+        read_frames(self.vadim, 230)
+        read_frames(self.andrei, 115)
+        read_frames(self.sergei, 115)
+        self.server_client.database.flush_history()
+
+        def get_history(before_id, frames):
+            send_frame(self.andrei, {
+                "action": "get_history",
+                "time": calendar.timegm(datetime.now(timezone.utc).utctimetuple()),
+                "contact": 'Sergei',
+                "before_id": before_id,
+                "limit": 150,
+            })
+            return read_frames(self.andrei, frames)
+
+        # Первая страница - два кадра, от новых сообщений к старым
+        first = get_history(None, 2)
+        self.assertEqual([(len(f['alert']), f['done']) for f in first], [(100, False), (50, True)])
+        self.assertTrue(first[-1]['more'])
+        last = get_history(first[-1]['cursor'], 1)[0]
+        self.assertEqual((len(last['alert']), last['done'], last['more']), (80, True, False))
+
+        rows = [row for f in first + [last] for row in f['alert']]
+        ids = [row[0] for row in rows]
+        self.assertEqual(ids, sorted(ids, reverse=True))
+        self.assertEqual(sorted(int(row[3]) for row in rows), list(range(230)))
+
+    def sync_history(self, sock, cursors, since, after_id=0, limit=10):
+        send_frame(sock, {
+            "action": "sync_history",
+            "time": calendar.timegm(datetime.now(timezone.utc).utctimetuple()),
+            "cursors": cursors,
+            "since": since,
+            "after_id": after_id,
+            "limit": limit,
+        })
+        frames = []
+        while not frames or not frames[-1]['done']:
+            frames.extend(read_frames(sock, 1))
+        return [row for f in frames for row in f['alert']], frames[-1]
+
+    def testHistorySync(self):
+        for i in range(10):
+            send_frame(self.andrei, create_text_message('Andrei', 'Sergei', f'a{i}'))
+        for i in range(3):
+            send_frame(self.vadim, create_text_message('Vadim', 'Sergei', f'v{i}'))
+        send_frame(self.andrei, create_text_message('Andrei', 'Vadim', 'Другая переписка'))
+        received = read_frames(self.sergei, 13)
+        read_frames(self.vadim, 1)
+        # Получатель узнаёт id сообщения в истории сервера
+        self.assertTrue(all(m['id'] for m in received))
+
+        # Первая синхронизация - вся история пользователя, страницами по limit сообщений
+        rows, last = self.sync_history(self.sergei, {}, 0)
+        self.assertEqual((len(rows), last['more']), (10, True))
+        more_rows, last = self.sync_history(self.sergei, {}, 0, last['cursor'])
+        self.assertEqual((len(more_rows), last['more']), (3, False))
+        rows += more_rows
+        self.assertEqual(sorted(row[0] for row in rows), sorted(m['id'] for m in received))
+        since = last['cursor']
+
+        # Повторная синхронизация передаёт только новые сообщения
+        send_frame(self.andrei, create_text_message('Andrei', 'Sergei', 'новое'))
+        new_id = read_frames(self.sergei, 1)[0]['id']
+        rows, last = self.sync_history(self.sergei, {}, since)
+        self.assertEqual([row[3] for row in rows], ['новое'])
+        rows, last = self.sync_history(self.sergei, {'Andrei': new_id}, since)
+        self.assertEqual(rows, [])
+
+        # Пропуск в переписке до since восстанавливается по cursors
+        andrei_ids = sorted(m['id'] for m in received if m['from'] == 'Andrei')
+        rows, last = self.sync_history(self.sergei, {'Andrei': andrei_ids[7], 'Vadim': since}, since)
+        self.assertEqual([row[0] for row in rows], andrei_ids[8:] + [new_id])
+        self.assertEqual(last['cursor'], new_id)
+
+    def testHistorySyncDoesNotBlock(self):
+        # Пока sync_history ждёт записи истории, сервер обрабатывает запросы других клиентов
+        database = self.server_client.database
+        flush_history = database.flush_history
+        written = threading.Event()
+        database.flush_history = lambda *args: (written.wait(5), flush_history(*args))
+        self.addCleanup(written.set)
+        send_frame(self.andrei, create_text_message('Andrei', 'Sergei', 'до синхронизации'))
+        read_frames(self.sergei, 1)
+        send_frame(self.sergei, {
+            "action": "sync_history",
+            "time": calendar.timegm(datetime.now(timezone.utc).utctimetuple()),
+            "since": 0,
+        })
+
+        send_frame(self.vadim, create_text_message('Vadim', 'Andrei', 'Привет'))
+        self.assertEqual(read_frames(self.andrei, 1)[0]['message'], 'Привет')
+        written.set()
+        response = read_frames(self.sergei, 1)[0]
+        self.assertEqual([row[3] for row in response['alert']], ['до синхронизации'])
+
+    def testMultipleSessions(self):
+        # Сообщение получают все сессии пользователя, отключение одной сессии не затрагивает остальные
+        sergei_second = connect_user(self.server_client, 'Sergei', '123')
+        send_frame(self.andrei, create_text_message('Andrei', 'Sergei', 'Привет'))
+        self.assertEqual(read_frames(self.sergei, 1)[0]['message'], 'Привет')
+        self.assertEqual(read_frames(sergei_second, 1)[0]['message'], 'Привет')
+
+        sessions = self.server_client.sessions
+        self.assertEqual(len(sessions.connections('Sergei')), 2)
+        sergei_second.close()
+        deadline = time.time() + 5
+        while len(sessions.connections('Sergei')) > 1 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(len(sessions.connections('Sergei')), 1)
+
+        send_frame(self.andrei, create_text_message('Andrei', 'Sergei', 'Ещё раз'))
+        self.assertEqual(read_frames(self.sergei, 1)[0]['message'], 'Ещё раз')
+
+    def wait_for(self, condition):
+        deadline = time.time() + 5
+        while not condition() and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(condition())
+
+    def check_offline_delivery(self, count):
+        pending = self.server_client.pending
+        self.sergei.close()
+        self.wait_for(lambda: 'Sergei' not in self.server_client.sessions)
+        for i in range(count):
+            send_frame(self.andrei, create_text_message('Andrei', 'Sergei', str(i)))
+        self.wait_for(lambda: pending.stored.get() == count)
+
+        # Сообщения, сохранённые пока пользователь не в сети, приходят после ответа на аутентификацию
+        self.sergei = socket(AF_INET, SOCK_STREAM)
+        self.sergei.settimeout(5)
+        self.sergei.connect(('localhost', self.server_client.port))
+        send_frame(self.sergei, {
+            "action": "authenticate",
+            "time": calendar.timegm(datetime.now(timezone.utc).utctimetuple()),
+            "user": {"account_name": 'Sergei', "password": '123'},
+        })
+        frames = read_frames(self.sergei, count + 1)
+        self.assertEqual(frames[0]['response'], 200)
+        messages = frames[1:]
+        self.assertEqual([m['message'] for m in messages], [str(i) for i in range(count)])
+        self.assertTrue(all(m['stored'] for m in messages))
+
+        # После подтверждения сообщения удаляются из очереди доставки
+        send_frame(self.sergei, {"action": "ack", "ids": [m['id'] for m in messages]})
+        self.wait_for(lambda: pending.acked.get() == count)
+        database = self.server_client.database
+        database.flush_history()
+        self.assertEqual(database.get_pending_messages('Sergei'), [])
+        self.assertEqual(pending.hot, {})
+
+    def testRequestIds(self):
+        # Каждый кадр ответа содержит request_id запроса, пересылаемое сообщение - нет.
+        # История читается в пуле потоков, поэтому её ответ может прийти после ответов на следующие запросы
+        now = calendar.timegm(datetime.now(timezone.utc).utctimetuple())
+        requests = [
+            {"action": "get_contacts", "time": now, "user_login": 'Andrei', "request_id": 1},
+            {"action": "get_history", "time": now, "contact": 'Sergei', "request_id": 2},
+            {"action": "add_contact", "time": now, "user_id": 'Andrei', "user_login": 'Sergei', "request_id": 3},
+            dict(create_text_message('Andrei', 'Sergei', 'Привет'), request_id=4),
+        ]
+        self.andrei.send(b''.join(encode_frame(json.dumps(r).encode('utf-8')) for r in requests))
+        self.assertEqual(sorted(f['request_id'] for f in read_frames(self.andrei, 3)), [1, 2, 3])
+        self.assertNotIn('request_id', read_frames(self.sergei, 1)[0])
+
+    def testBinaryCodec(self):
+        # Формат согласуется при аутентификации, остальные клиенты продолжают получать JSON
+        binary = socket(AF_INET, SOCK_STREAM)
+        binary.settimeout(5)
+        binary.connect(('localhost', self.server_client.port))
+        send_frame(binary, {
+            "action": "authenticate",
+            "time": calendar.timegm(datetime.now(timezone.utc).utctimetuple()),
+            "user": {"account_name": 'Sergei', "password": '123'},
+            "codec": 'binary',
+        })
+        buffer = FrameBuffer()
+        frames = []
+        while len(frames) < 1:
+            frames.extend(buffer.feed(binary.recv(1024)))
+        self.assertEqual(frames[0][:1], b'\xb1')
+        self.assertEqual(decode_message(frames[0])['codec'], 'binary')
+
+        binary.send(encode_frame(BINARY_CODEC.encode(create_text_message('Sergei', 'all', 'Всем привет'))))
+        self.assertEqual(read_frames(self.vadim, 1)[0]['message'], 'Всем привет')
+        send_frame(self.andrei, create_text_message('Andrei', 'all', 'Ответ'))
+        while len(frames) < 2:
+            frames.extend(buffer.feed(binary.recv(1024)))
+        self.assertEqual(frames[1][:1], b'\xb1')
+        self.assertEqual(decode_message(frames[1])['message'], 'Ответ')
+        self.assertEqual(read_frames(self.sergei, 2)[1]['message'], 'Ответ')
+        binary.close()
+
+    def testCompression(self):
+        # Сжатие согласуется при аутентификации, сжимаются только длинные сообщения
+        compressed = socket(AF_INET, SOCK_STREAM)
+        compressed.settimeout(5)
+        compressed.connect(('localhost', self.server_client.port))
+        send_frame(compressed, {
+            "action": "authenticate",
+            "time": calendar.timegm(datetime.now(timezone.utc).utctimetuple()),
+            "user": {"account_name": 'Sergei', "password": '123'},
+            "compression": 'zlib-dict',
+        })
+        self.assertEqual(read_frames(compressed, 1)[0]['compression'], 'zlib-dict')
+
+        long_message = 'Длинное сообщение. ' * 100
+        send_frame(self.andrei, create_text_message('Andrei', 'all', long_message))
+        data = b''
+        while len(data) < 4 or len(data) < 4 + (FRAME_HEADER.unpack_from(data)[0] & ~COMPRESSED_FLAG):
+            data += compressed.recv(65536)
+        self.assertTrue(FRAME_HEADER.unpack_from(data)[0] & COMPRESSED_FLAG)
+        self.assertEqual(decode_message(FrameBuffer().feed(data)[0])['message'], long_message)
+        self.assertEqual(read_frames(self.vadim, 1)[0]['message'], long_message)
+        compressed.close()
+
+        metrics = self.server_client.metrics
+        self.assertLess(metrics.get('chat_bytes_sent_total').get() + len(long_message),
+                        metrics.get('chat_bytes_sent_uncompressed_total').get())
+
+    def testOfflineDelivery(self):
+        self.check_offline_delivery(250)
+        self.assertEqual(self.server_client.database.get_pending_users(), set())
+
+    def testOfflineDeliveryFromDatabase(self):
+        # Сообщения сверх лимита памяти доставляются из базы
+        self.server_client.pending.hot_limit = 100
+        self.check_offline_delivery(250)
+
+    def testOfflineDeliveryToAllSessions(self):
+        # Недоставленные сообщения получают все сессии пользователя, подтверждение одной сессии удаляет их
+        pending = self.server_client.pending
+        self.sergei.close()
+        self.wait_for(lambda: 'Sergei' not in self.server_client.sessions)
+        for i in range(150):
+            send_frame(self.andrei, create_text_message('Andrei', 'Sergei', str(i)))
+        self.wait_for(lambda: pending.stored.get() == 150)
+
+        # Доставка начинается, когда подключены обе сессии
+        start = pending.start
+        pending.start = lambda conn: None
+        self.sergei = connect_user(self.server_client, 'Sergei', '123')
+        sergei_second = connect_user(self.server_client, 'Sergei', '123')
+        self.addCleanup(sergei_second.close)
+        pending.start = start
+        self.server_client.engine.call_soon_threadsafe(start, self.server_client.sessions.connections('Sergei')[0])
+
+        for sock in (self.sergei, sergei_second):
+            messages = read_frames(sock, 150)
+            self.assertEqual([m['message'] for m in messages], [str(i) for i in range(150)])
+        self.assertEqual(pending.delivered.get(), 150)
+        send_frame(sergei_second, {"action": "ack", "ids": [m['id'] for m in messages]})
+        self.wait_for(lambda: pending.acked.get() == 150)
+        self.assertEqual(pending.delivering, {})
+
+
+class TestMetricsEndpoint(unittest.TestCase):
+    def setUp(self):
+        self.server_client = start_test_server('threaded', metrics_port=0)
+        self.server_client.create_user('Andrei', '123')
+
+    def tearDown(self):
+        self.server_client.stop()
+
+    def testPrometheusText(self):
+        andrei = connect_user(self.server_client, 'Andrei', '123')
+        send_frame(andrei, {"action": "get_contacts", "time": 0, "user_login": 'Andrei'})
+        read_frames(andrei, 1)
+        send_frame(andrei, {"action": "unknown", "time": 0})
+        read_frames(andrei, 1)
+        andrei.close()
+
+        port = self.server_client.metrics_http.server_port
+        with urlopen(f'http://127.0.0.1:{port}/metrics', timeout=5) as response:
+            self.assertTrue(response.headers['Content-Type'].startswith('text/plain; version=0.0.4'))
+            text = response.read().decode('utf-8')
+        self.assertIn('chat_connections_total 1', text)
+        self.assertIn('chat_requests_total{action="get_contacts"} 1', text)
+        self.assertIn('chat_requests_total{action="other"} 1', text)
+        self.assertIn('chat_response_seconds_count{action="get_contacts"} 1', text)
+        self.assertIn('# TYPE chat_response_seconds histogram', text)
+        self.assertIn('# TYPE chat_user_cache_hits_total counter', text)
+        self.assertIn('# TYPE chat_user_cache_misses_total counter', text)
+        self.assertEqual(self.server_client.get_metrics_summary()['Запросы'], 3)
+        with self.assertRaises(HTTPError):
+            urlopen(f'http://127.0.0.1:{port}/', timeout=5)
+
+
+class TestMessageRoutingAsyncio(TestMessageRouting):
+    mode = 'asyncio'
+
+
+class TestAuthentication(unittest.TestCase):
+    mode = 'threaded'
+
+    def setUp(self):
+        self.server_client = start_test_server(self.mode)
+        self.server_client.create_user('Andrei', '123')
+        self.server_client.create_user('Sergei', '123')
+        self.sock = socket(AF_INET, SOCK_STREAM)
+        self.sock.settimeout(5)
+        self.sock.connect(('localhost', self.server_client.port))
+
+    def tearDown(self):
+        self.sock.close()
+        self.server_client.stop()
+
+    def authenticate_message(self, password):
+        return {
+            "action": "authenticate",
+            "time": calendar.timegm(datetime.now(timezone.utc).utctimetuple()),
+            "user": {
+                "account_name": 'Andrei',
+                "password": password,
+            }
+        }
+
+    def testDeferredRequests(self):
+        # Запрос, отправленный вместе с authenticate, обрабатывается после проверки пароля
+        self.server_client.database.add_contact('Andrei', 'Sergei')
+        get_contacts = {
+            "action": "get_contacts",
+            "time": calendar.timegm(datetime.now(timezone.utc).utctimetuple()),
+            "user_login": 'Andrei',
+        }
+        self.sock.send(encode_frame(json.dumps(self.authenticate_message('123')).encode('utf-8')) +
+                       encode_frame(json.dumps(get_contacts).encode('utf-8')))
+        responses = read_frames(self.sock, 2)
+        self.assertEqual(responses[0]['response'], 200)
+        self.assertEqual(responses[1]['alert'], ['Sergei'])
+        self.assertEqual(self.server_client.auth_queue_length, 0)
+
+    def testWrongPassword(self):
+        send_frame(self.sock, self.authenticate_message('321'))
+        self.assertEqual(read_frames(self.sock, 1)[0]['response'], 402)
+        self.assertEqual(self.server_client.auth_failures.get(), 1)
+
+    def testQueueLimit(self):
+        self.server_client.auth_queue_limit = 0
+        send_frame(self.sock, self.authenticate_message('123'))
+        self.assertEqual(read_frames(self.sock, 1)[0]['response'], 503)
+        self.assertEqual(self.server_client.auth_rejected.get(), 1)
+
+
+class TestAuthenticationAsyncio(TestAuthentication):
+    mode = 'asyncio'
+
+
+class StubConnection:
+    """Подключение, которое не отправляет данные"""
+    codec = JSON_CODEC
+    compression = None
+
+    def __init__(self):
+        self.frames = []
+        self.aborted = False
+
+    def send(self, data):
+        self.frames.append(data)
+
+    def queue_size(self):
+        return sum(len(f) for f in self.frames)
+
+    def abort(self):
+        self.aborted = True
+
+    def fileno(self):
+        return -1
+
+    def getpeername(self):
+        return 'stub'
+
+
+class TestBackpressure(unittest.TestCase):
+    def setUp(self):
+        self.server_client = server.ServerClient('localhost', 7777)
+        self.server_client.write_high_water = 250
+
+    def testDropLowPriority(self):
+        conn = StubConnection()
+        for _ in range(3):
+            self.server_client.deliver(conn, b'x' * 100, server.PRIORITY_LOW)
+        self.assertEqual(len(conn.frames), 2)
+        self.assertFalse(conn.aborted)
+        self.assertEqual(self.server_client.messages_dropped.get(), 1)
+
+    def testEvictSlowConsumer(self):
+        conn = StubConnection()
+        for _ in range(3):
+            self.server_client.deliver(conn, b'x' * 100)
+        self.assertTrue(conn.aborted)
+        self.assertEqual(self.server_client.slow_consumers_evicted.get(), 1)
+
+    def testEvictOverLiveSocket(self):
+        server_client = start_test_server('threaded')
+        server_client.write_high_water = 64 * 1024
+        for name in ('Andrei', 'Sergei'):
+            server_client.create_user(name, '123')
+        andrei = connect_user(server_client, 'Andrei', '123')
+        sergei = connect_user(server_client, 'Sergei', '123')
+
+        # Sergei не читает сокет: после заполнения буферов ядра очередь растёт до порога
+        message = create_text_message('Andrei', 'Sergei', 'x' * 10000)
+        frame = encode_frame(json.dumps(message).encode('utf-8'))
+        for _ in range(2000):
+            if server_client.slow_consumers_evicted.get():
+                break
+            andrei.send(frame * 10)
+        self.assertEqual(server_client.slow_consumers_evicted.get(), 1)
+        self.assertNotIn('Sergei', server_client.sessions)
+
+        andrei.close()
+        sergei.close()
+        server_client.stop()
+
+
+class TestClientConnection(unittest.TestCase):
+    def testPartialWrites(self):
+        engine = server_selector.SelectorServerEngine(None)
+        self.addCleanup(engine.close)
+        server_sock, client_sock = socketpair()
+        server_sock.setblocking(False)
+        conn = server_selector.ClientConnection(server_sock, 'test', engine)
+
+        frame = encode_frame(b'x' * 100000)
+        for _ in range(20):
+            conn.send(frame)
+        self.assertEqual(engine.dirty, [conn])
+
+        # Сокет не принимает всё сразу: остаток ждёт готовности к записи
+        received = bytearray()
+        while not conn.flush():
+            received += client_sock.recv(1000000)
+        client_sock.setblocking(False)
+        while len(received) < len(frame) * 20:
+            received += client_sock.recv(1000000)
+        self.assertEqual(FrameBuffer().feed(received), [b'x' * 100000] * 20)
+
+        conn.close()
+        client_sock.close()
+
+    def testFailingCallbacks(self):
+        # Ошибка функции, переданной в цикл, записывается в журнал и не прерывает выполнение остальных
+        engine = server_selector.SelectorServerEngine(None)
+        self.addCleanup(engine.close)
+        calls = []
+
+        def fail():
+            raise RuntimeError('Ошибка базы')
+
+        engine.call_later(0, fail)
+        engine.call_later(0, calls.append, 'call_later')
+        engine.call_soon_threadsafe(fail)
+        engine.call_soon_threadsafe(calls.append, 'call_soon_threadsafe')
+        with self.assertLogs('chat.server', 'ERROR') as logs:
+            engine.run_timers()
+            engine.wakeup()
+        self.assertEqual(calls, ['call_later', 'call_soon_threadsafe'])
+        self.assertEqual(len(logs.records), 2)
+
+
+class TestDatabaseQueries(unittest.TestCase):
+    """Количество SQL-запросов не должно зависеть от количества строк в результате"""
+    def setUp(self):
+        self.database = ServerDatabaseStorage('sqlite://')
+        for i in range(20):
+            self.database.add_user(f'User{i}', 'hash')
+        for i in range(1, 20):
+            self.database.add_contact('User0', f'User{i}')
+            self.database.save_messge_to_history('User0', f'User{i}', str(i))
+        self.statements = []
+        event.listen(self.database.db_engine, 'before_cursor_execute', self.count_statement)
+
+    def tearDown(self):
+        event.remove(self.database.db_engine, 'before_cursor_execute', self.count_statement)
+
+    def count_statement(self, conn, cursor, statement, *args):
+        self.statements.append(statement)
+
+    def testGetContacts(self):
+        contacts = self.database.get_contacts('User0')
+        self.assertEqual(contacts, tuple(f'User{i}' for i in range(1, 20)))
+        self.assertEqual(len(self.statements), 1)
+
+    def testGetMessagesHistory(self):
+        messages = self.database.get_messages_history(100)
+        self.assertEqual(sorted((m[0], m[1], m[2]) for m in messages),
+                         sorted(('User0', f'User{i}', str(i)) for i in range(1, 20)))
+        self.assertEqual(len(self.statements), 1)
+
+    def testGetUsersPage(self):
+        page = self.database.get_users_page(limit=5)
+        self.assertEqual([user[1] for user in page], [f'User{i}' for i in range(5)])
+        page = self.database.get_users_page(page[-1][0], 100)
+        self.assertEqual([user[1] for user in page], [f'User{i}' for i in range(5, 20)])
+        self.assertEqual(len(self.statements), 2)
+
+    def testUserCache(self):
+        # Повторный поиск пользователя не обращается к базе, изменение пользователя сбрасывает кэш
+        cache = self.database.user_cache
+        cache.invalidate()
+        hits, misses = cache.hits, cache.misses
+        for _ in range(10):
+            self.assertEqual(self.database.get_user('User1').name, 'User1')
+        self.assertEqual(len(self.statements), 1)
+        self.assertEqual((cache.hits - hits, cache.misses - misses), (9, 1))
+
+        self.database.update_user('User1', information='Администратор')
+        self.assertEqual(self.database.get_user('User1').information, 'Администратор')
+        self.assertIsNone(self.database.get_user_and_password('User1', 'wrong'))
+        self.assertIsNotNone(self.database.get_user_and_password('User1', 'hash'))
+
+
+class TestHistoryWriter(unittest.TestCase):
+    def testWaitWritten(self):
+        # Ожидание записи до id, назначенного к моменту запроса, не ждёт сообщений, поставленных позже
+        database = ServerDatabaseStorage('sqlite://')
+        database.add_user('Andrei', 'hash')
+        database.add_user('Sergei', 'hash')
+        database.start_history_writer(batch_interval=0.01)
+        self.addCleanup(database.stop_history_writer)
+        database.save_messge_to_history('Andrei', 'Sergei', 'Первое')
+        cursor = database.queued_message_id
+        database.flush_history(cursor)
+
+        writer = database.history_writer
+        write_batch = writer.write_batch
+        written = threading.Event()
+        self.addCleanup(written.set)
+        writer.write_batch = lambda batch: (written.wait(5), write_batch(batch))
+        database.save_messge_to_history('Andrei', 'Sergei', 'Второе')
+        start = time.perf_counter()
+        database.flush_history(cursor)
+        self.assertLess(time.perf_counter() - start, 1)
+        self.assertLess(writer.written_id, database.queued_message_id)
+
+        written.set()
+        database.flush_history(database.queued_message_id)
+        self.assertEqual(sorted(m[2] for m in database.get_messages_history(10)), ['Второе', 'Первое'])
+        self.assertEqual(writer.written_id, database.queued_message_id)
+
+
+class TestServerWindowModels(unittest.TestCase):
+    """Модели окна сервера читают базу страницами и обновляются по событиям без повторного чтения"""
+    def setUp(self):
+        self.database = ServerDatabaseStorage('sqlite://')
+        for i in range(25):
+            self.database.add_user(f'User{i}', 'hash')
+        self.statements = []
+        event.listen(self.database.db_engine, 'before_cursor_execute', self.count_statement)
+
+    def tearDown(self):
+        event.remove(self.database.db_engine, 'before_cursor_execute', self.count_statement)
+
+    def count_statement(self, conn, cursor, statement, *args):
+        self.statements.append(statement)
+
+    def testUsersPaging(self):
+        model = UsersTableModel(page_size=10)
+        model.set_database(self.database)
+        while model.canFetchMore():
+            model.fetchMore()
+        self.assertEqual(model.rowCount(), 25)
+        self.assertEqual(len(self.statements), 3)
+
+        user = self.database.add_user('Oleg', 'hash')
+        model.user_saved(user.id, 'Oleg', '')
+        model.user_saved(1, 'User0', 'Администратор')
+        self.assertEqual(model.rowCount(), 26)
+        self.assertEqual(model.data(model.index(25, 1)), 'Oleg')
+        self.assertEqual(model.data(model.index(0, 2)), 'Администратор')
+
+    def testMessagesLimit(self):
+        model = MessagesListModel(count=3)
+        model.set_database(self.database)
+        for i in range(5):
+            model.message_saved('User0', 'User1', str(i), datetime(2024, 1, 1))
+        self.assertEqual(model.rowCount(), 3)
+        self.assertEqual(model.data(model.index(0)), '(2024-01-01 00:00:00) User0 -> User1: 4')
+
+
+class TestSchemaUpgrade(unittest.TestCase):
+    def testUpgradeExistingDatabase(self):
+        # База, созданная предыдущей версией сервера: без индексов, с повторяющимися записями
+        path = os.path.join(tempfile.mkdtemp(), 'server_database.sqlite3')
+        connection = sqlite3.connect(path)
+        connection.executescript("""
+            CREATE TABLE users (id INTEGER PRIMARY KEY, name VARCHAR, password_hash VARCHAR, information VARCHAR);
+            CREATE TABLE history (id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL, time_login DATETIME,
+                                  ip_address VARCHAR);
+            CREATE TABLE contacts (id INTEGER PRIMARY KEY, user_owner INTEGER NOT NULL, user_contact INTEGER NOT NULL);
+            CREATE TABLE messages_history (id INTEGER PRIMARY KEY, user_id_from INTEGER NOT NULL,
+                                           user_id_to INTEGER NOT NULL, message VARCHAR, time_send DATETIME);
+            INSERT INTO users VALUES (1, 'Andrei', 'hash', ''), (2, 'Sergei', 'hash', ''), (3, 'Sergei', 'hash', '');
+            INSERT INTO contacts VALUES (1, 1, 2), (2, 1, 2), (3, 1, 3);
+            INSERT INTO messages_history VALUES (1, 1, 3, 'Привет', '2022-01-01 00:00:00');
+        """)
+        connection.commit()
+        connection.close()
+
+        database = ServerDatabaseStorage(f'sqlite:///{path}')
+        self.assertEqual(database.session.execute(text('PRAGMA user_version')).scalar(), SCHEMA_VERSION)
+        self.assertEqual(database.get_contacts('Andrei'), ('Sergei',))
+        self.assertEqual([m[:3] for m in database.get_messages_history()], [('Andrei', 'Sergei', 'Привет')])
+
+        indexes = {index['name'] for table in ('users', 'contacts', 'messages_history')
+                   for index in inspect(database.db_engine).get_indexes(table)}
+        self.assertTrue({'ix_users_name', 'ix_contacts_owner_contact', 'ix_messages_history_from_to_time',
+                         'ix_messages_history_time_send', 'ix_messages_history_from_to_id'} <= indexes)
+        plan = database.session.execute(text("EXPLAIN QUERY PLAN SELECT * FROM users WHERE name = 'Andrei'")).all()
+        self.assertIn('ix_users_name', str(plan))
+
+
 # Запустить тестирование
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,79 @@
+"""
+Нагрузочный тест: одновременное переподключение клиентов.
+
+Все клиенты одновременно отправляют authenticate. Во время шторма отдельный, уже авторизованный клиент
+запрашивает список контактов и измеряет время ответа: пока хэши паролей вычисляются в потоке сервера,
+его запросы ждут окончания всего шторма.
+
+Запуск: python bench_auth_storm.py [количество клиентов] [режим сервера]
+"""
+import selectors
+import sys
+import threading
+import time
+
+from bench_utils import FrameBuffer, start_server, create_users, connect, authenticate_frame, create_frame, \
+    request, get_time, percentile
+
+
+def probe(server_client, user_name, stop, latencies):
+    """Замер времени ответа на get_contacts во время шторма"""
+    sock = connect(server_client)
+    buffer = FrameBuffer()
+    request(sock, authenticate_frame(user_name), buffer)
+    frame = create_frame({"action": "get_contacts", "time": get_time(), "user_login": user_name})
+    while not stop.is_set():
+        start = time.perf_counter()
+        request(sock, frame, buffer)
+        latencies.append(time.perf_counter() - start)
+        time.sleep(0.01)
+    sock.close()
+
+
+def run_storm(clients, mode, auth_workers):
+    server_client = start_server(mode, auth_workers=auth_workers, auth_queue_limit=clients)
+    create_users(server_client, clients + 1)
+
+    socks = [connect(server_client) for _ in range(clients)]
+    stop = threading.Event()
+    latencies = []
+    probe_thread = threading.Thread(target=probe, args=(server_client, f'User{clients}', stop, latencies))
+    probe_thread.start()
+    time.sleep(0.1)
+
+    selector = selectors.DefaultSelector()
+    start = time.perf_counter()
+    for i, sock in enumerate(socks):
+        sock.sendall(authenticate_frame(f'User{i}'))
+        sock.setblocking(False)
+        selector.register(sock, selectors.EVENT_READ, FrameBuffer())
+
+    accepted = 0
+    waiting = clients
+    while waiting:
+        for key, _ in selector.select():
+            data = key.fileobj.recv(65536)
+            frames = key.data.feed(data)
+            if frames or not data:
+                accepted += bool(frames) and b'"response": 200' in frames[0]
+                waiting -= 1
+                selector.unregister(key.fileobj)
+    duration = time.perf_counter() - start
+
+    stop.set()
+    probe_thread.join()
+    for sock in socks:
+        sock.close()
+    server_client.stop()
+
+    print(f'{mode:8} auth_workers={auth_workers}: {clients} клиентов за {duration:.2f} с, успешно {accepted}, '
+          f'get_contacts во время шторма: медиана {percentile(latencies, 50) * 1000:.1f} мс, '
+          f'p99 {percentile(latencies, 99) * 1000:.1f} мс, максимум {max(latencies) * 1000:.1f} мс')
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    modes = sys.argv[2:] or ['threaded', 'asyncio']
+    for server_mode in modes:
+        run_storm(count, server_mode, 0)
+        run_storm(count, server_mode, 4)
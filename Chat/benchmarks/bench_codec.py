@@ -0,0 +1,63 @@
+"""
+Микротест: форматы сообщений JSON и двоичный.
+
+Для сообщений, которые создают методы MessangerClient.create_*_message, и для ответов сервера
+(пересылаемое сообщение, страница истории) измеряет размер и время сериализации и разбора.
+
+Запуск: python bench_codec.py [количество повторов]
+"""
+import os
+import sys
+import tempfile
+import timeit
+
+from bench_utils import BASE_DIR, get_time
+
+sys.path.insert(0, os.path.join(BASE_DIR, 'Client'))
+
+from common.codec import BINARY_CODEC, JSON_CODEC, decode_message
+
+
+def create_client():
+    # Клиент создаёт базу в текущем каталоге
+    os.chdir(tempfile.mkdtemp())
+    from client import MessangerClient
+    return MessangerClient('Andrei', '123')
+
+
+def get_messages(client):
+    rows = [[i, 'Andrei', 'Sergei', f'Сообщение {i}', get_time()] for i in range(100)]
+    return {
+        'presence': client.create_presence_message(),
+        'authenticate': client.create_authenticate_message(),
+        'msg': client.create_text_message('Sergei', 'Привет, как дела?'),
+        'get_contacts': client.create_get_contacts_message(),
+        'add_contact': client.create_add_contacts_message('Sergei'),
+        'sync_history': client.create_sync_history_message({'Sergei': 1000, 'Vadim': 2000}, 3000),
+        'ответ msg': dict(client.create_text_message('Andrei', 'Привет, как дела?'), id=123456),
+        'ответ 200': {"response": 200, "time": get_time(), "alert": 'Ok'},
+        'история 100': {"response": 202, "time": get_time(), "action": 'get_history', "contact": 'Sergei',
+                        "alert": rows, "cursor": 0, "done": True, "more": True},
+    }
+
+
+def measure(function, number):
+    return min(timeit.repeat(function, number=number, repeat=3)) * 1000000 / number
+
+
+def run(number):
+    print(f'{"сообщение":14} {"байт JSON":>10} {"двоичный":>9}  {"запись, мкс":>21}  {"разбор, мкс":>21}')
+    for name, message in get_messages(create_client()).items():
+        json_data = JSON_CODEC.encode(message)
+        binary_data = BINARY_CODEC.encode(message)
+        assert decode_message(binary_data) == decode_message(json_data)
+        times = [measure(lambda: JSON_CODEC.encode(message), number),
+                 measure(lambda: BINARY_CODEC.encode(message), number),
+                 measure(lambda: decode_message(json_data), number),
+                 measure(lambda: decode_message(binary_data), number)]
+        print(f'{name:14} {len(json_data):10} {len(binary_data):9}  '
+              f'{times[0]:9.2f} / {times[1]:9.2f}  {times[2]:9.2f} / {times[3]:9.2f}')
+
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
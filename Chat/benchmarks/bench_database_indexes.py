@@ -0,0 +1,84 @@
+"""
+Нагрузочный тест: поиск в базе данных сервера при росте истории сообщений.
+
+Для каждого размера истории измеряется время основных запросов с индексами схемы и без них
+(индексы удаляются после замера).
+
+Запуск: python bench_database_indexes.py [количество сообщений в самой большой истории]
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import bench_utils  # noqa: F401 (пути импорта модулей сервера)
+
+from sqlalchemy import desc, insert
+from server_database import ServerDatabaseStorage
+
+USERS = 10000
+REPEAT = 200
+
+
+def create_storage(messages):
+    db_dir = tempfile.mkdtemp()
+    database = ServerDatabaseStorage(f'sqlite:///{os.path.join(db_dir, "server_database.sqlite3")}')
+    users = database.Users.__table__
+    contacts = database.ContactList.__table__
+    history = database.MessagesHistory.__table__
+    start = datetime(2022, 1, 1)
+    rnd = random.Random(1)
+    with database.db_engine.begin() as connection:
+        connection.execute(insert(users), [{'name': f'User{i}', 'password_hash': 'hash', 'information': ''}
+                                           for i in range(USERS)])
+        connection.execute(insert(contacts), [{'user_owner': i + 1, 'user_contact': (i + j) % USERS + 1}
+                                              for i in range(USERS) for j in range(1, 6)])
+        for offset in range(0, messages, 100000):
+            connection.execute(insert(history), [
+                {'user_id_from': rnd.randrange(USERS) + 1, 'user_id_to': rnd.randrange(USERS) + 1,
+                 'message': f'Сообщение {i}', 'time_send': start + timedelta(seconds=i)}
+                for i in range(offset, min(offset + 100000, messages))])
+    return database
+
+
+def measure(function):
+    start = time.perf_counter()
+    for i in range(REPEAT):
+        function(i)
+    return (time.perf_counter() - start) / REPEAT * 1000
+
+
+def run_queries(database):
+    history = database.MessagesHistory
+    session = database.session
+    return {
+        'get_user': measure(lambda i: (database.user_cache.invalidate(), database.get_user(f'User{i * 37 % USERS}'))),
+        'контакт': measure(lambda i: session.query(database.ContactList)
+                           .filter_by(user_owner=i + 1, user_contact=i + 2).count()),
+        'переписка': measure(lambda i: session.query(history).filter_by(user_id_from=i + 1, user_id_to=i + 2)
+                             .order_by(desc(history.time_send)).limit(20).all()),
+        'история': measure(lambda i: database.get_messages_history(20)),
+        'страница get_history': measure(lambda i: list(database.get_conversation(f'User{i}', f'User{i + 1}',
+                                                                                 10 ** 9, 50))),
+    }
+
+
+def print_results(messages, indexed, results):
+    name = 'с индексами' if indexed else 'без индексов'
+    print(f'{messages:>8} сообщений, {name:12}: ' +
+          ', '.join(f'{query} {duration:.3f} мс' for query, duration in results.items()))
+
+
+if __name__ == '__main__':
+    largest = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    for count in (largest // 100, largest // 10, largest):
+        storage = create_storage(count)
+        print_results(count, True, run_queries(storage))
+        storage.session.commit()
+        with storage.db_engine.begin() as conn:
+            for table in storage.metadata.sorted_tables:
+                for index in table.indexes:
+                    index.drop(conn)
+        print_results(count, False, run_queries(storage))
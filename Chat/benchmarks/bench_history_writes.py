@@ -0,0 +1,49 @@
+"""
+Нагрузочный тест: сохранение истории сообщений.
+
+Сравнивает запись каждого сообщения отдельной транзакцией (как при вызове в потоке сервера)
+и отложенную запись пакетами в потоке HistoryWriter.
+
+Запуск: python bench_history_writes.py [количество сообщений]
+"""
+import os
+import sys
+import tempfile
+import time
+
+from bench_utils import server
+
+from server_database import ServerDatabaseStorage
+
+
+def create_storage():
+    db_dir = tempfile.mkdtemp()
+    database = ServerDatabaseStorage(f'sqlite:///{os.path.join(db_dir, "server_database.sqlite3")}')
+    password_hash = server.get_password_hash('123')
+    database.session.add_all(database.Users(f'User{i}', password_hash) for i in range(10))
+    database.session.commit()
+    return database
+
+
+def run(count, write_behind):
+    database = create_storage()
+    if write_behind:
+        database.start_history_writer()
+
+    start = time.perf_counter()
+    for i in range(count):
+        database.save_messge_to_history(f'User{i % 10}', f'User{(i + 1) % 10}', f'Сообщение {i}')
+    enqueued = time.perf_counter() - start
+    database.stop_history_writer()
+    duration = time.perf_counter() - start
+
+    saved = database.session.query(database.MessagesHistory).count()
+    name = 'пакетами' if write_behind else 'по одному'
+    print(f'{name:10}: {count} сообщений за {duration:.2f} с ({count / duration:.0f} сообщений/с), '
+          f'время в потоке сервера {enqueued * 1000000 / count:.1f} мкс на сообщение, сохранено {saved}')
+
+
+if __name__ == '__main__':
+    messages = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    run(messages, False)
+    run(messages, True)
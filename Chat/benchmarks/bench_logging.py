@@ -0,0 +1,113 @@
+"""
+Нагрузочный тест: журнал сервера на уровне DEBUG.
+
+Один клиент отправляет личные сообщения другому, измеряется время до получения последнего сообщения.
+Сравнивает работу без журнала DEBUG, запись журнала в потоке сервера (обработчик файла подключён к логгеру напрямую)
+и запись через очередь в потоке QueueListener, в том числе с выборочной записью содержимого запросов.
+Отдельно измеряется время вызова logger.debug в вызывающем потоке, в том числе при медленной записи
+(обработчик ждёт 1 мс каждые 100 записей, как при сбросе буфера на медленный диск).
+
+Запуск: python bench_logging.py [количество сообщений] [режим сервера]
+"""
+import itertools
+import logging
+import os
+import sys
+import tempfile
+import time
+import timeit
+
+from bench_utils import FrameBuffer, start_server, create_users, connect, authenticate_frame, create_frame, \
+    request, get_time
+
+import server_log_config
+from common.log_queue import start_queue_logging, stop_queue_logging
+
+logger = logging.getLogger('chat.server')
+
+
+def configure(variant):
+    """Обработчик файла журнала для варианта теста, возвращает функцию отключения"""
+    if variant == 'без DEBUG':
+        return lambda: None
+    file_handler = logging.FileHandler(os.path.join(tempfile.mkdtemp(), 'chat.server.log'), encoding='utf-8')
+    file_handler.setFormatter(server_log_config.formatter)
+    logger.setLevel(logging.DEBUG)
+    if variant == 'в потоке':
+        logger.addHandler(file_handler)
+        return lambda: (logger.removeHandler(file_handler), file_handler.close())
+    sample_rates = {'chat.server.messages': 100} if variant == 'выборочно' else None
+    queue_handler, listener = start_queue_logging(logger, (file_handler,), sample_rates=sample_rates)
+    return lambda: (stop_queue_logging(logger, queue_handler, listener), file_handler.close())
+
+
+class SlowFileHandler(logging.FileHandler):
+    """Файл журнала на медленном диске: каждая сотая запись ждёт 1 мс"""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.records = itertools.count(1)
+
+    def emit(self, record):
+        super().emit(record)
+        if next(self.records) % 100 == 0:
+            time.sleep(0.001)
+
+
+def measure_call(number, slow):
+    """Время вызова logger.debug в вызывающем потоке, мкс"""
+    handler_class = SlowFileHandler if slow else logging.FileHandler
+    times = []
+    for variant in ('в потоке', 'очередь'):
+        file_handler = handler_class(os.path.join(tempfile.mkdtemp(), 'chat.server.log'), encoding='utf-8')
+        file_handler.setFormatter(server_log_config.formatter)
+        logger.setLevel(logging.DEBUG)
+        if variant == 'в потоке':
+            logger.addHandler(file_handler)
+            stop_logging = lambda: logger.removeHandler(file_handler)
+        else:
+            queue_handler, listener = start_queue_logging(logger, (file_handler,), queue_size=number)
+            stop_logging = lambda: stop_queue_logging(logger, queue_handler, listener)
+        duration = timeit.timeit(lambda: logger.debug('Сообщение %s', 'текст'), number=number)
+        stop_logging()
+        file_handler.close()
+        logger.setLevel(logging.WARNING)
+        times.append(duration * 1000000 / number)
+    name = 'медленный диск' if slow else 'файл'
+    print(f'logger.debug, {name:14}: в потоке {times[0]:.1f} мкс, очередь {times[1]:.1f} мкс')
+
+
+def run(count, mode, variant):
+    server_client = start_server(mode)
+    create_users(server_client, 2)
+    sender, receiver = connect(server_client), connect(server_client)
+    request(sender, authenticate_frame('User0'))
+    request(receiver, authenticate_frame('User1'))
+    frames = b''.join(create_frame({"action": "msg", "time": get_time(), "to": 'User1', "from": 'User0',
+                                    "encoding": 'utf-8', "message": f'Сообщение {i}'}) for i in range(count))
+
+    stop_logging = configure(variant)
+    start = time.perf_counter()
+    sender.sendall(frames)
+    buffer = FrameBuffer()
+    received = 0
+    while received < count:
+        received += len(buffer.feed(receiver.recv(65536)))
+    duration = time.perf_counter() - start
+    stop_logging()
+    logger.setLevel(logging.WARNING)
+
+    print(f'{variant:10}: {count} сообщений за {duration:.2f} с ({count / duration:.0f} сообщений/с)')
+    sender.close()
+    receiver.close()
+    server_client.stop()
+
+
+if __name__ == '__main__':
+    messages = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    server_mode = sys.argv[2] if len(sys.argv) > 2 else 'threaded'
+    # Обработчики, установленные server_log_config, в тесте не используются
+    stop_queue_logging(logger, server_log_config.queue_handler, server_log_config.listener)
+    for name in ('без DEBUG', 'в потоке', 'очередь', 'выборочно'):
+        run(messages, server_mode, name)
+    measure_call(20000, False)
+    measure_call(20000, True)
@@ -0,0 +1,63 @@
+"""
+Нагрузочный тест: одновременное чтение и запись базы данных сервера.
+
+Поток записи сохраняет сообщения по одному (каждое своей транзакцией), поток чтения в это время
+запрашивает последние сообщения истории, как интерфейс сервера. Сравниваются настройки SQLite
+по умолчанию (журнал отката) и профиль common.storage.SQLITE_PROFILE.
+
+Запуск: python bench_storage_concurrency.py [длительность замера, с]
+"""
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from bench_utils import server
+
+from common.storage import SQLITE_PROFILE
+from server_database import ServerDatabaseStorage
+
+
+def run(duration, profile):
+    db_dir = tempfile.mkdtemp()
+    database = ServerDatabaseStorage(f'sqlite:///{os.path.join(db_dir, "server_database.sqlite3")}', profile=profile)
+    password_hash = server.get_password_hash('123')
+    for i in range(10):
+        database.add_user(f'User{i}', password_hash)
+
+    stop = threading.Event()
+    counts = {'запись': 0, 'чтение': 0}
+
+    def writer():
+        i = 0
+        while not stop.is_set():
+            database.save_messge_to_history(f'User{i % 10}', f'User{(i + 1) % 10}', f'Сообщение {i}')
+            counts['запись'] += 1
+            i += 1
+        database.session.remove()
+
+    def reader():
+        while not stop.is_set():
+            database.get_messages_history(20)
+            database.session.commit()
+            counts['чтение'] += 1
+        database.session.remove()
+
+    threads = [threading.Thread(target=writer), threading.Thread(target=reader)]
+    for thread in threads:
+        thread.start()
+    time.sleep(duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    database.db_engine.dispose()
+
+    name = 'WAL' if profile else 'по умолчанию'
+    print(f'{name:13}: ' + ', '.join(f'{operation} {count / duration:.0f} оп/с' for operation, count in counts.items()))
+
+
+if __name__ == '__main__':
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 5
+    run(seconds, {})
+    run(seconds, SQLITE_PROFILE)
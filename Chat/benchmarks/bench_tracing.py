@@ -0,0 +1,61 @@
+"""
+Микротест: стоимость декоратора трассировки вызовов.
+
+Сравнивает прежний декоратор log() (имя вызывающей функции через inspect.stack()) и common.tracing.trace
+при уровне логгера DEBUG и INFO, с записью времени выполнения в гистограмму и без неё.
+Записи журнала передаются обработчику, который их не сохраняет, поэтому измеряется только сам декоратор.
+
+Запуск: python bench_tracing.py [количество вызовов]
+"""
+import inspect
+import logging
+import sys
+import timeit
+from functools import wraps
+
+import bench_utils  # Пути к модулям проекта
+
+from common.metrics import MetricsRegistry
+from common.tracing import trace
+
+logger = logging.getLogger('bench.tracing')
+logger.addHandler(logging.NullHandler())
+logger.propagate = False
+
+
+def stack_log(func):
+    """Прежний декоратор log()"""
+    @wraps(func)
+    def decorated(*args, **kwargs):
+        logger.debug(f' Функция {func.__name__} вызвана из функции {inspect.stack()[1].function}')
+        res = func(*args, **kwargs)
+        return res
+    return decorated
+
+
+def function(value):
+    return value
+
+
+def measure(func, number):
+    return min(timeit.repeat(lambda: func(1), number=number, repeat=3)) * 1000000 / number
+
+
+def run(number):
+    registry = MetricsRegistry()
+    variants = {
+        'без декоратора': function,
+        'inspect.stack()': stack_log(function),
+        'trace': trace(logger)(function),
+        'trace, timed': trace(logger, timed=True, registry=registry)(function),
+    }
+    for level in (logging.DEBUG, logging.INFO):
+        logger.setLevel(level)
+        for name, func in variants.items():
+            # inspect.stack() читает исходный код модулей всего стека, поэтому вызовов меньше
+            count = max(number // 1000, 10) if name == 'inspect.stack()' else number
+            print(f'{logging.getLevelName(level):5} {name:16}: {measure(func, count):10.2f} мкс на вызов')
+
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
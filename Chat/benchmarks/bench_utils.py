@@ -0,0 +1,98 @@
+import calendar
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from socket import socket, AF_INET, SOCK_STREAM
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(BASE_DIR, 'Server'), BASE_DIR]
+
+from common.framing import FrameBuffer, encode_frame
+
+import server
+
+logging.getLogger('chat.server').setLevel(logging.WARNING)
+
+
+def get_free_port():
+    s = socket(AF_INET, SOCK_STREAM)
+    s.bind(('localhost', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def start_server(mode='threaded', **options):
+    """
+    Запуск сервера с временной базой данных на свободном порту
+
+    :param mode: режим работы сервера
+    :param options: атрибуты ServerClient, которые нужно изменить перед запуском
+    :return: экземпляр ServerClient
+    """
+    db_dir = tempfile.mkdtemp()
+    server_client = server.ServerClient('localhost', get_free_port(), mode)
+    server_client.set_database(f'sqlite:///{os.path.join(db_dir, "server_database.sqlite3")}')
+    for name, value in options.items():
+        setattr(server_client, name, value)
+    server_client.daemon = True
+    server_client.start()
+    for _ in range(0, 50):
+        if server_client.server_is_active:
+            break
+        time.sleep(0.1)
+    return server_client
+
+
+def create_users(server_client, count, password='123'):
+    """Добавление пользователей User0..UserN одной транзакцией"""
+    database = server_client.database
+    password_hash = server.get_password_hash(password)
+    database.session.add_all(database.Users(f'User{i}', password_hash) for i in range(count))
+    database.session.commit()
+
+
+def get_time():
+    return calendar.timegm(datetime.now(timezone.utc).utctimetuple())
+
+
+def create_frame(data):
+    return encode_frame(json.dumps(data).encode('utf-8'))
+
+
+def authenticate_frame(user_name, password='123'):
+    return create_frame({
+        "action": "authenticate",
+        "time": get_time(),
+        "user": {
+            "account_name": user_name,
+            "password": password,
+        }
+    })
+
+
+def connect(server_client):
+    s = socket(AF_INET, SOCK_STREAM)
+    s.connect(('localhost', server_client.port))
+    return s
+
+
+def request(sock, frame, buffer=None):
+    """Отправка запроса и ожидание одного кадра ответа"""
+    buffer = buffer or FrameBuffer()
+    sock.sendall(frame)
+    while True:
+        frames = buffer.feed(sock.recv(65536))
+        if frames:
+            return json.loads(frames[0].decode('utf-8'))
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
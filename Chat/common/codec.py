@@ -0,0 +1,289 @@
+import json
+import struct
+
+ACTIONS = ('presence', 'authenticate', 'msg', 'get_contacts', 'add_contact', 'del_contact', 'get_history',
+           'sync_history', 'ack')
+"""Коды действий двоичного формата: номер в кортеже + 1, 0 - действие передаётся строкой"""
+
+KEYS = ('time', 'type', 'user', 'account_name', 'status', 'password', 'to', 'from', 'encoding', 'message', 'id',
+        'stored', 'user_login', 'user_id', 'response', 'alert', 'codec', 'contact', 'before_id', 'limit', 'cursor',
+        'done', 'more', 'cursors', 'since', 'after_id', 'ids', 'action', 'request_id', 'compression')
+"""Коды ключей сообщений: номер в кортеже + 1, 0 - ключ передаётся строкой"""
+
+CONSTANTS = ('utf-8', 'all', 'Ok', 'status', 'online', 'json', 'binary')
+"""Часто встречающиеся строковые значения, передаются номером"""
+
+STRING_TABLE_LIMIT = 64
+"""Строки до этой длины (в байтах) попадают в таблицу строк кадра и повторно передаются номером"""
+
+BINARY_MARKER = 0xB1
+"""Первый байт кадра в двоичном формате. Кадр JSON начинается с символа {"""
+
+T_NONE, T_FALSE, T_TRUE, T_INT, T_NEGATIVE, T_FLOAT, T_STR, T_REF, T_CONST, T_LIST, T_DICT = range(11)
+
+FLOAT = struct.Struct('!d')
+
+ACTION_CODES = {action: code for code, action in enumerate(ACTIONS, 1)}
+KEY_CODES = {key: code for code, key in enumerate(KEYS, 1)}
+CONSTANT_CODES = {value: code for code, value in enumerate(CONSTANTS)}
+
+
+class JsonCodec:
+    """Сообщения в формате JSON (по умолчанию)"""
+    name = 'json'
+
+    @staticmethod
+    def encode(message):
+        """
+        Сериализация сообщения
+
+        :param message: сообщение (dict)
+        :return: содержимое кадра (bytes)
+        """
+        return json.dumps(message).encode('utf-8')
+
+    @staticmethod
+    def decode(data):
+        """
+        Разбор сообщения
+
+        :param data: содержимое кадра (bytes или str)
+        :return: сообщение (dict)
+        """
+        return json.loads(data)
+
+
+class BinaryCodec:
+    """
+    Компактный двоичный формат сообщений.
+
+    Кадр: байт BINARY_MARKER, код действия (varint), количество полей (varint) и поля. Ключ поля - код из KEYS
+    или 0 и строка. Значение - байт типа и данные: целые числа записываются varint, строки - длиной (varint)
+    и байтами UTF-8. Короткие строки (имена пользователей) нумеруются в порядке первого появления в кадре,
+    повторное появление передаётся номером, поэтому страница истории содержит каждое имя один раз.
+    """
+    name = 'binary'
+
+    @staticmethod
+    def write_varint(buffer, value):
+        while value > 0x7F:
+            buffer.append(value & 0x7F | 0x80)
+            value >>= 7
+        buffer.append(value)
+
+    def encode(self, message):
+        """
+        Сериализация сообщения
+
+        :param message: сообщение (dict)
+        :return: содержимое кадра (bytes)
+        """
+        buffer = bytearray((BINARY_MARKER,))
+        action = message.get('action')
+        code = ACTION_CODES.get(action) if isinstance(action, str) else None
+        if code:
+            self.write_varint(buffer, code)
+            self.write_dict(buffer, message, {}, skip='action')
+        else:
+            buffer.append(0)
+            self.write_dict(buffer, message, {})
+        return bytes(buffer)
+
+    def write_dict(self, buffer, data, strings, skip=None):
+        write_varint = self.write_varint
+        write_varint(buffer, len(data) - (skip in data))
+        for key, value in data.items():
+            if key == skip:
+                continue
+            code = KEY_CODES.get(key)
+            if code:
+                write_varint(buffer, code)
+            else:
+                buffer.append(0)
+                raw = str(key).encode('utf-8')
+                write_varint(buffer, len(raw))
+                buffer += raw
+            self.write_value(buffer, value, strings)
+
+    def write_value(self, buffer, value, strings):
+        value_type = type(value)
+        if value_type is str:
+            index = strings.get(value)
+            if index is not None:
+                buffer.append(T_REF)
+                if index < 0x80:
+                    buffer.append(index)
+                else:
+                    self.write_varint(buffer, index)
+                return
+            code = CONSTANT_CODES.get(value)
+            if code is not None:
+                buffer.append(T_CONST)
+                buffer.append(code)
+                return
+            raw = value.encode('utf-8')
+            length = len(raw)
+            if length < 0x80:
+                buffer.append(T_STR)
+                buffer.append(length)
+            else:
+                buffer.append(T_STR)
+                self.write_varint(buffer, length)
+            buffer += raw
+            if length <= STRING_TABLE_LIMIT:
+                strings[value] = len(strings)
+        elif value_type is int:
+            if 0 <= value < 0x80:
+                buffer.append(T_INT)
+                buffer.append(value)
+            elif value >= 0:
+                buffer.append(T_INT)
+                self.write_varint(buffer, value)
+            else:
+                buffer.append(T_NEGATIVE)
+                self.write_varint(buffer, -1 - value)
+        elif value is None:
+            buffer.append(T_NONE)
+        elif value is True:
+            buffer.append(T_TRUE)
+        elif value is False:
+            buffer.append(T_FALSE)
+        elif value_type is list or value_type is tuple:
+            buffer.append(T_LIST)
+            self.write_varint(buffer, len(value))
+            write_value = self.write_value
+            for item in value:
+                write_value(buffer, item, strings)
+        elif isinstance(value, dict):
+            buffer.append(T_DICT)
+            self.write_dict(buffer, value, strings)
+        elif isinstance(value, float):
+            buffer.append(T_FLOAT)
+            buffer += FLOAT.pack(value)
+        elif isinstance(value, int):
+            self.write_value(buffer, int(value), strings)
+        else:
+            raise TypeError(f'Тип {type(value).__name__} не поддерживается двоичным форматом')
+
+    def decode(self, data):
+        """
+        Разбор сообщения
+
+        :param data: содержимое кадра (bytes)
+        :return: сообщение (dict)
+        """
+        if not data or data[0] != BINARY_MARKER:
+            raise ValueError('Сообщение не в двоичном формате')
+        reader = BinaryReader(data)
+        reader.position = 1
+        code = reader.read_varint()
+        message = {'action': ACTIONS[code - 1]} if code else {}
+        message.update(reader.read_dict())
+        return message
+
+
+class BinaryReader:
+    """Разбор одного кадра двоичного формата"""
+    __slots__ = ('data', 'position', 'strings')
+
+    def __init__(self, data):
+        self.data = data
+        self.position = 0
+        self.strings = []
+
+    def read_varint(self):
+        data = self.data
+        position = self.position
+        byte = data[position]
+        position += 1
+        if byte < 0x80:
+            self.position = position
+            return byte
+        value = byte & 0x7F
+        shift = 7
+        while byte & 0x80:
+            byte = data[position]
+            position += 1
+            value |= (byte & 0x7F) << shift
+            shift += 7
+        self.position = position
+        return value
+
+    def read_string(self):
+        length = self.read_varint()
+        start = self.position
+        end = start + length
+        if end > len(self.data):
+            raise ValueError('Неполное сообщение')
+        value = self.data[start:end].decode('utf-8')
+        self.position = end
+        if length <= STRING_TABLE_LIMIT:
+            self.strings.append(value)
+        return value
+
+    def read_dict(self):
+        result = {}
+        read_varint = self.read_varint
+        read_value = self.read_value
+        for _ in range(read_varint()):
+            code = read_varint()
+            if code:
+                key = KEYS[code - 1]
+            else:
+                length = read_varint()
+                key = self.data[self.position:self.position + length].decode('utf-8')
+                self.position += length
+            result[key] = read_value()
+        return result
+
+    def read_value(self):
+        tag = self.data[self.position]
+        self.position += 1
+        if tag == T_STR:
+            return self.read_string()
+        if tag == T_INT:
+            return self.read_varint()
+        if tag == T_REF:
+            return self.strings[self.read_varint()]
+        if tag == T_CONST:
+            return CONSTANTS[self.read_varint()]
+        if tag == T_LIST:
+            read_value = self.read_value
+            return [read_value() for _ in range(self.read_varint())]
+        if tag == T_DICT:
+            return self.read_dict()
+        if tag == T_NONE:
+            return None
+        if tag == T_TRUE:
+            return True
+        if tag == T_FALSE:
+            return False
+        if tag == T_NEGATIVE:
+            return -1 - self.read_varint()
+        if tag == T_FLOAT:
+            value, = FLOAT.unpack_from(self.data, self.position)
+            self.position += FLOAT.size
+            return value
+        raise ValueError(f'Неизвестный тип значения {tag}')
+
+
+JSON_CODEC = JsonCodec()
+BINARY_CODEC = BinaryCodec()
+
+CODECS = {codec.name: codec for codec in (JSON_CODEC, BINARY_CODEC)}
+"""Поддерживаемые форматы сообщений по имени, которое клиент передаёт в presence/authenticate"""
+
+DEFAULT_CODEC = JSON_CODEC.name
+
+
+def decode_message(data):
+    """
+    Разбор сообщения в любом поддерживаемом формате. Формат определяется по первому байту,
+    поэтому кадры, отправленные до и после согласования формата, разбираются одинаково.
+
+    :param data: содержимое кадра (bytes или str)
+    :return: сообщение (dict)
+    """
+    if isinstance(data, (bytes, bytearray)) and data[:1] == bytes((BINARY_MARKER,)):
+        return BINARY_CODEC.decode(data)
+    return json.loads(data)
@@ -0,0 +1,89 @@
+import zlib
+
+COMPRESSION_THRESHOLD = 256
+"""Сообщения меньше этого размера (в байтах) отправляются без сжатия"""
+
+COMPRESSION_LEVEL = 6
+"""Уровень сжатия zlib: баланс между временем сжатия и размером"""
+
+PRESET_DICTIONARY = b''.join((
+    b'"get_history", "contact": "sync_history", "cursors": {}, "since": "after_id": "limit": ',
+    b'"add_contact", "user_id": "del_contact", "user_login": "get_contacts", ',
+    b'{"action": "presence", "time": "type": "status", "user": {"account_name": "status": "online"}}',
+    b'{"action": "authenticate", "time": "user": {"account_name": "password": }}',
+    b'"cursor": "done": true, "more": false}',
+    b'{"response": 200, "time": "alert": "Ok"}',
+    b'{"response": 202, "time": "action": "alert": [["',
+    b'{"action": "msg", "time": "to": "all", "from": "encoding": "utf-8", "message": "id": "stored": true}',
+))
+"""
+Общий словарь zlib: ключи и значения, которые есть в большинстве сообщений. Сжатые с ним сообщения
+короче даже при небольшом размере, словарь не меняется в течение подключения, поэтому каждый кадр
+распаковывается независимо от остальных.
+"""
+
+COMPRESSIONS = {
+    'zlib': None,
+    'zlib-dict': PRESET_DICTIONARY,
+}
+"""Поддерживаемые способы сжатия по имени, которое клиент передаёт в presence/authenticate, и их словари"""
+
+FDICT = 0x20
+"""Флаг заголовка zlib: сжатие выполнено со словарём"""
+
+
+class Compressor:
+    """Сжатие содержимого кадров одного способа (zlib без словаря или со словарём PRESET_DICTIONARY)"""
+    __slots__ = ('name', 'zdict', 'threshold', 'level')
+
+    def __init__(self, name, threshold=COMPRESSION_THRESHOLD, level=COMPRESSION_LEVEL):
+        """
+        Инициализация
+
+        :param name: способ сжатия из COMPRESSIONS
+        :param threshold: минимальный размер сжимаемого сообщения
+        :param level: уровень сжатия zlib
+        """
+        self.name = name
+        self.zdict = COMPRESSIONS[name]
+        self.threshold = threshold
+        self.level = level
+
+    def compress(self, payload):
+        """
+        Сжатие сообщения, если оно не меньше threshold и сжатие уменьшает размер
+
+        :param payload: сообщение (bytes)
+        :return: (данные, признак сжатия)
+        """
+        if len(payload) < self.threshold:
+            return payload, False
+        if self.zdict:
+            compressor = zlib.compressobj(self.level, zdict=self.zdict)
+        else:
+            compressor = zlib.compressobj(self.level)
+        data = compressor.compress(payload) + compressor.flush()
+        if len(data) >= len(payload):
+            return payload, False
+        return data, True
+
+
+def decompress(data, max_size):
+    """
+    Распаковка сжатого сообщения. Словарь определяется по заголовку zlib, поэтому кадры
+    распаковываются одинаково до и после согласования способа сжатия.
+
+    :param data: сжатое сообщение (bytes)
+    :param max_size: максимальный размер распакованного сообщения
+    :return: сообщение (bytes)
+    """
+    if len(data) > 1 and data[1] & FDICT:
+        decompressor = zlib.decompressobj(zdict=PRESET_DICTIONARY)
+    else:
+        decompressor = zlib.decompressobj()
+    payload = decompressor.decompress(data, max_size)
+    if decompressor.unconsumed_tail:
+        raise ValueError(f'Размер распакованного кадра превышает допустимый {max_size}')
+    if not decompressor.eof:
+        raise ValueError('Неполное сжатое сообщение')
+    return payload
@@ -0,0 +1,73 @@
+import struct
+
+from common.compression import decompress
+
+FRAME_HEADER = struct.Struct('!I')
+"""Заголовок кадра: длина полезной нагрузки, 4 байта в сетевом порядке"""
+
+COMPRESSED_FLAG = 0x80000000
+"""Старший бит заголовка: полезная нагрузка сжата zlib"""
+
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+"""Максимальный размер полезной нагрузки кадра"""
+
+
+def encode_frame(payload, compressed=False):
+    """
+    Упаковка сообщения в кадр с префиксом длины
+
+    :param payload: сообщение (bytes)
+    :param compressed: сообщение сжато zlib
+    :return: кадр (bytes)
+    """
+    return FRAME_HEADER.pack(len(payload) | COMPRESSED_FLAG if compressed else len(payload)) + payload
+
+
+class FrameBuffer:
+    """
+    Буфер сборки кадров одного подключения.
+
+    Принимает данные в том виде, в котором они пришли из сокета: собирает кадры, разделённые между
+    несколькими recv, и разделяет несколько кадров, пришедших одним блоком. Сжатые кадры распаковываются.
+    """
+    __slots__ = ('buffer', 'max_frame_size')
+
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE):
+        """
+        Инициализация буфера
+
+        :param max_frame_size: максимальный допустимый размер кадра
+        """
+        self.buffer = bytearray()
+        self.max_frame_size = max_frame_size
+
+    def feed(self, data):
+        """
+        Добавление полученных данных в буфер
+
+        :param data: данные из сокета (bytes)
+        :return: список полностью собранных сообщений (bytes)
+        """
+        buffer = self.buffer
+        buffer += data
+        frames = []
+        offset = 0
+        while len(buffer) - offset >= FRAME_HEADER.size:
+            header, = FRAME_HEADER.unpack_from(buffer, offset)
+            length = header & ~COMPRESSED_FLAG
+            if length > self.max_frame_size:
+                raise ValueError(f'Размер кадра {length} превышает допустимый {self.max_frame_size}')
+            end = offset + FRAME_HEADER.size + length
+            if len(buffer) < end:
+                break
+            payload = bytes(buffer[offset + FRAME_HEADER.size:end])
+            if header & COMPRESSED_FLAG:
+                payload = decompress(payload, self.max_frame_size)
+            frames.append(payload)
+            offset = end
+        if offset:
+            del buffer[:offset]
+        return frames
+
+    def __len__(self):
+        return len(self.buffer)
@@ -0,0 +1,97 @@
+import atexit
+import itertools
+import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
+
+LOG_QUEUE_SIZE = 10000
+"""Максимальное количество записей журнала, ожидающих записи в файл"""
+
+
+class DroppingQueueHandler(QueueHandler):
+    """
+    Передача записей журнала в очередь без ожидания. Файлы и консоль пишет поток QueueListener,
+    поэтому поток сервера не выполняет операций ввода-вывода. Если очередь заполнена,
+    запись отбрасывается и учитывается в счётчике dropped.
+    """
+    def __init__(self, queue_size=LOG_QUEUE_SIZE):
+        """
+        :param queue_size: размер очереди записей
+        """
+        super().__init__(queue.SimpleQueue())
+        self.queue_size = queue_size
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Запись передаётся в другой поток: параметры подставляются сразу, пока объекты не изменились.
+        # Остальное форматирование (время, уровень) выполняют обработчики в потоке записи.
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        # Размер очереди проверяется без блокировки: при одновременной записи из нескольких потоков
+        # очередь может превысить queue_size на количество этих потоков
+        if self.queue.qsize() < self.queue_size:
+            self.queue.put_nowait(record)
+        else:
+            self.dropped += 1
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Выборочная запись частых сообщений: из записей логгеров, указанных в rates, пропускается
+    каждая N-я запись. Записи уровня WARNING и выше пропускаются всегда.
+    """
+    def __init__(self, rates):
+        """
+        :param rates: словарь {имя логгера: N}
+        """
+        super().__init__()
+        self.counters = {name: itertools.count() for name in rates}
+        self.rates = dict(rates)
+
+    def filter(self, record):
+        counter = self.counters.get(record.name)
+        if counter is None or record.levelno >= logging.WARNING:
+            return True
+        return next(counter) % self.rates[record.name] == 0
+
+
+def start_queue_logging(logger, handlers, queue_size=LOG_QUEUE_SIZE, sample_rates=None):
+    """
+    Перевод логгера на запись через очередь: обработчики handlers вызываются в потоке QueueListener,
+    при завершении программы оставшиеся записи дописываются.
+
+    :param logger: логгер
+    :param handlers: обработчики (файл, консоль), уровень каждого обработчика учитывается
+    :param queue_size: размер очереди записей
+    :param sample_rates: словарь {имя логгера: N} для выборочной записи частых сообщений
+    :return: (обработчик очереди, поток записи)
+    """
+    queue_handler = DroppingQueueHandler(queue_size)
+    if sample_rates:
+        queue_handler.addFilter(SamplingFilter(sample_rates))
+    listener = QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+    logger.addHandler(queue_handler)
+    listener.start()
+    atexit.register(stop_queue_logging, logger, queue_handler, listener)
+    return queue_handler, listener
+
+
+def stop_queue_logging(logger, queue_handler, listener):
+    """
+    Запись оставшихся в очереди записей и отключение очереди от логгера
+
+    :return: Не возвращает значений
+    """
+    if queue_handler not in logger.handlers:
+        return  # Уже остановлено
+    logger.removeHandler(queue_handler)
+    if queue_handler.dropped:
+        queue_handler.queue.put(logger.makeRecord(logger.name, logging.WARNING, __file__, 0,
+                                                  f'Отброшено записей журнала: {queue_handler.dropped}', None, None))
+    listener.stop()
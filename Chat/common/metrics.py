@@ -0,0 +1,245 @@
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+"""Границы интервалов гистограммы по умолчанию (секунды)"""
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+"""Тип содержимого текстового формата Prometheus"""
+
+
+class Counter:
+    """Счётчик: значение только увеличивается. Может вычисляться функцией при чтении (счётчик другого объекта)."""
+    __slots__ = ('name', 'labels', 'value', 'function')
+    type_name = 'counter'
+
+    def __init__(self, name, labels, function=None):
+        self.name = name
+        self.labels = labels
+        self.value = 0
+        self.function = function
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def get(self):
+        return self.function() if self.function else self.value
+
+
+class Gauge:
+    """Текущее значение. Может задаваться явно или вычисляться функцией при чтении."""
+    __slots__ = ('name', 'labels', 'value', 'function')
+    type_name = 'gauge'
+
+    def __init__(self, name, labels, function=None):
+        self.name = name
+        self.labels = labels
+        self.value = 0
+        self.function = function
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def get(self):
+        return self.function() if self.function else self.value
+
+
+class Histogram:
+    """Распределение значений по интервалам с фиксированными границами"""
+    __slots__ = ('name', 'labels', 'buckets', 'counts', 'sum', 'count')
+    type_name = 'histogram'
+
+    def __init__(self, name, labels, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def get(self):
+        return self.count
+
+
+class MetricsRegistry:
+    """
+    Реестр метрик.
+
+    Метрика создаётся один раз и дальше обновляется напрямую, без поиска в реестре,
+    поэтому обновление в горячем пути стоит одну арифметическую операцию.
+    """
+    def __init__(self):
+        self.metrics = {}
+        self.documentation = {}
+
+    def _get_or_create(self, metric_class, name, documentation, labels, **kwargs):
+        key = (name, tuple(sorted(labels.items())))
+        metric = self.metrics.get(key)
+        if metric is None:
+            metric = metric_class(name, key[1], **kwargs)
+            self.metrics[key] = metric
+            self.documentation.setdefault(name, documentation)
+        elif not isinstance(metric, metric_class):
+            raise ValueError(f'Метрика {name} уже зарегистрирована с типом {metric.type_name}')
+        return metric
+
+    def counter(self, name, documentation='', function=None, **labels):
+        """
+        Получение (создание) счётчика
+
+        :param name: имя метрики
+        :param documentation: описание метрики
+        :param function: функция без аргументов, возвращающая неубывающее значение при чтении
+        :param labels: метки
+        :return: Counter
+        """
+        counter = self._get_or_create(Counter, name, documentation, labels)
+        if function:
+            counter.function = function
+        return counter
+
+    def gauge(self, name, documentation='', function=None, **labels):
+        """
+        Получение (создание) текущего значения
+
+        :param name: имя метрики
+        :param documentation: описание метрики
+        :param function: функция без аргументов, вычисляющая значение при чтении
+        :param labels: метки
+        :return: Gauge
+        """
+        gauge = self._get_or_create(Gauge, name, documentation, labels)
+        if function:
+            gauge.function = function
+        return gauge
+
+    def histogram(self, name, documentation='', buckets=DEFAULT_BUCKETS, **labels):
+        """
+        Получение (создание) гистограммы
+
+        :param name: имя метрики
+        :param documentation: описание метрики
+        :param buckets: границы интервалов
+        :param labels: метки
+        :return: Histogram
+        """
+        return self._get_or_create(Histogram, name, documentation, labels, buckets=buckets)
+
+    def get(self, name, **labels):
+        """
+        Поиск метрики
+
+        :param name: имя метрики
+        :param labels: метки
+        :return: метрика или None
+        """
+        return self.metrics.get((name, tuple(sorted(labels.items()))))
+
+    def render(self):
+        """
+        Метрики реестра в текстовом формате Prometheus
+
+        :return: str
+        """
+        return render(self)
+
+
+def format_labels(labels, extra=()):
+    labels = tuple(labels) + tuple(extra)
+    if not labels:
+        return ''
+    items = (f'{name}="{format_label_value(value)}"' for name, value in labels)
+    return '{' + ','.join(items) + '}'
+
+
+def format_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def render(*registries):
+    """
+    Метрики нескольких реестров в текстовом формате Prometheus. Метрики с одним именем
+    выводятся одной группой с общими HELP и TYPE.
+
+    :param registries: реестры MetricsRegistry
+    :return: str
+    """
+    groups = {}
+    documentation = {}
+    for registry in registries:
+        for metric in list(registry.metrics.values()):
+            groups.setdefault(metric.name, []).append(metric)
+        for name, text in list(registry.documentation.items()):
+            documentation.setdefault(name, text)
+
+    lines = []
+    for name in sorted(groups):
+        metrics = groups[name]
+        help_text = documentation.get(name, '').replace('\\', '\\\\').replace('\n', '\\n')
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {metrics[0].type_name}')
+        for metric in metrics:
+            if isinstance(metric, Histogram):
+                cumulative = 0
+                for bound, count in zip(metric.buckets + (float('inf'),), list(metric.counts)):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{format_labels(metric.labels, (("le", format_value(bound)),))} '
+                                 f'{cumulative}')
+                lines.append(f'{name}_sum{format_labels(metric.labels)} {format_value(metric.sum)}')
+                lines.append(f'{name}_count{format_labels(metric.labels)} {metric.count}')
+            else:
+                lines.append(f'{name}{format_labels(metric.labels)} {format_value(metric.get())}')
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    """Ответ на GET /metrics: метрики в текстовом формате Prometheus"""
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # Запросы сборщика метрик не записываются в журнал
+
+
+def start_http_server(render_function, addr='127.0.0.1', port=0):
+    """
+    Запуск HTTP-сервера метрик в отдельном потоке. По умолчанию сервер доступен только локально.
+
+    :param render_function: функция без аргументов, возвращающая метрики в текстовом формате
+    :param addr: адрес
+    :param port: порт, 0 - любой свободный
+    :return: ThreadingHTTPServer, остановка - shutdown() и server_close()
+    """
+    http_server = ThreadingHTTPServer((addr, port), MetricsRequestHandler)
+    http_server.daemon_threads = True
+    http_server.render = render_function
+    threading.Thread(target=http_server.serve_forever, name='metrics-http', daemon=True).start()
+    return http_server
@@ -0,0 +1,63 @@
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy.pool import StaticPool
+
+SQLITE_PROFILE = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'mmap_size': 256 * 1024 * 1024,
+    'cache_size': -64 * 1024,
+    'busy_timeout': 5000,
+}
+"""
+Настройки SQLite по умолчанию: журнал WAL (чтение не блокирует запись), синхронизация с диском
+только при контрольных точках журнала, отображение файла в память 256 МБ, кэш страниц 64 МБ,
+ожидание блокировки до 5 секунд
+"""
+
+
+def create_storage_engine(connection_string, echo=False, profile=None):
+    """
+    Создание подключения к базе данных с настройками производительности.
+
+    Для файла SQLite используется пул соединений: каждый поток работает со своим соединением,
+    настройки profile применяются к каждому новому соединению. База в памяти существует только
+    в одном соединении, поэтому оно общее для всех потоков.
+
+    :param connection_string: строка подключения
+    :param echo: вывод подробной информации о взаимодействии с БД
+    :param profile: настройки SQLite (PRAGMA), None - SQLITE_PROFILE, пустой словарь - без настроек
+    :return: Engine
+    """
+    if profile is None:
+        profile = SQLITE_PROFILE
+    if not connection_string.startswith('sqlite'):
+        return create_engine(connection_string, echo=echo)
+
+    in_memory = connection_string.rstrip('/') in ('sqlite:', 'sqlite+pysqlite:') or ':memory:' in connection_string
+    if in_memory:
+        engine = create_engine(connection_string, echo=echo, poolclass=StaticPool,
+                               connect_args={'check_same_thread': False})
+        profile = {name: value for name, value in profile.items() if name not in ('journal_mode', 'mmap_size')}
+    else:
+        engine = create_engine(connection_string, echo=echo, connect_args={'check_same_thread': False})
+
+    if profile:
+        @event.listens_for(engine, 'connect')
+        def set_sqlite_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            for name, value in profile.items():
+                cursor.execute(f'PRAGMA {name} = {value}')
+            cursor.close()
+
+    return engine
+
+
+def create_session(engine):
+    """
+    Сессия, отдельная для каждого потока (сервера, интерфейса), с общим интерфейсом Session
+
+    :param engine: Engine
+    :return: scoped_session
+    """
+    return scoped_session(sessionmaker(bind=engine))
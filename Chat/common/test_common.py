@@ -0,0 +1,269 @@
+import logging
+import os
+import tempfile
+import threading
+import unittest
+
+from sqlalchemy import text
+
+from common.codec import BINARY_CODEC, JSON_CODEC, decode_message
+from common.compression import Compressor
+from common.framing import FrameBuffer, encode_frame, FRAME_HEADER, COMPRESSED_FLAG
+from common.log_queue import DroppingQueueHandler, SamplingFilter, start_queue_logging, stop_queue_logging
+from common.metrics import MetricsRegistry, render
+from common.storage import create_storage_engine, create_session
+from common.tracing import trace
+
+
+class TestFrameBuffer(unittest.TestCase):
+    def testSingleFrame(self):
+        buffer = FrameBuffer()
+        self.assertEqual(buffer.feed(encode_frame(b'{"action": "presence"}')), [b'{"action": "presence"}'])
+        self.assertEqual(len(buffer), 0)
+
+    def testPartialFrame(self):
+        buffer = FrameBuffer()
+        frame = encode_frame('Привет'.encode('utf-8'))
+        self.assertEqual(buffer.feed(frame[:2]), [])
+        self.assertEqual(buffer.feed(frame[2:7]), [])
+        self.assertEqual(buffer.feed(frame[7:]), ['Привет'.encode('utf-8')])
+
+    def testPipelinedFrames(self):
+        buffer = FrameBuffer()
+        frames = [b'one', b'', b'three' * 1000]
+        data = b''.join(encode_frame(f) for f in frames)
+        self.assertEqual(buffer.feed(data + encode_frame(b'four')[:5]), frames)
+        self.assertEqual(buffer.feed(b'our'), [b'four'])
+
+    def testFrameTooLarge(self):
+        buffer = FrameBuffer(max_frame_size=10)
+        self.assertRaises(ValueError, buffer.feed, FRAME_HEADER.pack(11))
+
+
+class TestCompression(unittest.TestCase):
+    def testCompressedFrames(self):
+        payload = b'{"response": 202, "alert": ["' + b'", "'.join(b'User%d' % i for i in range(200)) + b'"]}'
+        for name in ('zlib', 'zlib-dict'):
+            data, compressed = Compressor(name).compress(payload)
+            self.assertTrue(compressed)
+            self.assertLess(len(data), len(payload) // 3)
+            frame = encode_frame(data, compressed)
+            self.assertTrue(FRAME_HEADER.unpack_from(frame)[0] & COMPRESSED_FLAG)
+            self.assertEqual(FrameBuffer().feed(frame + encode_frame(b'short')), [payload, b'short'])
+
+    def testThreshold(self):
+        # Короткие сообщения отправляются без сжатия
+        self.assertEqual(Compressor('zlib-dict').compress(b'{"response": 200}'), (b'{"response": 200}', False))
+
+    def testDecompressedSizeLimit(self):
+        data, compressed = Compressor('zlib').compress(b' ' * 10000)
+        with self.assertRaises(ValueError):
+            FrameBuffer(max_frame_size=1000).feed(encode_frame(data, compressed))
+
+
+class TestCodec(unittest.TestCase):
+    def testRoundTrip(self):
+        messages = [
+            {"action": "msg", "time": 1700000000, "to": "Sergei", "from": "Andrei", "encoding": 'utf-8',
+             "message": 'Привет' * 50, "id": 300, "stored": True},
+            {"response": 202, "alert": ['Andrei', 'Sergei'], "codec": 'binary'},
+            {"action": "custom", "extra": [None, False, -1, 2.5, 2 ** 70, {"nested": ''}], "ids": []},
+        ]
+        for message in messages:
+            self.assertEqual(decode_message(BINARY_CODEC.encode(message)), message)
+            self.assertEqual(decode_message(JSON_CODEC.encode(message)), message)
+
+    def testStringTable(self):
+        # Повторяющиеся имена передаются в кадре один раз
+        rows = [[i, 'Andrei', 'Sergei', str(i), 1700000000 + i] for i in range(100)]
+        data = BINARY_CODEC.encode({"action": "get_history", "alert": rows})
+        self.assertEqual(data.count(b'Andrei'), 1)
+        self.assertLess(len(data), len(JSON_CODEC.encode({"action": "get_history", "alert": rows})) // 2)
+        self.assertEqual(decode_message(data)['alert'], rows)
+
+
+class TestMetricsRegistry(unittest.TestCase):
+    def testCounterLabels(self):
+        registry = MetricsRegistry()
+        registry.counter('requests_total', 'Запросы', action='msg').inc()
+        registry.counter('requests_total', 'Запросы', action='msg').inc(2)
+        registry.counter('requests_total', 'Запросы', action='presence').inc()
+        self.assertEqual(registry.get('requests_total', action='msg').get(), 3)
+        self.assertEqual(registry.get('requests_total', action='presence').get(), 1)
+
+    def testCounterFunction(self):
+        registry = MetricsRegistry()
+        source = {'hits': 5}
+        counter = registry.counter('hits_total', 'Попадания', function=lambda: source['hits'])
+        source['hits'] += 1
+        self.assertEqual(counter.get(), 6)
+
+    def testGaugeFunction(self):
+        registry = MetricsRegistry()
+        queue = [1, 2, 3]
+        gauge = registry.gauge('queue_depth', 'Глубина очереди', function=lambda: len(queue))
+        queue.append(4)
+        self.assertEqual(gauge.get(), 4)
+
+    def testHistogramBuckets(self):
+        histogram = MetricsRegistry().histogram('fanout', 'Получатели', buckets=(1, 10))
+        for value in (0, 1, 5, 100):
+            histogram.observe(value)
+        self.assertEqual(histogram.counts, [2, 1, 1])
+        self.assertEqual((histogram.count, histogram.sum), (4, 106))
+
+    def testRender(self):
+        registry = MetricsRegistry()
+        registry.counter('requests_total', 'Запросы', action='m"sg').inc(2)
+        registry.histogram('latency_seconds', 'Время', buckets=(0.1, 1)).observe(0.5)
+        tracing = MetricsRegistry()
+        tracing.gauge('queue_depth', 'Глубина очереди').set(1.5)
+        self.assertEqual(render(registry, tracing).splitlines(), [
+            '# HELP latency_seconds Время',
+            '# TYPE latency_seconds histogram',
+            'latency_seconds_bucket{le="0.1"} 0',
+            'latency_seconds_bucket{le="1"} 1',
+            'latency_seconds_bucket{le="+Inf"} 1',
+            'latency_seconds_sum 0.5',
+            'latency_seconds_count 1',
+            '# HELP queue_depth Глубина очереди',
+            '# TYPE queue_depth gauge',
+            'queue_depth 1.5',
+            '# HELP requests_total Запросы',
+            '# TYPE requests_total counter',
+            'requests_total{action="m\\"sg"} 2',
+        ])
+
+    def testTypeConflict(self):
+        registry = MetricsRegistry()
+        registry.counter('value')
+        self.assertRaises(ValueError, registry.gauge, 'value')
+
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.messages = []
+        self.records = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+        self.records.append(record)
+
+
+class TestLogQueue(unittest.TestCase):
+    def setUp(self):
+        self.logger = logging.getLogger('test.log_queue')
+        self.logger.setLevel(logging.DEBUG)
+        self.logger.propagate = False
+        self.handler = ListHandler()
+
+    def testListener(self):
+        # Записи передаются обработчику в потоке записи, при остановке очередь дописывается
+        queue_handler, listener = start_queue_logging(self.logger, (self.handler,))
+        for i in range(100):
+            self.logger.debug('Сообщение %d', i)
+        stop_queue_logging(self.logger, queue_handler, listener)
+        self.assertEqual(self.handler.messages, [f'Сообщение {i}' for i in range(100)])
+        self.assertNotIn(queue_handler, self.logger.handlers)
+
+    def testDroppedRecords(self):
+        # Без потока записи очередь заполняется, лишние записи отбрасываются без ожидания
+        queue_handler = DroppingQueueHandler(10)
+        self.logger.addHandler(queue_handler)
+        for i in range(15):
+            self.logger.info('Сообщение %d', i)
+        self.logger.removeHandler(queue_handler)
+        self.assertEqual((queue_handler.queue.qsize(), queue_handler.dropped), (10, 5))
+
+    def testSampling(self):
+        sampled = logging.getLogger('test.log_queue.sampled')
+        self.handler.addFilter(SamplingFilter({'test.log_queue.sampled': 10}))
+        self.logger.addHandler(self.handler)
+        for i in range(100):
+            sampled.info('%d', i)
+        sampled.warning('Предупреждение')
+        self.logger.info('Не выборочно')
+        self.logger.removeHandler(self.handler)
+        self.assertEqual(self.handler.messages, [str(i) for i in range(0, 100, 10)] + ['Предупреждение', 'Не выборочно'])
+
+
+class TestTracing(unittest.TestCase):
+    def setUp(self):
+        self.logger = logging.getLogger('test.tracing')
+        self.logger.propagate = False
+        self.handler = ListHandler()
+        self.logger.addHandler(self.handler)
+
+    def tearDown(self):
+        self.logger.removeHandler(self.handler)
+
+    def testCaller(self):
+        @trace(self.logger)
+        def traced(value):
+            return value * 2
+
+        def caller():
+            return traced(21)
+
+        self.logger.setLevel(logging.DEBUG)
+        self.assertEqual(caller(), 42)
+        self.logger.setLevel(logging.INFO)
+        self.assertEqual(caller(), 42)
+        self.assertEqual(self.handler.messages,
+                         ['Функция TestTracing.testCaller.<locals>.traced вызвана из функции caller'])
+        # Запись указывает на место вызова отмеченной функции, а не на декоратор
+        self.assertEqual((self.handler.records[0].module, self.handler.records[0].funcName), ('test_common', 'caller'))
+        self.assertEqual(traced.__name__, 'traced')
+
+    def testDuration(self):
+        registry = MetricsRegistry()
+
+        @trace(self.logger, timed=True, registry=registry)
+        def failed():
+            raise ValueError
+
+        self.logger.setLevel(logging.INFO)
+        for _ in range(3):
+            with self.assertRaises(ValueError):
+                failed()
+        histogram = registry.get('chat_function_duration_seconds',
+                                 function='TestTracing.testDuration.<locals>.failed')
+        self.assertEqual(histogram.count, 3)
+        self.assertEqual(self.handler.messages, [])
+
+
+class TestStorage(unittest.TestCase):
+    def testSqliteProfile(self):
+        path = os.path.join(tempfile.mkdtemp(), 'test.sqlite3')
+        engine = create_storage_engine(f'sqlite:///{path}')
+        with engine.connect() as connection:
+            self.assertEqual(connection.execute(text('PRAGMA journal_mode')).scalar(), 'wal')
+            self.assertEqual(connection.execute(text('PRAGMA synchronous')).scalar(), 1)
+        engine.dispose()
+
+    def testSessionPerThread(self):
+        # Каждый поток работает со своей сессией, база в памяти общая для всех потоков
+        engine = create_storage_engine('sqlite://')
+        session = create_session(engine)
+        session.execute(text('CREATE TABLE test (id INTEGER)'))
+        session.execute(text('INSERT INTO test VALUES (1)'))
+        session.commit()
+
+        result = {}
+
+        def read():
+            result['session'] = session()
+            result['count'] = session.execute(text('SELECT COUNT(*) FROM test')).scalar()
+            session.remove()
+
+        thread = threading.Thread(target=read)
+        thread.start()
+        thread.join()
+        self.assertIsNot(result['session'], session())
+        self.assertEqual(result['count'], 1)
+
+
+# Запустить тестирование
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+import logging
+import sys
+from functools import wraps
+from time import perf_counter
+
+from common.metrics import MetricsRegistry
+
+TRACING_METRICS = MetricsRegistry()
+"""Время выполнения функций, отмеченных trace(timed=True): гистограмма chat_function_duration_seconds"""
+
+
+def trace(logger, timed=False, registry=TRACING_METRICS):
+    """
+    Декоратор трассировки вызовов. При уровне логгера DEBUG записывает имя функции и имя вызывающей функции
+    (по кадру стека вызывающего, без чтения всего стека), при более высоком уровне только проверяет уровень.
+    Уровень проверяется при каждом вызове, поэтому трассировку можно включить без перезапуска.
+
+    :param logger: логгер
+    :param timed: записывать время выполнения в гистограмму chat_function_duration_seconds
+    :param registry: реестр метрик для гистограммы
+    :return: декоратор
+    """
+    def decorator(func):
+        name = func.__qualname__
+        is_enabled_for = logger.isEnabledFor
+        histogram = registry.histogram('chat_function_duration_seconds', 'Время выполнения функции',
+                                       function=name) if timed else None
+
+        if histogram is None:
+            @wraps(func)
+            def traced(*args, **kwargs):
+                if is_enabled_for(logging.DEBUG):
+                    logger.debug('Функция %s вызвана из функции %s', name, sys._getframe(1).f_code.co_name,
+                                 stacklevel=2)
+                return func(*args, **kwargs)
+            return traced
+
+        @wraps(func)
+        def timed_traced(*args, **kwargs):
+            if is_enabled_for(logging.DEBUG):
+                logger.debug('Функция %s вызвана из функции %s', name, sys._getframe(1).f_code.co_name,
+                             stacklevel=2)
+            start = perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                histogram.observe(perf_counter() - start)
+        return timed_traced
+    return decorator